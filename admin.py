@@ -0,0 +1,173 @@
+"""Служебные HTTP маршруты /admin/* рядом с /health.
+
+Доступны только с заголовком Authorization: Bearer <ADMIN_TOKEN>.
+Без ADMIN_TOKEN маршруты не регистрируются.
+"""
+import asyncio
+import hmac
+import json
+import logging
+import os
+
+import export
+from http_server import FileResponse, Response, NO_CACHE_HEADERS
+import tracing
+
+logger = logging.getLogger(__name__)
+
+
+def require_token(token, handler):
+    """Обертка маршрута: 403 без правильного токена администратора"""
+    expected = f"Bearer {token}".encode('utf-8')
+
+    async def guarded(request):
+        provided = request.headers.get('authorization', '').encode('utf-8')
+        if not hmac.compare_digest(provided, expected):
+            logger.warning(f"Запрос {request.method} {request.path} без токена администратора")
+            return Response(403, '403 Forbidden')
+        return await handler(request)
+
+    return guarded
+
+
+def json_response(data, status=200):
+    return Response(status, json.dumps(data, ensure_ascii=False), content_type='application/json', headers=NO_CACHE_HEADERS)
+
+
+def _float_param(request, name):
+    value = request.query.get(name)
+    return float(value) if value not in (None, '') else None
+
+
+async def profile_start(request):
+    """POST /admin/profile/start?seconds=N - начать окно профилирования"""
+    try:
+        seconds = _float_param(request, 'seconds')
+        tracing.profiler.start(asyncio.get_running_loop(), seconds)
+    except ValueError:
+        return Response(400, '400 Bad Request')
+    except RuntimeError as e:
+        return json_response({'error': str(e)}, status=400)
+    return json_response({'running': True, 'seconds': seconds})
+
+
+async def profile_stop(request):
+    """POST /admin/profile/stop - остановить профилирование"""
+    stopped = tracing.profiler.stop()
+    return json_response({'running': False, 'stopped': stopped})
+
+
+async def profile_download(request):
+    """GET /admin/profile - статистика последнего окна (?format=text для сводки)"""
+    profiler = tracing.profiler
+    if profiler.stats is None:
+        return json_response({'error': "Профилирование еще не выполнялось", 'running': profiler.running}, status=404)
+
+    if request.query.get('format') == 'text':
+        report = profiler.report(sort=request.query.get('sort', 'cumulative'))
+        return Response(200, report, headers=NO_CACHE_HEADERS)
+
+    return Response(
+        200,
+        profiler.dump(),
+        content_type='application/octet-stream',
+        headers={'Content-Disposition': 'attachment; filename="bot.prof"', **NO_CACHE_HEADERS},
+    )
+
+
+async def traces(request):
+    """GET /admin/traces - последние медленные обновления с интервалами"""
+    return json_response({
+        'sample_rate': tracing.sample_rate,
+        'slow_threshold': tracing.slow_threshold,
+        'traces': [trace.as_dict() for trace in tracing.slow_traces],
+    })
+
+
+async def configure_tracing(request):
+    """POST /admin/tracing?rate=0.1&threshold=0.5 - изменить настройки трассировки"""
+    try:
+        tracing.configure(_float_param(request, 'rate'), _float_param(request, 'threshold'))
+    except ValueError as e:
+        return json_response({'error': str(e)}, status=400)
+    return json_response({'sample_rate': tracing.sample_rate, 'slow_threshold': tracing.slow_threshold})
+
+
+def make_export_handler(export_file):
+    async def export_all(request):
+        """GET /admin/export?format=csv|jsonl - история достижений всех пользователей (gzip)"""
+        fmt = request.query.get('format', 'csv')
+        if fmt not in export.FORMATS:
+            return json_response({'error': f"Неизвестный формат выгрузки {fmt!r}"}, status=400)
+        path, rows = await export_file(fmt)
+
+        logger.info(f"Выгрузка всех пользователей: {rows} строк, {os.path.getsize(path)} байт")
+        return FileResponse(
+            path,
+            content_type='application/gzip',
+            headers={'Content-Disposition': f'attachment; filename="{export.export_filename(fmt)}"', **NO_CACHE_HEADERS},
+            remove=True,
+        )
+
+    return export_all
+
+
+def make_totals_handler(totals):
+    async def totals_handler(request):
+        """GET /admin/totals - пользователи, достижения и баллы по всей базе (или всем шардам)"""
+        return json_response(await totals())
+
+    return totals_handler
+
+
+def make_analytics_handler(analytics):
+    async def analytics_handler(request):
+        """GET /admin/analytics - выполнение целей, удержание, баллы за день и отказы по всем пользователям"""
+        try:
+            return json_response(await analytics())
+        except RuntimeError as e:
+            return json_response({'error': str(e)}, status=503)
+
+    return analytics_handler
+
+
+def make_broadcast_handler(broadcaster):
+    async def broadcast(request):
+        """POST /admin/broadcast?kind=reminder|digest - запустить рассылку за сегодня"""
+        try:
+            broadcaster.trigger(request.query.get('kind', ''))
+        except ValueError as e:
+            return json_response({'error': str(e)}, status=400)
+        return json_response({'started': request.query['kind']}, status=202)
+
+    return broadcast
+
+
+# Маршруты, которые не читают базу: работают и в принимающем процессе шардов
+ROUTES = (
+    ('POST', '/admin/profile/start', profile_start),
+    ('POST', '/admin/profile/stop', profile_stop),
+    ('GET', '/admin/profile', profile_download),
+    ('GET', '/admin/traces', traces),
+    ('POST', '/admin/tracing', configure_tracing),
+)
+
+
+def register_routes(server, token, broadcaster=None, totals=None, analytics=None, export_file=None):
+    """Зарегистрировать служебные маршруты на HTTP сервере.
+
+    Маршруты с базой получают функции процесса: свою базу или ShardPool,
+    который выполняет запрос на всех шардах
+    """
+    if not token:
+        return
+    for method, path, handler in ROUTES:
+        server.route(method, path, require_token(token, handler))
+    if totals is not None:
+        server.route('GET', '/admin/totals', require_token(token, make_totals_handler(totals)))
+    if export_file is not None:
+        server.route('GET', '/admin/export', require_token(token, make_export_handler(export_file)))
+    if analytics is not None:
+        server.route('GET', '/admin/analytics', require_token(token, make_analytics_handler(analytics)))
+    if broadcaster is not None:
+        server.route('POST', '/admin/broadcast', require_token(token, make_broadcast_handler(broadcaster)))
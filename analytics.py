@@ -0,0 +1,228 @@
+"""Когортная аналитика по всем пользователям для администратора.
+
+Столбцы users и daily_summary читаются из файла базы целиком, одним
+проходом, в отдельном процессе со своим соединением только для чтения:
+event loop бота и его читатели не ждут расчет. Все агрегаты считаются
+векторно в NumPy. Сначала собираются счетчики (collect), которые можно
+складывать между шардами (merge), затем по ним считаются доли
+и перцентили (summarize). NumPy - необязательная зависимость: без него
+аналитика недоступна, остальной бот работает. Процесс расчета запускается
+один раз при старте бота (start) и переиспользуется всеми запросами.
+"""
+import asyncio
+import importlib.util
+import itertools
+import multiprocessing
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date
+
+import database
+from goals import DAILY_GOALS, GOAL_BITS
+
+AVAILABLE = importlib.util.find_spec('numpy') is not None
+
+# Дни челленджа, для которых показывается удержание
+RETENTION_DAYS = (1, 2, 3, 7, 14, 21, 30, 60, 90)
+PERCENTILES = (10, 25, 50, 75, 90, 99)
+# Ширина корзины распределения баллов за день
+POINTS_BUCKET = 10
+
+# Процесс расчета (start/close)
+_pool = None
+
+# Даты как номер дня от 1970-01-01: переводит SQLite, Python строки не разбирает
+EPOCH = date(1970, 1, 1)
+USERS_SQL = '''
+    SELECT user_id,
+           COALESCE(CAST(julianday(challenge_start_date) - 2440587.5 AS INTEGER), -1),
+           COALESCE(challenge_active, -1)
+    FROM users ORDER BY user_id
+'''
+# Строка daily_summary одним числом (день << 40 | маска целей << 24 | баллы):
+# основное время уходит на создание объектов Python для каждого значения.
+# user_id строк восстанавливается по RUNS_SQL, строки идут в порядке ключа (user_id, day)
+DAYS_SQL = '''
+    SELECT (CAST(julianday(day) - 2440587.5 AS INTEGER) << 40) | (goals_mask << 24) | MIN(MAX(points, 0), 16777215)
+    FROM daily_summary ORDER BY user_id, day
+'''
+RUNS_SQL = 'SELECT user_id, COUNT(*) FROM daily_summary GROUP BY user_id ORDER BY user_id'
+
+
+def _columns(conn, sql, width):
+    """Результат запроса как массив int64 формы (строк, width)"""
+    import numpy as np
+
+    values = np.fromiter(itertools.chain.from_iterable(conn.execute(sql)), dtype=np.int64)
+    return values.reshape(-1, width)
+
+
+def collect(path, today=None):
+    """Счетчики по файлу базы (выполняется в отдельном процессе).
+
+    Все значения - числа и списки чисел: счетчики шардов складываются merge
+    """
+    import numpy as np
+
+    today = ((today or date.today()) - EPOCH).days
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        # Все запросы читают один снимок базы, бот в это время продолжает писать
+        conn.execute("BEGIN")
+        user_ids, starts, active = _columns(conn, USERS_SQL, 3).T
+        run_users, run_lengths = _columns(conn, RUNS_SQL, 2).T
+        packed = _columns(conn, DAYS_SQL, 1)[:, 0]
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+    row_users = np.repeat(run_users, run_lengths)
+    row_days = packed >> 40
+    masks = (packed >> 24) & 0xFFFF
+    points = packed & 0xFFFFFF
+
+    bits = np.array(list(GOAL_BITS.values()), dtype=np.int64)
+    goal_days = np.count_nonzero(masks[:, None] & bits, axis=0)
+    points_histogram = np.bincount(points, minlength=1)
+
+    # День челленджа каждой строки: users отсортированы по user_id
+    positions = np.searchsorted(user_ids, row_users)
+    known = positions < len(user_ids)
+    known[known] = user_ids[positions[known]] == row_users[known]
+    row_starts = starts[positions[known]]
+    challenge_days = row_days[known] - row_starts + 1
+    active_by_day = np.bincount(challenge_days[(row_starts >= 0) & (challenge_days >= 1)], minlength=1)
+
+    # Сколько дней идет челлендж у каждого пользователя: до дня d дошли все с ages >= d
+    ages = today - starts[starts >= 0] + 1
+    users_by_age = np.bincount(ages[ages >= 1], minlength=1)
+
+    return {
+        'users': len(user_ids),
+        # -1 - челлендж не начат (challenge_active IS NULL): это не отказ
+        'abandoned': int(np.count_nonzero(active == 0)),
+        'user_days': len(row_days),
+        'goal_days': goal_days.tolist(),
+        'points_histogram': points_histogram.tolist(),
+        'active_by_day': active_by_day.tolist(),
+        'users_by_age': users_by_age.tolist(),
+    }
+
+
+def merge(results):
+    """Сложить счетчики нескольких баз (шардов)"""
+    import numpy as np
+
+    merged = {}
+    for result in results:
+        for key, value in result.items():
+            if isinstance(value, list):
+                current = np.array(merged.get(key, []), dtype=np.int64)
+                value = np.array(value, dtype=np.int64)
+                total = np.zeros(max(len(current), len(value)), dtype=np.int64)
+                total[:len(current)] += current
+                total[:len(value)] += value
+                merged[key] = total.tolist()
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def _rate(part, whole):
+    return round(part / whole, 4) if whole else None
+
+
+def summarize(counts):
+    """Отчет: выполнение целей, удержание по дням челленджа, баллы за день, отказы"""
+    import numpy as np
+
+    user_days = counts['user_days']
+    completion = {
+        goal_id: {'name': goal['name'], 'days': days, 'rate': _rate(days, user_days)}
+        for (goal_id, goal), days in zip(DAILY_GOALS.items(), counts['goal_days'])
+    }
+
+    active_by_day = np.array(counts['active_by_day'], dtype=np.int64)
+    # reached[d] - пользователи, чей челлендж дошел до дня d
+    reached = np.cumsum(np.array(counts['users_by_age'], dtype=np.int64)[::-1])[::-1]
+    retention = {}
+    for day in RETENTION_DAYS:
+        eligible = int(reached[day]) if day < len(reached) else 0
+        retained = int(active_by_day[day]) if day < len(active_by_day) else 0
+        retention[str(day)] = {'users': eligible, 'active': retained, 'rate': _rate(retained, eligible)}
+
+    histogram = np.array(counts['points_histogram'], dtype=np.int64)
+    values = np.arange(len(histogram))
+    cumulative = np.cumsum(histogram)
+    points = {'days': user_days, 'mean': None, 'percentiles': {}, 'buckets': {}}
+    if user_days:
+        points['mean'] = round(float((histogram * values).sum() / user_days), 2)
+        # Перцентиль по ближайшему рангу: первое значение, до которого набралось p% дней
+        ranks = np.ceil(np.array(PERCENTILES) / 100 * user_days)
+        points['percentiles'] = {
+            f'p{p}': int(value) for p, value in zip(PERCENTILES, np.searchsorted(cumulative, ranks))
+        }
+        starts = np.arange(0, len(histogram), POINTS_BUCKET)
+        points['buckets'] = {
+            f'{start}-{start + POINTS_BUCKET - 1}': int(count)
+            for start, count in zip(starts, np.add.reduceat(histogram, starts))
+            if count
+        }
+
+    return {
+        'users': counts['users'],
+        'abandoned': counts['abandoned'],
+        'abandoned_share': _rate(counts['abandoned'], counts['users']),
+        'user_days': user_days,
+        'goal_completion': completion,
+        'retention': retention,
+        'daily_points': points,
+    }
+
+
+def _warm_up():
+    import numpy  # noqa: F401
+
+
+def start():
+    """Запустить процесс расчета: интерпретатор и numpy загружаются один раз, а не на каждый запрос"""
+    global _pool
+    if not AVAILABLE or _pool is not None:
+        return
+    # spawn: в процесс расчета не попадают потоки и соединения бота
+    _pool = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'))
+    _pool.submit(_warm_up)
+
+
+def close():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+async def collect_counts():
+    """Счетчики базы этого процесса: расчет в процессе пула"""
+    if not AVAILABLE:
+        raise RuntimeError("Аналитика недоступна: не установлен numpy")
+    path = await database.flushed_path()
+    start()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_pool, collect, path)
+    except BrokenProcessPool:
+        # Процесс расчета упал: следующий запрос запустит новый
+        close()
+        raise
+
+
+async def report():
+    """Отчет по базе этого процесса"""
+    return summarize(await collect_counts())
+
+
+def report_sync():
+    """Отчет по открытой базе, расчет в текущем процессе (manage.py)"""
+    if not AVAILABLE:
+        raise RuntimeError("Аналитика недоступна: не установлен numpy")
+    return summarize(collect(database.flushed_path_sync()))
@@ -0,0 +1,374 @@
+"""Нагрузочный тест обработчиков бота без Telegram.
+
+Настоящие обработчики bot.py получают поток синтетических обновлений
+от заданного числа пользователей, исходящие вызовы уходят в fake_bot_api.py,
+база - временный файл с заранее загруженной историей. Результат
+записывается в JSON: пропускная способность, p50/p95/p99 задержки по
+действиям, число запросов к базе и вызовов Bot API на обновление.
+
+Примеры:
+    python benchmark.py --users 1000 --updates 20000
+    python benchmark.py --mix achievement=80,today_stats=20 --output after.json --baseline before.json
+    python benchmark.py --engine memory --output memory.json --baseline before.json
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import math
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import telegram
+
+from fake_bot_api import FakeBotApi
+from goals import DAILY_GOALS, MENU_BUTTONS
+
+logger = logging.getLogger(__name__)
+
+# Доля нажатий каждого действия реестра, command_start - команда /start
+DEFAULT_MIX = {
+    'achievement': 50,
+    'menu': 15,
+    'today_stats': 10,
+    'month_history': 5,
+    'month_total': 5,
+    'challenge_management': 5,
+    'stats_menu': 5,
+    'start': 3,
+    'command_start': 2,
+}
+
+
+def build_taps():
+    """Тексты сообщений для каждого действия по реестру кнопок"""
+    taps = collections.defaultdict(list)
+    for goal in DAILY_GOALS.values():
+        taps['achievement'].extend(goal['buttons'])
+    for text, (action, *_) in MENU_BUTTONS.items():
+        taps[action].append(text)
+    taps['command_start'].append('/start')
+    return taps
+
+
+def parse_mix(value):
+    """Строка вида achievement=60,today_stats=40 -> словарь весов"""
+    mix = {}
+    for item in value.split(','):
+        action, _, weight = item.partition('=')
+        mix[action.strip()] = float(weight or 1)
+    return mix
+
+
+def percentile(sorted_values, percent):
+    """Перцентиль методом ближайшего ранга"""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values) * 1000, 3),
+        'p50': round(percentile(values, 50) * 1000, 3),
+        'p95': round(percentile(values, 95) * 1000, 3),
+        'p99': round(percentile(values, 99) * 1000, 3),
+        'max': round(values[-1] * 1000, 3),
+    }
+
+
+class QueryCounter:
+    """Счетчик запросов к базе по первому ключевому слову (SELECT, INSERT...)"""
+
+    def __init__(self):
+        self.kinds = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, sql):
+        # Вызывается из потоков писателя и читателей
+        kind = sql.split(None, 1)[0].upper() if sql.strip() else ''
+        with self._lock:
+            self.kinds[kind] += 1
+
+    @property
+    def queries(self):
+        return sum(self.kinds[kind] for kind in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH'))
+
+
+def make_history(users, days, today, rng):
+    """Пользователи и их достижения за прошедшие дни"""
+    user_rows = []
+    achievement_rows = []
+    for user_id in users:
+        user_rows.append((user_id, f'user{user_id}', f'User{user_id}', today - timedelta(days=days)))
+        for offset in range(days, 0, -1):
+            day = today - timedelta(days=offset)
+            for goal_id, goal in DAILY_GOALS.items():
+                if rng.random() < 0.5:
+                    points, _ = rng.choice(list(goal['buttons'].values()))
+                    achievement_rows.append((user_id, goal['category'], goal_id, points, day))
+    return user_rows, achievement_rows
+
+
+def make_stream(users, count, mix, taps, rng):
+    """Последовательность (пользователь, действие, текст) заданной длины"""
+    actions = [action for action in mix if taps.get(action)]
+    unknown = set(mix) - set(actions)
+    if unknown:
+        raise ValueError(f"Нет кнопок для действий: {', '.join(sorted(unknown))}")
+
+    weights = [mix[action] for action in actions]
+    stream = []
+    for action in rng.choices(actions, weights, k=count):
+        stream.append((rng.choice(users), action, rng.choice(taps[action])))
+    return stream
+
+
+async def run_benchmark(args):
+    rng = random.Random(args.seed)
+
+    api = FakeBotApi(latency=args.api_latency, flood_limit=args.api_flood_limit)
+    await api.start()
+
+    # config читает окружение при импорте, поэтому бот импортируется после запуска API
+    os.environ.setdefault('BOT_TOKEN', '1:benchmark')
+    os.environ['BOT_MODE'] = 'polling'
+    os.environ['BOT_API_URL'] = api.url
+    os.environ['MAX_CONCURRENT_UPDATES'] = str(args.concurrency)
+    os.environ['SEND_GLOBAL_RATE'] = str(args.global_send_rate)
+    os.environ['SEND_CHAT_RATE'] = str(args.chat_send_rate)
+    os.environ['ACHIEVEMENT_REPLY_MODE'] = args.reply_mode
+    import bot
+    import database
+
+    logging.getLogger().setLevel(args.log_level)
+
+    workdir = None
+    db_path = args.db
+    if db_path is None:
+        workdir = tempfile.TemporaryDirectory(prefix='benchmark-')
+        db_path = os.path.join(workdir.name, 'benchmark.db')
+
+    today = date.today()
+    users = list(range(1, args.users + 1))
+    database.init_db(db_path, engine=args.engine)
+    user_rows, achievement_rows = make_history(users, args.history_days, today, rng)
+    database.import_history(user_rows, achievement_rows)
+    logger.warning(f"База {db_path}: {len(user_rows)} пользователей, {len(achievement_rows)} достижений в истории")
+
+    stream = make_stream(users, args.updates, args.mix, build_taps(), rng)
+
+    application = bot.build_application()
+    errors = []
+
+    async def count_error(update, context):
+        errors.append(repr(context.error))
+
+    application.add_error_handler(count_error)
+    await application.initialize()
+
+    latencies = collections.defaultdict(list)
+    service_times = collections.defaultdict(list)
+
+    async def handle(update, action, submitted):
+        started = time.perf_counter()
+        await application.process_update(update)
+        finished = time.perf_counter()
+        latencies[action].append(finished - submitted)
+        service_times[action].append(finished - started)
+
+    counter = QueryCounter()
+    database.set_query_trace(counter)
+    api.calls.clear()
+    cache_hits, cache_misses = database.progress_cache.hits, database.progress_cache.misses
+
+    tasks = []
+    started = time.perf_counter()
+    for index, (user_id, action, text) in enumerate(stream):
+        if args.rate:
+            # Открытая нагрузка: обновления приходят по расписанию, а не по готовности бота
+            delay = started + index / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        data = api.make_message_update(user_id, text)
+        data['update_id'] = index + 1
+        update = telegram.Update.de_json(data, application.bot)
+        submitted = time.perf_counter()
+        tasks.append(asyncio.create_task(
+            application.update_processor.process_update(update, handle(update, action, submitted))
+        ))
+    await asyncio.gather(*tasks)
+    duration = time.perf_counter() - started
+
+    database.set_query_trace(None)
+    api_calls = collections.Counter(method for method, _, _ in api.calls)
+    hits = database.progress_cache.hits - cache_hits
+    misses = database.progress_cache.misses - cache_misses
+
+    await bot.outbox.close()
+    await application.shutdown()
+    database.close_db()
+    await api.stop()
+    if workdir is not None:
+        workdir.cleanup()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    all_service = [value for values in service_times.values() for value in values]
+    updates = len(stream)
+
+    return {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'config': {
+            'users': args.users,
+            'updates': updates,
+            'history_days': args.history_days,
+            'mix': args.mix,
+            'rate': args.rate,
+            'concurrency': args.concurrency,
+            'global_send_rate': args.global_send_rate,
+            'chat_send_rate': args.chat_send_rate,
+            'reply_mode': args.reply_mode,
+            'api_latency': args.api_latency,
+            'api_flood_limit': args.api_flood_limit,
+            'seed': args.seed,
+            'engine': args.engine,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'python_telegram_bot': telegram.__version__,
+            'platform': platform.platform(),
+        },
+        'totals': {
+            'duration_s': round(duration, 3),
+            'throughput_ups': round(updates / duration, 2) if duration else 0.0,
+            'errors': len(errors),
+        },
+        'latency_ms': {'all': summarize(all_latencies), **{a: summarize(v) for a, v in sorted(latencies.items())}},
+        'service_ms': {'all': summarize(all_service), **{a: summarize(v) for a, v in sorted(service_times.items())}},
+        'db': {
+            'queries': counter.queries,
+            'queries_per_update': round(counter.queries / updates, 3) if updates else 0.0,
+            'statements': dict(counter.kinds.most_common()),
+        },
+        'api': {
+            'calls': sum(api_calls.values()),
+            'calls_per_update': round(sum(api_calls.values()) / updates, 3) if updates else 0.0,
+            'methods': dict(api_calls.most_common()),
+            'rejected_429': api.rejected_calls,
+        },
+        'progress_cache': {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': round(hits / (hits + misses), 3) if hits + misses else 0.0,
+        },
+        'error_samples': errors[:10],
+    }
+
+
+def compare(result, baseline, max_regression):
+    """Сравнить с прошлым запуском, вернуть список регрессий сверх порога (в процентах)"""
+    regressions = []
+
+    def change(new, old):
+        return (new - old) / old * 100 if old else 0.0
+
+    throughput = change(result['totals']['throughput_ups'], baseline['totals']['throughput_ups'])
+    print(f"throughput: {baseline['totals']['throughput_ups']} -> {result['totals']['throughput_ups']} ({throughput:+.1f}%)")
+    if max_regression is not None and -throughput > max_regression:
+        regressions.append(f"throughput {throughput:+.1f}%")
+
+    for action, stats in result['latency_ms'].items():
+        old = baseline['latency_ms'].get(action)
+        if not old or not old.get('count') or not stats.get('count'):
+            continue
+        p95 = change(stats['p95'], old['p95'])
+        print(f"{action:22} p95: {old['p95']:>9} -> {stats['p95']:>9} ms ({p95:+.1f}%)")
+        if max_regression is not None and p95 > max_regression:
+            regressions.append(f"{action} p95 {p95:+.1f}%")
+
+    queries = result['db']['queries_per_update']
+    old_queries = baseline['db']['queries_per_update']
+    print(f"queries/update: {old_queries} -> {queries}")
+    return regressions
+
+
+def print_report(result):
+    totals = result['totals']
+    print(f"{result['config']['updates']} обновлений за {totals['duration_s']} с: "
+          f"{totals['throughput_ups']} обн/с, ошибок {totals['errors']}")
+    print(f"{'действие':22} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9}  (мс)")
+    for action, stats in result['latency_ms'].items():
+        print(f"{action:22} {stats['count']:>7} {stats['p50']:>9} {stats['p95']:>9} {stats['p99']:>9}")
+    print(f"запросов к базе на обновление: {result['db']['queries_per_update']}, "
+          f"вызовов Bot API на обновление: {result['api']['calls_per_update']}, "
+          f"попаданий в кэш прогресса: {result['progress_cache']['hit_ratio']}")
+
+
+def main():
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.WARNING,
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков бота")
+    parser.add_argument('--users', type=int, default=1000, help="число синтетических пользователей")
+    parser.add_argument('--updates', type=int, default=10000, help="число обновлений в потоке")
+    parser.add_argument('--history-days', type=int, default=30, help="дней истории на пользователя")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help="доли действий, например achievement=60,today_stats=40")
+    parser.add_argument('--rate', type=float, default=0, help="обновлений в секунду (0 - все сразу)")
+    parser.add_argument('--concurrency', type=int, default=64, help="MAX_CONCURRENT_UPDATES")
+    parser.add_argument('--global-send-rate', type=float, default=0,
+                        help="SEND_GLOBAL_RATE, сообщений в секунду (0 - без ограничения)")
+    parser.add_argument('--chat-send-rate', type=float, default=0,
+                        help="SEND_CHAT_RATE, сообщений в чат в секунду (0 - без ограничения)")
+    parser.add_argument('--reply-mode', default='merge', choices=('merge', 'edit', 'off'),
+                        help="ACHIEVEMENT_REPLY_MODE")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="задержка ответа Bot API, с")
+    parser.add_argument('--api-flood-limit', type=int, default=0,
+                        help="Bot API отвечает 429 сверх стольких сообщений в секунду (0 - без ограничения)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--db', help="файл базы (по умолчанию временный)")
+    parser.add_argument('--engine', default=os.getenv('DB_ENGINE', 'sqlite'), help="движок данных: sqlite или memory")
+    parser.add_argument('--output', default='benchmark.json', help="куда записать результат в JSON")
+    parser.add_argument('--baseline', help="JSON прошлого запуска для сравнения")
+    parser.add_argument('--max-regression', type=float,
+                        help="код возврата 1, если p95 или пропускная способность хуже базы на столько процентов")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    result = asyncio.run(run_benchmark(args))
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print_report(result)
+    print(f"Результат записан в {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.max_regression)
+        if regressions:
+            print(f"Регрессии: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,15 +1,37 @@
 import logging
-import sqlite3
 import os
 import asyncio
+import hmac
+import json
+import secrets
+import socket
 import sys
 import time
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from telegram import Update, ReplyKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from telegram.error import Conflict, TimedOut, NetworkError
+from telegram.ext import Application, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes
+from telegram.error import BadRequest, Conflict, TimedOut, NetworkError
 import database
 import config
+import admin
+import analytics
+import charts
+from goals import DAILY_GOALS
+from leadership import LeaderLease
+from http_server import HttpServer, Response, NO_CACHE_HEADERS
+import keyboards
+import metrics
+from progress import PROGRESS_SCREENS
+from streaks import compute_streaks, render_streaks
+import tracing
+from broadcast import Broadcaster
+from compaction import Compactor
+import export
+from router import build_routers
+from sender import Sender
+from sharding import ShardLayoutError, ShardPool, check_layout, worker_loop
+from state_store import ConversationStore
+from update_processor import PerUserUpdateProcessor
 
 # Настройка логирования
 logging.basicConfig(
@@ -21,18 +43,29 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Ежедневные цели
-DAILY_GOALS = {
-    'workout': {'name': 'Тренировка', 'points': 10, 'emoji': '💪', 'percent': 15},
-    'meditation': {'name': 'Медитация', 'points': 5, 'emoji': '🧘', 'percent': 10},
-    'reading': {'name': 'Книга (30 минут)', 'points': 5, 'emoji': '📚', 'percent': 15},
-    'steps': {'name': '10.000 шагов', 'points': 10, 'emoji': '🚶', 'percent': 20},
-    'chinese': {'name': 'Китайский (1 час)', 'points': 10, 'emoji': '🀅', 'percent': 20},
-    'thesis': {'name': 'Диссертация (1 страница)', 'points': 10, 'emoji': '📝', 'percent': 20}
-}
+# Состояния диалогов: пользователь подтверждает отказ от челленджа.
+# Обновления одного пользователя обрабатываются по порядку (PerUserUpdateProcessor),
+# поэтому состояние пользователя меняет только его собственный обработчик
+conversations = ConversationStore(
+    ttl=config.CONVERSATION_TTL,
+    max_users=config.CONVERSATION_MAX_USERS,
+    persist=config.CONVERSATION_PERSIST,
+)
+CONFIRM_QUIT = 'confirm_quit'
+
+# Очередь исходящих сообщений с ограничением частоты и ежедневные рассылки,
+# создаются в build_application
+outbox = None
+broadcaster = None
+compactor = None
+# Отрисовка графиков в пуле процессов, пул создается при первом графике
+chart_renderer = charts.ChartRenderer(workers=config.CHART_WORKERS, cache_size=config.CHART_CACHE_SIZE)
+# Процессы шардов, если бот запущен с SHARDS > 1 (только в принимающем процессе)
+shard_pool = None
 
-# Глобальная переменная для отслеживания подтверждения отказа
-challenge_confirmations = {}
+async def reply(update: Update, text: str, reply_markup: ReplyKeyboardMarkup = None):
+    """Ответить в чат пользователя через очередь отправки"""
+    return await outbox.send_message(update.effective_chat.id, text, reply_markup=reply_markup)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Приветствие и главное меню"""
@@ -40,16 +73,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = user.id
     
     # Регистрируем/получаем пользователя
-    database.get_or_create_user(user_id, user.username, user.first_name)
+    await database.get_or_create_user(user_id, user.username, user.first_name)
     
     # Получаем день челленджа
-    challenge_day = database.get_challenge_day(user_id)
-    
-    keyboard = [
-        ['💪 Тело', '🧠 Разум', '🧘 Медитация'],
-        ['📊 Статистика', '🔧 Управление челленджем']
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    challenge_day = await database.get_challenge_day(user_id)
     
     today = date.today()
     
@@ -71,150 +98,136 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"{progress_message}"
     )
     
-    await update.message.reply_text(welcome_text, reply_markup=reply_markup)
+    await reply(update, welcome_text, reply_markup=keyboards.MAIN_KEYBOARD)
+
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /start"""
+    with metrics.track_update('command_start'), tracing.trace_update('command_start', update.effective_user.id):
+        await start(update, context)
+
+async def export_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отправить историю достижений файлом CSV или JSON Lines (/export jsonl)"""
+    user_id = update.effective_user.id
+    fmt = context.args[0].lower() if context.args else 'csv'
+    if fmt not in export.FORMATS:
+        await reply(update, f"Доступные форматы: {', '.join(export.FORMATS)}. Например: /export jsonl")
+        return
+
+    path, rows = await export.export_to_file(fmt, user_id)
+    try:
+        if not rows:
+            await reply(update, "Пока нечего выгружать - отметь первое достижение! 💪")
+            return
+        with open(path, 'rb') as document:
+            async def send_document(**kwargs):
+                # Очередь повторяет вызов после RetryAfter: каждая попытка читает файл с начала
+                document.seek(0)
+                return await context.bot.send_document(document=document, **kwargs)
+
+            # Файл закрывается после последней попытки
+            await outbox.send(
+                update.effective_chat.id,
+                send_document,
+                chat_id=update.effective_chat.id,
+                filename=export.export_filename(fmt, user_id),
+                caption=f"📦 История достижений: {rows} записей",
+            )
+    finally:
+        os.remove(path)
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /export"""
+    with metrics.track_update('command_export'), tracing.trace_update('command_export', update.effective_user.id):
+        await export_history(update, context)
 
 async def get_daily_progress(user_id: int, today: date):
     """Получить прогресс по ежедневным целям"""
-    conn = sqlite3.connect('achievements.db')
-    cur = conn.cursor()
-    
-    # Получаем выполненные сегодня достижения
-    cur.execute("""
-        SELECT achievement_type 
-        FROM achievements 
-        WHERE user_id = ? AND date = ?
-    """, (user_id, today))
-    
-    completed_tasks = {row[0] for row in cur.fetchall()}
-    conn.close()
-    
-    # Строим сообщение с прогрессом
-    progress_text = "📊 Ежедневные цели:\n\n"
-    
-    completed_percent = 0
-    total_goals = len(DAILY_GOALS)
-    completed_count = 0
-    
-    for goal_id, goal_info in DAILY_GOALS.items():
-        if goal_id in completed_tasks:
-            status = "✅"
-            completed_percent += goal_info['percent']
-            completed_count += 1
-        else:
-            status = "⭕"
-        
-        progress_text += f"{status} {goal_info['emoji']} {goal_info['name']}\n"
-    
-    progress_text += f"\n📈 Прогресс: {completed_percent}% выполнено"
+    # Маска выполненных сегодня целей, обычно из кэша без обращения к базе
+    completed_mask = await database.get_completed_mask(user_id, today)
     
-    return progress_text, completed_count, total_goals
+    # Готовый экран прогресса: текст, число выполненных целей, всего целей
+    return PROGRESS_SCREENS[completed_mask]
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка всех нажатий на кнопки"""
     user_input = update.message.text
     user_id = update.effective_user.id
-    today = date.today()
     
+    route = None
     # Обработка подтверждения отказа от челленджа
-    if user_id in challenge_confirmations:
-        if user_input == "✅ Да, отказаться":
-            database.deactivate_challenge(user_id)
-            del challenge_confirmations[user_id]
-            await update.message.reply_text(
-                "🎯 Челендж завершен! Твои баллы сохранены, но счетчик дней остановлен.\n"
-                "Ты всегда можешь начать новый челлендж!",
-                reply_markup=ReplyKeyboardMarkup([['/start']], resize_keyboard=True)
-            )
-            return
-        elif user_input == "❌ Нет, продолжить":
-            del challenge_confirmations[user_id]
-            await start(update, context)
-            return
-    
-    if user_input == "💪 Тело":
-        keyboard = [['🚶 10.000 шагов', '💪 Тренировка'], ['← Назад']]
-        await show_menu(update, "Что выполнил для тела?", keyboard)
-    
-    elif user_input == "🧠 Разум":
-        keyboard = [['📚 Книга 30 мин', '🀅 Китайский'], ['📝 Диссертация', '← Назад']]
-        await show_menu(update, "Что выполнил для разума?", keyboard)
-    
-    elif user_input == "🧘 Медитация":
-        await process_achievement(update, user_id, 'mind', 'meditation', 5, "медитацию")
-    
-    elif user_input == "🀅 Китайский":
-        keyboard = [['🀅 1 час', '🀅 2 часа'], ['← Назад']]
-        await show_menu(update, "Сколько времени уделил китайскому?", keyboard)
-    
-    elif user_input == "📊 Статистика":
-        await show_stats_menu(update, user_id)
-    
-    elif user_input == "🔧 Управление челленджем":
-        await show_challenge_management(update, user_id)
-    
-    # Обработка достижений
-    elif user_input == "🚶 10.000 шагов":
-        await process_achievement(update, user_id, 'body', 'steps', 10, "10.000 шагов")
-    
-    elif user_input == "💪 Тренировка":
-        await process_achievement(update, user_id, 'body', 'workout', 10, "тренировку")
-    
-    elif user_input == "📚 Книга 30 мин":
-        await process_achievement(update, user_id, 'mind', 'reading', 5, "чтение 30 минут")
-    
-    elif user_input == "🀅 1 час":
-        await process_achievement(update, user_id, 'mind', 'chinese', 10, "китайский язык (1 час)")
-    
-    elif user_input == "🀅 2 часа":
-        await process_achievement(update, user_id, 'mind', 'chinese', 20, "китайский язык (2 часа)")
-    
-    elif user_input == "📝 Диссертация":
-        await process_achievement(update, user_id, 'mind', 'thesis', 10, "страницу диссертации")
-    
-    elif user_input == "← Назад":
-        await start(update, context)
+    if conversations.get(user_id) == CONFIRM_QUIT:
+        route = confirmation_router.resolve(user_input)
+    if route is None:
+        route = router.resolve(user_input)
     
-    # Обработка управления челленджем
-    elif user_input == "❌ Отказаться от челленджа":
-        challenge_confirmations[user_id] = True
-        keyboard = [['✅ Да, отказаться', '❌ Нет, продолжить']]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        await update.message.reply_text(
-            "⚠️ Вы уверены, что хотите отказаться от челленджа?\n\n"
-            "📊 Ваши баллы сохранятся, но счетчик дней остановится.\n"
-            "Это действие нельзя отменить!",
-            reply_markup=reply_markup
-        )
+    if route is None:
+        metrics.UPDATES.inc('unknown')
         return
     
-    # Обработка меню статистики
-    elif user_input == "📈 Статистика за сегодня":
-        await show_today_stats(update, user_id)
-    
-    elif user_input == "📅 История за месяц":
-        await show_month_history(update, user_id)
-    
-    elif user_input == "💰 Общий итог за месяц":
-        await show_month_total(update, user_id)
+    with metrics.track_update(route.action), tracing.trace_update(route.action, user_id):
+        await route.handler(update, context, *route.args)
+
+async def ask_quit_confirmation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Запросить подтверждение отказа от челленджа"""
+    await conversations.set(update.effective_user.id, CONFIRM_QUIT)
+    await reply(update, 
+        "⚠️ Вы уверены, что хотите отказаться от челленджа?\n\n"
+        "📊 Ваши баллы сохранятся, но счетчик дней остановится.\n"
+        "Это действие нельзя отменить!",
+        reply_markup=keyboards.CONFIRM_QUIT_KEYBOARD
+    )
+
+async def quit_challenge(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отказ от челленджа подтвержден"""
+    user_id = update.effective_user.id
+    await database.deactivate_challenge(user_id)
+    await conversations.pop(user_id)
+    await reply(update, 
+        "🎯 Челендж завершен! Твои баллы сохранены, но счетчик дней остановлен.\n"
+        "Ты всегда можешь начать новый челлендж!",
+        reply_markup=keyboards.RESTART_KEYBOARD
+    )
+
+async def keep_challenge(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Пользователь передумал отказываться от челленджа"""
+    await conversations.pop(update.effective_user.id)
+    await start(update, context)
 
-async def process_achievement(update: Update, user_id: int, category: str, achievement_type: str, points: int, achievement_name: str):
-    """Обработать достижение и отправить два сообщения"""
+async def process_achievement(update: Update, context: ContextTypes.DEFAULT_TYPE, achievement_type: str, points: int, achievement_name: str):
+    """Обработать достижение: подтверждение и обновленный прогресс"""
+    user_id = update.effective_user.id
+    category = DAILY_GOALS[achievement_type]['category']
     today = date.today()
+    mode = config.ACHIEVEMENT_REPLY_MODE
+    
+    # Добавляем достижение в базу: повторное обновление и цель сверх max_per_day не записываются
+    result = await database.add_achievement(user_id, category, achievement_type, points, update.update_id)
+    if result == database.DUPLICATE_UPDATE:
+        # На это обновление уже ответили при первой обработке
+        logger.info(f"Повтор обновления {update.update_id} от пользователя {user_id} пропущен")
+        return
+    if result == database.DAILY_LIMIT:
+        goal = DAILY_GOALS[achievement_type]
+        await reply(update,
+            f"👌 {goal['emoji']} {goal['name']} - на сегодня уже засчитано, баллы не добавлены.\n"
+            f"Выбери следующее достижение:",
+            reply_markup=keyboards.CONTINUE_KEYBOARD,
+        )
+        return
     
-    # Сообщение 1: Подтверждение добавления баллов
-    challenge_day = database.get_challenge_day(user_id)
+    # Подтверждение добавления баллов
+    challenge_day = await database.get_challenge_day(user_id)
     challenge_text = f"🎯 День {challenge_day}\n" if challenge_day else "🎯 Челендж завершен\n"
     
     achievement_message = f"🎉 За {achievement_name} +{points} баллов!\n{challenge_text}"
-    await update.message.reply_text(achievement_message)
-    
-    # Добавляем достижение в базу
-    database.add_achievement(user_id, category, achievement_type, points)
-    
-    # Небольшая пауза для лучшего UX
-    await asyncio.sleep(0.5)
-    
-    # Сообщение 2: Обновленный прогресс и предложение продолжить
+    sent = None
+    if mode == 'edit':
+        # Клавиатура ставится сразу: правка сообщения не может ее изменить
+        sent = await reply(update, achievement_message, reply_markup=keyboards.CONTINUE_KEYBOARD)
+    elif mode == 'off':
+        await reply(update, achievement_message)
+    
+    # Обновленный прогресс и предложение продолжить
     progress_data = await get_daily_progress(user_id, today)
     progress_message = progress_data[0]
     completed_count = progress_data[1]
@@ -222,72 +235,59 @@ async def process_achievement(update: Update, user_id: int, category: str, achie
     
     if completed_count == total_goals:
         # Все достижения выполнены
-        completion_message = (
+        progress_reply = (
             f"{progress_message}\n\n"
             f"🎊 Так держать, сегодня ты закрыл все достижения! 🎊\n"
             f"Завтра - больше! 🦾"
         )
-        await update.message.reply_text(completion_message)
+        keyboard = None
     else:
         # Не все достижения выполнены - предлагаем продолжить
-        continue_message = (
+        progress_reply = (
             f"{progress_message}\n\n"
             f"Продолжай в том же духе! 💪\n"
             f"Выбери следующее достижение:"
         )
-        
-        keyboard = [
-            ['💪 Тело', '🧠 Разум', '🧘 Медитация'],
-            ['📊 Статистика', '← Назад']
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-        await update.message.reply_text(continue_message, reply_markup=reply_markup)
-
-async def show_challenge_management(update: Update, user_id: int):
+        keyboard = keyboards.CONTINUE_KEYBOARD
+    
+    if mode == 'merge':
+        await reply(update, f"{achievement_message}\n{progress_reply}", reply_markup=keyboard)
+    elif mode == 'edit':
+        await outbox.edit_message_text(sent.chat_id, sent.message_id, f"{achievement_message}\n{progress_reply}")
+    else:
+        await reply(update, progress_reply, reply_markup=keyboard)
+
+async def show_challenge_management(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать меню управления челленджем"""
-    challenge_day = database.get_challenge_day(user_id)
+    user_id = update.effective_user.id
+    challenge_day = await database.get_challenge_day(user_id)
     
     if challenge_day:
         message = f"🎯 Текущий челлендж: День {challenge_day}\n\n"
         message += "Ты можешь отказаться от челленджа, если нужно сделать перерыв.\n"
-        message += "Твои баллы сохранятся, но счетчик дней остановится."
+        message += "Твои баллы сохранятся, но счетчик дней остановится.\n\n"
+        
+        day_masks = await database.get_day_masks(user_id)
+        with tracing.span('render streaks'):
+            message += render_streaks(compute_streaks(day_masks, date.today()))
         
-        keyboard = [['❌ Отказаться от челленджа'], ['← Назад']]
+        keyboard = keyboards.CHALLENGE_ACTIVE_KEYBOARD
     else:
         message = "🎯 У тебя нет активного челленджа.\n"
         message += "Начни новый челлендж командой /start!"
         
-        keyboard = [['← Назад']]
+        keyboard = keyboards.CHALLENGE_INACTIVE_KEYBOARD
     
     await show_menu(update, message, keyboard)
 
-async def show_stats_menu(update: Update, user_id: int):
+async def show_stats_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать меню статистики"""
-    keyboard = [
-        ['📈 Статистика за сегодня', '📅 История за месяц'],
-        ['💰 Общий итог за месяц', '← Назад']
-    ]
-    await show_menu(update, "📊 Выбери тип статистики:", keyboard)
+    await show_menu(update, "📊 Выбери тип статистики:", keyboards.STATS_KEYBOARD)
 
-async def show_today_stats(update: Update, user_id: int):
+async def show_today_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать статистику за сегодня"""
-    conn = sqlite3.connect('achievements.db')
-    cur = conn.cursor()
-    
-    cur.execute("SELECT SUM(points) FROM achievements WHERE user_id = ? AND date = ?", 
-                (user_id, date.today()))
-    result = cur.fetchone()
-    today_points = result[0] if result[0] else 0
-    
-    cur.execute("""
-        SELECT category, SUM(points) 
-        FROM achievements 
-        WHERE user_id = ? AND date = ? 
-        GROUP BY category
-    """, (user_id, date.today()))
-    category_stats = cur.fetchall()
-    
-    conn.close()
+    user_id = update.effective_user.id
+    today_points, category_stats = await database.get_day_stats(user_id, date.today())
     
     message = f"📊 Сегодня {date.today().strftime('%d.%m.%Y')}:\n"
     message += f"Всего баллов: {today_points}\n\n"
@@ -297,199 +297,469 @@ async def show_today_stats(update: Update, user_id: int):
         category_name = "Тело" if category == 'body' else "Разум"
         message += f"{emoji} {category_name}: {points} баллов\n"
     
-    await update.message.reply_text(message)
+    await reply(update, message)
 
-async def show_month_history(update: Update, user_id: int):
+async def show_month_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать историю за месяц"""
-    conn = sqlite3.connect('achievements.db')
-    cur = conn.cursor()
-    
-    cur.execute("""
-        SELECT date, SUM(points) as daily_points
-        FROM achievements
-        WHERE user_id = ? AND strftime('%Y-%m', date) = strftime('%Y-%m', 'now')
-        GROUP BY date
-        ORDER BY date DESC
-    """, (user_id,))
-    
-    data = cur.fetchall()
-    conn.close()
+    user_id = update.effective_user.id
+    data = await database.get_month_history(user_id, date.today())
     
     if not data:
-        await update.message.reply_text("📅 В этом месяце еще нет достижений!")
+        await reply(update, "📅 В этом месяце еще нет достижений!")
         return
     
     current_month = datetime.now().strftime('%B %Y')
     message = f"📅 История за {current_month}:\n\n"
     
-    for entry_date, daily_points in data:
-        formatted_date = datetime.strptime(entry_date, '%Y-%m-%d').strftime('%d.%m')
-        message += f"{formatted_date}: {daily_points} баллов\n"
+    with tracing.span('render month history'):
+        for entry_date, daily_points in data:
+            formatted_date = datetime.strptime(entry_date, '%Y-%m-%d').strftime('%d.%m')
+            message += f"{formatted_date}: {daily_points} баллов\n"
     
-    await update.message.reply_text(message)
+    await reply(update, message)
 
-async def show_month_total(update: Update, user_id: int):
+async def show_month_total(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показать общий итог за месяц"""
-    conn = sqlite3.connect('achievements.db')
-    cur = conn.cursor()
-    
-    cur.execute("""
-        SELECT SUM(points) FROM achievements
-        WHERE user_id = ? AND strftime('%Y-%m', date) = strftime('%Y-%m', 'now')
-    """, (user_id,))
-    
-    result = cur.fetchone()
-    month_total = result[0] if result[0] else 0
-    conn.close()
+    user_id = update.effective_user.id
+    month_total = await database.get_month_total(user_id, date.today())
     
     current_month = datetime.now().strftime('%B %Y')
-    await update.message.reply_text(
+    await reply(update, 
         f"💰 Всего в {current_month} набрано: {month_total} баллов!\n"
         f"Так держать! 💥"
     )
 
-async def show_menu(update: Update, text: str, keyboard: list):
-    """Показать меню с кнопками"""
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text(text, reply_markup=reply_markup)
+async def show_month_chart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показать график баллов и выполненных целей за месяц"""
+    if not charts.AVAILABLE:
+        await reply(update, "📉 Графики сейчас недоступны, загляни в историю за месяц 📅")
+        return
+
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    today = date.today()
+    history, masks = await asyncio.gather(
+        database.get_month_history(user_id, today),
+        database.get_month_masks(user_id, today),
+    )
+    if not history and not masks:
+        await reply(update, "📉 В этом месяце еще нет достижений!")
+        return
+
+    daily_points = {date.fromisoformat(day).day: points for day, points in history}
+    daily_goals = {date.fromisoformat(day).day: mask.bit_count() for day, mask in masks}
+    days = list(range(1, today.day + 1))
+    points = [daily_points.get(day, 0) for day in days]
+    completion = [round(100 * daily_goals.get(day, 0) / len(DAILY_GOALS)) for day in days]
+
+    # Одинаковые данные - одна картинка, даже у разных пользователей
+    current_month = datetime.now().strftime('%B %Y')
+    key = charts.chart_key('month', {'month': current_month, 'points': points, 'completion': completion})
+    caption = f"📉 Прогресс за {current_month}: {sum(points)} баллов"
+
+    file_id = await database.get_chart_file(key)
+    if file_id is not None:
+        try:
+            await outbox.send(chat_id, context.bot.send_photo, chat_id=chat_id, photo=file_id, caption=caption)
+            metrics.CHART_REQUESTS.inc('file_id')
+            return
+        except BadRequest as e:
+            logger.warning(f"file_id графика {key[:12]} не принят ({e}), отправляем картинку заново")
+            await database.forget_chart_file(key)
+
+    with tracing.span('render month chart'):
+        image, rendered = await chart_renderer.render(
+            key, charts.render_month, current_month, days, points, completion
+        )
+    metrics.CHART_REQUESTS.inc('render' if rendered else 'memory')
+
+    message = await outbox.send(chat_id, context.bot.send_photo, chat_id=chat_id, photo=image, caption=caption)
+    if message is not None and message.photo:
+        await database.save_chart_file(key, message.photo[-1].file_id)
+
+async def show_menu(update: Update, text: str, keyboard: ReplyKeyboardMarkup):
+    """Показать меню с заранее созданной клавиатурой"""
+    await reply(update, text, reply_markup=keyboard)
+
+async def open_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, keyboard: ReplyKeyboardMarkup):
+    """Действие реестра: показать подменю"""
+    await show_menu(update, text, keyboard)
+
+# Действия, на которые ссылается реестр кнопок в goals.py
+ACTIONS = {
+    'start': start,
+    'menu': open_menu,
+    'achievement': process_achievement,
+    'stats_menu': show_stats_menu,
+    'challenge_management': show_challenge_management,
+    'today_stats': show_today_stats,
+    'month_history': show_month_history,
+    'month_total': show_month_total,
+    'month_chart': show_month_chart,
+    'confirm_quit': ask_quit_confirmation,
+    'quit_challenge': quit_challenge,
+    'keep_challenge': keep_challenge,
+}
+
+# Маршрутизаторы строятся один раз при запуске
+router, confirmation_router = build_routers(ACTIONS, make_keyboard=keyboards.make_keyboard)
 
 # Обработчики ошибок
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка ошибок"""
+    metrics.ERRORS.inc(type(context.error).__name__)
     logger.error(f"Ошибка при обработке обновления {update}: {context.error}")
 
-# Простой HTTP сервер без aiohttp
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import threading
-
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.handle_request()
-    
-    def do_HEAD(self):
-        """Обработка HEAD запросов для health checks от Render"""
-        self.handle_request(head_only=True)
-    
-    def handle_request(self, head_only=False):
-        if self.path == '/health' or self.path == '/':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain; charset=utf-8')
-            self.send_header('Cache-Control', 'no-cache, no-store, must-revalidate')
-            self.send_header('Pragma', 'no-cache')
-            self.send_header('Expires', '0')
-            self.end_headers()
-            if not head_only:
-                self.wfile.write('Bot is running! ✅'.encode('utf-8'))
-        else:
-            self.send_response(404)
-            self.end_headers()
-            if not head_only:
-                self.wfile.write('404 Not Found'.encode('utf-8'))
-    
-    def log_message(self, format, *args):
-        # Отключаем логирование запросов
-        pass
-
-def run_http_server():
-    """Запуск HTTP сервера в отдельном потоке"""
-    port = int(os.getenv('PORT', 10000))
-    server = HTTPServer(('0.0.0.0', port), HealthHandler)
-    logger.info(f"HTTP сервер запущен на порту {port}")
-    server.serve_forever()
+# HTTP сервер работает на том же event loop, что и бот:
+# /health, /metrics и webhook обслуживаются одним сервером на одном порту
+http_server = None
+loop_lag_monitor = metrics.LoopLagMonitor()
+# Аренда лидерства, создается в main (в процессах шардов ее нет)
+lease = None
 
-def run_sync_bot():
-    """Синхронная обертка для запуска бота"""
-    # Инициализируем базу данных
-    database.init_db()
-    
-    # Запускаем HTTP сервер в отдельном потоке
-    http_thread = threading.Thread(target=run_http_server, daemon=True)
-    http_thread.start()
-    logger.info("HTTP сервер запущен в отдельном потоке")
-    
-    # Создаем приложение бота с настройкой соединения
-    application = (
+async def health(request):
+    """Ответ для health checks от Render"""
+    return Response(200, 'Bot is running! ✅', headers=NO_CACHE_HEADERS)
+
+async def metrics_endpoint(request):
+    """Метрики в формате Prometheus"""
+    return Response(200, metrics.render(), content_type=metrics.CONTENT_TYPE, headers=NO_CACHE_HEADERS)
+
+def make_webhook_handler(application: Application, secret: str):
+    """Обработчик webhook: проверяет секрет и передает обновление приложению"""
+    async def webhook(request):
+        token = request.headers.get('x-telegram-bot-api-secret-token', '')
+        if not hmac.compare_digest(token.encode('utf-8'), secret.encode('utf-8')):
+            logger.warning("Webhook запрос с неверным секретным токеном")
+            return Response(403, '403 Forbidden')
+
+        # Неразбираемое тело - 400: Telegram не повторяет такой запрос
+        try:
+            data = json.loads(request.body)
+            if not isinstance(data, dict):
+                raise ValueError("обновление должно быть объектом JSON")
+            update = Update.de_json(data, application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Webhook запрос с неверным обновлением: {e}")
+            return Response(400, '400 Bad Request')
+
+        await application.update_queue.put(update)
+        return Response(200)
+
+    return webhook
+
+async def start_http_server(application: Application, webhook_secret: str = None):
+    """Запуск HTTP сервера на event loop бота"""
+    global http_server
+
+    http_server = HttpServer(port=config.PORT)
+    http_server.route('GET', '/health', health)
+    http_server.route('GET', '/', health)
+    http_server.route('GET', '/metrics', metrics_endpoint)
+    totals = shard_pool.totals if shard_pool is not None else database.get_totals
+    report = shard_pool.analytics if shard_pool is not None else analytics.report
+    if config.ADMIN_TOKEN and shard_pool is None:
+        # Процесс расчета аналитики запускается заранее и живет до остановки бота
+        analytics.start()
+    export_file = shard_pool.export if shard_pool is not None else export.export_to_file
+    admin.register_routes(http_server, config.ADMIN_TOKEN, broadcaster, totals, report, export_file)
+    if webhook_secret:
+        http_server.route('POST', config.WEBHOOK_PATH, make_webhook_handler(application, webhook_secret))
+
+    await http_server.start()
+    loop_lag_monitor.start()
+
+async def post_init(application: Application):
+    """В режиме polling HTTP сервер нужен только для /health"""
+    await start_http_server(application)
+    broadcaster.start()
+    if compactor is not None:
+        compactor.start()
+    if lease is not None:
+        lease.start(application.stop_running)
+
+async def post_stop(application: Application):
+    """Остановить рассылки и отправить сообщения, оставшиеся в очереди,
+    пока соединение с Bot API открыто"""
+    await broadcaster.stop()
+    if compactor is not None:
+        await compactor.stop()
+    if outbox is not None:
+        await outbox.close()
+
+async def post_shutdown(application: Application):
+    """Остановить HTTP сервер и закрыть соединения с базой после остановки бота"""
+    global http_server
+
+    await loop_lag_monitor.stop()
+    chart_renderer.close()
+    analytics.close()
+    if http_server is not None:
+        await http_server.stop()
+        http_server = None
+    database.close_db()
+    # Все принятые обновления обработаны и записаны - новый экземпляр может начинать
+    if lease is not None:
+        await lease.stop()
+        lease.release()
+
+async def start_webhook(application: Application):
+    """Запустить приложение и зарегистрировать webhook"""
+    secret = config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    webhook_url = config.WEBHOOK_URL.rstrip('/') + config.WEBHOOK_PATH
+
+    await application.initialize()
+    await start_http_server(application, webhook_secret=secret)
+    await application.start()
+    broadcaster.start()
+    if compactor is not None:
+        compactor.start()
+    if lease is not None:
+        lease.start(application.stop_running)
+    # Обновления, пришедшие во время передачи работы, не сбрасываем
+    await application.bot.set_webhook(
+        url=webhook_url,
+        secret_token=secret,
+        allowed_updates=Update.ALL_TYPES,
+        drop_pending_updates=False
+    )
+    logger.info(f"Webhook установлен: {webhook_url}")
+
+async def stop_application(application: Application):
+    """Обработать принятые обновления и остановить приложение"""
+    if application.running:
+        await application.stop()
+    await post_stop(application)
+    await application.shutdown()
+    await post_shutdown(application)
+
+def run_webhook(application: Application):
+    """Режим webhook: Telegram сам присылает обновления на HTTP сервер бота"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(start_webhook(application))
+        # Работаем до сигнала завершения
+        loop.run_forever()
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Остановка webhook режима")
+    finally:
+        loop.run_until_complete(stop_application(application))
+        loop.close()
+
+# Соединений с Bot API: столько же вызовов одновременно выполняет очередь отправки
+SEND_CONNECTIONS = 8
+
+def broadcast_schedule():
+    """Расписание рассылок из настроек: вид -> время запуска"""
+    schedule = {}
+    for kind, value in (('reminder', config.REMINDER_TIME), ('digest', config.DIGEST_TIME)):
+        if value:
+            schedule[kind] = datetime.strptime(value, '%H:%M').time()
+    return schedule
+
+def make_builder():
+    """Настройки соединения с Bot API и хуки запуска, общие для всех режимов"""
+    builder = (
         Application.builder()
         .token(config.BOT_TOKEN)
-        .connection_pool_size(8)
-        .pool_timeout(30)
-        .read_timeout(30)
-        .write_timeout(30)
-        .connect_timeout(30)
-        .build()
+        # Запросы Bot API замеряются для /metrics
+        .request(metrics.InstrumentedRequest(
+            connection_pool_size=SEND_CONNECTIONS,
+            pool_timeout=30,
+            read_timeout=30,
+            write_timeout=30,
+            connect_timeout=30,
+        ))
+        .get_updates_request(metrics.InstrumentedRequest(connection_pool_size=1))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if config.BOT_API_URL:
+        # Локальный Bot API сервер или fake_bot_api для проверки
+        builder = builder.base_url(f"{config.BOT_API_URL}/bot").base_file_url(f"{config.BOT_API_URL}/file/bot")
+    return builder
+
+def build_application():
+    """Создать приложение бота с настройкой соединения"""
+    global outbox, broadcaster, compactor
+    
+    application = make_builder().concurrent_updates(PerUserUpdateProcessor(config.MAX_CONCURRENT_UPDATES)).build()
+    outbox = Sender(
+        application.bot,
+        global_rate=config.SEND_GLOBAL_RATE,
+        chat_rate=config.SEND_CHAT_RATE,
+        chat_burst=config.SEND_CHAT_BURST,
+        concurrency=SEND_CONNECTIONS,
     )
+    broadcaster = Broadcaster(
+        outbox,
+        schedule=broadcast_schedule(),
+        window=timedelta(minutes=config.BROADCAST_WINDOW_MINUTES),
+    )
+    if config.COMPACTION_TIME and database.HISTORY_HORIZON_DAYS:
+        compactor = Compactor(datetime.strptime(config.COMPACTION_TIME, '%H:%M').time())
+    tracing.configure(config.TRACE_SAMPLE_RATE, config.SLOW_UPDATE_THRESHOLD)
     
     # Добавляем обработчики команд
-    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("export", export_command))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
     # Добавляем обработчик ошибок
     application.add_error_handler(error_handler)
+    return application
+
+def build_front_application():
+    """Принимающее приложение: только передает обновления процессам шардов"""
+    global broadcaster, shard_pool
+    
+    application = make_builder().build()
+    # Рассылки и служебные запросы выполняют шарды, пул рассылает их всем
+    shard_pool = broadcaster = ShardPool(config.SHARDS, database.DB_PATH, config.PORT)
+    application.add_handler(TypeHandler(Update, shard_pool.forward))
+    application.add_error_handler(error_handler)
+    return application
+
+async def serve_shard(index, inbox, results):
+    """Процесс шарда: обрабатывать обновления из очереди принимающего процесса"""
+    database.init_db()
+    conversations.load()
+    application = build_application()
+    
+    async def handle_update(data):
+        await application.update_queue.put(Update.de_json(data, application.bot))
+    
+    async def trigger_broadcast(kind, day=None):
+        broadcaster.trigger(kind, day)
+        return kind
+    
+    async def export_part(fmt):
+        # Заголовок CSV только в части первого шарда: части склеиваются подряд
+        return await export.export_to_file(fmt, header=index == 0)
+    
+    calls = {
+        'totals': database.get_totals,
+        'broadcast': trigger_broadcast,
+        'analytics': analytics.collect_counts,
+        'export': export_part,
+    }
+    
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+    logger.info(f"Шард {index} запущен, база {database.DB_PATH}")
+    try:
+        await worker_loop(index, inbox, results, handle_update, calls)
+    finally:
+        await stop_application(application)
+        logger.info(f"Шард {index} остановлен")
+
+def run_sync_bot():
+    """Синхронная обертка для запуска бота"""
+    check_layout(database.DB_PATH, config.SHARDS)
+    if config.SHARDS > 1:
+        # Базы открывают процессы шардов
+        application = build_front_application()
+    else:
+        # Инициализируем базу данных
+        database.init_db()
+        restored = conversations.load()
+        if restored:
+            logger.info(f"Восстановлено состояний диалогов: {restored}")
+        
+        application = build_application()
     
-    # Запускаем бота с параметрами для избежания конфликтов
-    logger.info("Бот запущен! 🚀")
+    logger.info(f"Бот запущен в режиме {config.BOT_MODE}! 🚀")
     
     try:
-        # Запускаем polling с параметрами
-        application.run_polling(
-            drop_pending_updates=True,
-            allowed_updates=Update.ALL_TYPES,
-            poll_interval=0.5,  # Увеличиваем интервал
-            timeout=10,
-            close_loop=False
-        )
+        if config.BOT_MODE == 'webhook':
+            run_webhook(application)
+        else:
+            # Запасной режим: polling. Конфликты getUpdates исключает аренда лидерства,
+            # обновления, пришедшие во время передачи работы, не сбрасываем
+            application.run_polling(
+                drop_pending_updates=False,
+                allowed_updates=Update.ALL_TYPES,
+                poll_interval=0,
+                timeout=10,
+                close_loop=False,
+                # Сигналы обрабатывает signal_handler, чтобы сначала зафиксировать очередь записей
+                stop_signals=None
+            )
     except Exception as e:
-        logger.error(f"Ошибка в run_polling: {e}")
+        logger.error(f"Ошибка в режиме {config.BOT_MODE}: {e}")
         raise
 
+def restart_delay(attempt):
+    """Пауза перед повторным запуском: 1, 2, 4... секунд, не больше 30"""
+    return min(2 ** (attempt - 1), 30)
+
 def main():
     """Основная функция для запуска бота"""
+    global lease
+    
     logger.info(f"Запуск бота на Render. PID: {os.getpid()}")
     
-    # Ждем перед стартом, чтобы предыдущий процесс мог завершиться
-    time.sleep(5)
+    # Предыдущий экземпляр освобождает аренду, как только дообработает обновления
+    lease = LeaderLease(
+        config.LEASE_PATH or f"{database.DB_PATH}.lease",
+        holder=f"{socket.gethostname()}:{os.getpid()}",
+        ttl=config.LEASE_TTL,
+    )
     
     retry_count = 0
     max_retries = 5
     
     while retry_count < max_retries:
+        lease.wait()
         try:
             logger.info(f"Попытка запуска бота #{retry_count + 1}")
             run_sync_bot()
+            if lease.superseded:
+                logger.info("Работа передана новому экземпляру")
+            else:
+                # Штатный выход из run_sync_bot означает сигнал завершения - не перезапускаемся
+                logger.info("Бот остановлен")
+            break
             
         except Conflict as e:
-            logger.warning(f"Конфликт обнаружен. Подождите 30 секунд...")
+            # getUpdates вызывает экземпляр, не использующий общий файл аренды
             retry_count += 1
-            if retry_count < max_retries:
-                wait_time = 30 * retry_count
-                logger.info(f"Ожидание {wait_time} секунд перед повторной попыткой...")
-                time.sleep(wait_time)
-            else:
-                logger.error("Достигнуто максимальное количество попыток")
-                break
+            wait_time = restart_delay(retry_count)
+            logger.warning(f"Конфликт с другим экземпляром бота, повтор через {wait_time} с")
+            time.sleep(wait_time)
                 
         except (TimedOut, NetworkError) as e:
-            logger.warning(f"Сетевая ошибка: {e}. Перезапуск через 10 секунд...")
             retry_count += 1
-            time.sleep(10)
+            wait_time = restart_delay(retry_count)
+            logger.warning(f"Сетевая ошибка: {e}. Перезапуск через {wait_time} с")
+            time.sleep(wait_time)
             
         except KeyboardInterrupt:
             logger.info("Бот остановлен пользователем")
             break
             
+        except ShardLayoutError as e:
+            # Повторный запуск не поможет: нужен manage.py split-shards
+            logger.error(str(e))
+            sys.exit(1)
+            
         except Exception as e:
             logger.error(f"Неожиданная ошибка: {type(e).__name__}: {e}")
             import traceback
             logger.error(f"Трассировка: {traceback.format_exc()}")
             
             retry_count += 1
-            if retry_count < max_retries:
-                wait_time = 60 * retry_count
-                logger.info(f"Ожидание {wait_time} секунд перед повторной попыткой...")
-                time.sleep(wait_time)
-            else:
-                logger.error("Достигнуто максимальное количество попыток")
-                break
+            wait_time = restart_delay(retry_count)
+            logger.info(f"Ожидание {wait_time} секунд перед повторной попыткой...")
+            time.sleep(wait_time)
+        
+        finally:
+            lease.release()
+    else:
+        logger.error("Достигнуто максимальное количество попыток")
 
 if __name__ == '__main__':
     # Устанавливаем обработчик для корректного завершения
@@ -497,6 +767,8 @@ if __name__ == '__main__':
     
     def signal_handler(signum, frame):
         logger.info(f"Получен сигнал {signum}. Завершаем работу...")
+        # Ни одно нажатое достижение не должно потеряться в очереди записей
+        database.drain_writes()
         sys.exit(0)
     
     signal.signal(signal.SIGINT, signal_handler)
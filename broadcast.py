@@ -0,0 +1,179 @@
+"""Ежедневные рассылки: напоминание о невыполненных целях и итоги дня.
+
+Получатели выбираются страницами одним запросом к users и daily_summary
+(keyset по user_id), сообщения уходят через очередь отправки с приоритетом
+рассылки, поэтому ответы пользователям не ждут рассылку, а ограничения
+частоты Telegram соблюдаются. После каждой страницы прогресс сохраняется
+в broadcast_runs: после перезапуска рассылка продолжается с того же места.
+Сообщения страницы, прерванной перезапуском, могут быть отправлены повторно.
+"""
+import asyncio
+import logging
+from datetime import date, datetime, timedelta
+
+from telegram.error import Forbidden
+
+import database
+from goals import ALL_GOALS_MASK
+import metrics
+from progress import PROGRESS_SCREENS
+from sender import BROADCAST
+
+logger = logging.getLogger(__name__)
+
+
+def reminder_text(mask, points):
+    """Напоминание о целях, которые еще не выполнены"""
+    progress_text, completed_count, total_goals = PROGRESS_SCREENS[mask]
+    return (
+        f"⏰ Напоминание! Осталось целей на сегодня: {total_goals - completed_count}\n\n"
+        f"{progress_text}\n\n"
+        f"Еще есть время, чтобы успеть! 💪"
+    )
+
+
+def digest_text(mask, points):
+    """Итоги дня"""
+    progress_text, completed_count, total_goals = PROGRESS_SCREENS[mask]
+    ending = "🎊 Все цели выполнены!" if completed_count == total_goals else "Завтра - больше! 🦾"
+    return (
+        f"🌙 Итоги дня: {points} баллов\n\n"
+        f"{progress_text}\n\n"
+        f"{ending}"
+    )
+
+
+# Виды рассылок: текст сообщения и маска, получатели с которой пропускаются
+# (-1 - никто не пропускается)
+KINDS = {
+    'reminder': (reminder_text, ALL_GOALS_MASK),
+    'digest': (digest_text, -1),
+}
+
+
+class Broadcaster:
+    def __init__(self, sender, schedule=None, window=timedelta(hours=2), page_size=200, concurrency=64):
+        self.sender = sender
+        # Вид рассылки -> время запуска (datetime.time) по часам сервера
+        self.schedule = schedule or {}
+        self.window = window
+        self.page_size = page_size
+        self.concurrency = concurrency
+        self._tasks = {}
+        # Рассылки (вид, день), которые выполняются сейчас
+        self._running = set()
+        self._stopping = False
+
+    def start(self):
+        """Запустить ожидание рассылок по расписанию"""
+        self._stopping = False
+        loop = asyncio.get_running_loop()
+        for kind, at in self.schedule.items():
+            self._tasks[kind] = loop.create_task(self._schedule_loop(kind, at))
+            logger.info(f"Рассылка {kind} запланирована на {at.strftime('%H:%M')}")
+
+    def trigger(self, kind, day=None):
+        """Запустить рассылку сейчас в фоне (для /admin/broadcast)"""
+        if kind not in KINDS:
+            raise ValueError(f"Неизвестная рассылка {kind!r}")
+        day = day or date.today()
+        name = f"{kind}:{day.isoformat()}:manual"
+        task = asyncio.get_running_loop().create_task(self.run(kind, day, datetime.now() + self.window))
+        self._tasks[name] = task
+        task.add_done_callback(lambda _: self._tasks.pop(name, None))
+        return task
+
+    async def stop(self, timeout=10.0):
+        """Дать текущим страницам дослаться и остановить рассылки"""
+        self._stopping = True
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        if not tasks:
+            return
+
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _schedule_loop(self, kind, at):
+        day = date.today()
+        while not self._stopping:
+            start = datetime.combine(day, at)
+            deadline = start + self.window
+            now = datetime.now()
+
+            if now >= deadline:
+                # Окно рассылки на этот день уже прошло
+                day += timedelta(days=1)
+                continue
+            if now < start:
+                await asyncio.sleep((start - now).total_seconds())
+
+            try:
+                await self.run(kind, day, deadline)
+            except Exception as e:
+                logger.error(f"Ошибка рассылки {kind} за {day}: {e}")
+            day += timedelta(days=1)
+
+    async def run(self, kind, day, deadline):
+        """Отправить рассылку за день, продолжая с сохраненного места"""
+        if (kind, day) in self._running:
+            logger.warning(f"Рассылка {kind} за {day} уже выполняется")
+            return
+
+        self._running.add((kind, day))
+        try:
+            await self._run(kind, day, deadline)
+        finally:
+            self._running.discard((kind, day))
+
+    async def _run(self, kind, day, deadline):
+        make_text, skip_mask = KINDS[kind]
+
+        state = await database.get_broadcast_run(kind, day)
+        if state is not None and state[3]:
+            logger.info(f"Рассылка {kind} за {day} уже завершена")
+            return
+        last_user_id, sent, failed = state[:3] if state is not None else (0, 0, 0)
+        if last_user_id:
+            logger.info(f"Рассылка {kind} за {day} продолжается после пользователя {last_user_id}")
+
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(user_id, mask, points):
+            async with slots:
+                try:
+                    await self.sender.send_message(user_id, make_text(mask, points), BROADCAST)
+                except Forbidden:
+                    # Пользователь заблокировал бота
+                    metrics.BROADCAST_MESSAGES.inc(kind, 'forbidden')
+                    return False
+                except Exception as e:
+                    metrics.BROADCAST_MESSAGES.inc(kind, 'error')
+                    logger.warning(f"Рассылка {kind}: не отправлено пользователю {user_id}: {e}")
+                    return False
+                metrics.BROADCAST_MESSAGES.inc(kind, 'sent')
+                return True
+
+        while True:
+            if self._stopping:
+                logger.info(f"Рассылка {kind} за {day} остановлена, продолжится после перезапуска")
+                return
+            if datetime.now() >= deadline:
+                logger.warning(f"Рассылка {kind} за {day} не уложилась в окно, отправлено {sent}")
+                return
+
+            page = await database.get_broadcast_targets(day, last_user_id, self.page_size, skip_mask)
+            if not page:
+                break
+
+            results = await asyncio.gather(*(deliver(*row) for row in page))
+            delivered = sum(results)
+            sent += delivered
+            failed += len(results) - delivered
+            last_user_id = page[-1][0]
+            await database.save_broadcast_run(kind, day, last_user_id, sent, failed)
+
+        await database.save_broadcast_run(kind, day, last_user_id, sent, failed, finished=True)
+        logger.info(f"Рассылка {kind} за {day} завершена: отправлено {sent}, ошибок {failed}")
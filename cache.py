@@ -0,0 +1,110 @@
+from collections import OrderedDict
+
+
+class DailyProgressCache:
+    """LRU-кэш масок целей, выполненных пользователями за текущий день.
+
+    Запись в базу сразу обновляет кэш (write-through), при смене даты
+    кэш очищается. Число хранимых пользователей ограничено max_users.
+    """
+
+    def __init__(self, max_users=10000):
+        self.max_users = max_users
+        self._day = None
+        self._entries = OrderedDict()
+        # Счетчики записей по пользователям: загрузка из базы, во время которой
+        # у этого пользователя была запись, может вернуть устаревшие данные
+        # и не попадает в кэш. Записи других пользователей загрузке не мешают.
+        # Очищаются вместе с кэшем при смене даты
+        self._generations = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _is_current(self, day):
+        if day == self._day:
+            return True
+        if self._day is None or day > self._day:
+            # Наступил новый день - вчерашний прогресс больше не нужен
+            self._entries.clear()
+            self._generations.clear()
+            self._day = day
+            return True
+        return False
+
+    def get(self, user_id, day):
+        """Маска выполненных целей или None, если пользователя нет в кэше"""
+        mask = self._entries.get(user_id) if self._is_current(day) else None
+
+        if mask is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(user_id)
+        return mask
+
+    def generation(self, user_id):
+        """Счетчик записей пользователя: взять до загрузки и передать в put"""
+        return self._generations.get(user_id, 0)
+
+    def put(self, user_id, day, mask, generation):
+        """Сохранить загруженную из базы маску целей"""
+        if generation != self._generations.get(user_id, 0) or not self._is_current(day):
+            return
+
+        self._entries[user_id] = mask
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+
+    def add(self, user_id, day, bit):
+        """Отметить записанную в базу цель (бит маски)"""
+        if not self._is_current(day):
+            return
+        self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+        mask = self._entries.get(user_id)
+        if mask is not None:
+            self._entries[user_id] = mask | bit
+
+    def clear(self):
+        self._entries.clear()
+        self._generations.clear()
+        self._day = None
+
+
+class RecentIds:
+    """Ограниченное множество недавно обработанных идентификаторов.
+
+    Повторы отсекаются без обращения к базе. Вытесненный старый
+    идентификатор проверяет уже уникальный индекс в базе.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+        # Попадание - найденный повтор
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, key):
+        if key in self._ids:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, key):
+        self._ids[key] = None
+        self._ids.move_to_end(key)
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+    def clear(self):
+        self._ids.clear()
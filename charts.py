@@ -0,0 +1,101 @@
+"""Графики прогресса для меню статистики.
+
+Картинки рисуются matplotlib в пуле процессов, event loop бота не ждет
+отрисовку. Ключ графика - хеш данных, по которым он построен: готовая
+картинка берется из памяти, а file_id уже загруженной в Telegram
+картинки хранится в базе, поэтому повторный показ не требует ни
+отрисовки, ни загрузки. matplotlib - необязательная зависимость:
+без него графики недоступны, остальной бот работает.
+"""
+import asyncio
+import collections
+import hashlib
+import importlib.util
+import io
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+AVAILABLE = importlib.util.find_spec('matplotlib') is not None
+
+# Меняется вместе с оформлением графиков: старые file_id перестают совпадать
+CHART_VERSION = 1
+
+
+def chart_key(kind, data):
+    """Ключ графика по виду и данным (одинаковые данные - одна картинка)"""
+    payload = json.dumps([CHART_VERSION, kind, data], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def render_month(title, days, points, completion):
+    """PNG с баллами по дням и долей выполненных целей (выполняется в процессе пула)"""
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(8, 6), dpi=100)
+    points_ax, completion_ax = fig.subplots(2, 1, sharex=True)
+
+    points_ax.bar(days, points, color='#4C9BE8')
+    points_ax.set_title(title)
+    points_ax.set_ylabel('Баллы')
+    points_ax.grid(axis='y', alpha=0.3)
+
+    completion_ax.plot(days, completion, marker='o', color='#3BB273')
+    completion_ax.fill_between(days, completion, alpha=0.15, color='#3BB273')
+    completion_ax.set_ylim(0, 100)
+    completion_ax.set_ylabel('Цели, %')
+    completion_ax.set_xlabel('День месяца')
+    completion_ax.set_xticks(days[::2] if len(days) > 16 else days)
+    completion_ax.grid(alpha=0.3)
+
+    fig.tight_layout()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png')
+    return buffer.getvalue()
+
+
+class ChartRenderer:
+    """Пул процессов для отрисовки и кэш готовых картинок по ключу"""
+
+    def __init__(self, workers=2, cache_size=128):
+        self.workers = workers
+        self.cache_size = cache_size
+        self._images = collections.OrderedDict()
+        # Ключ -> отрисовка, которая уже идет: одинаковые запросы ждут ее
+        self._pending = {}
+        self._pool = None
+
+    async def render(self, key, func, *args):
+        """Картинка по ключу: из кэша или отрисованная func(*args) в пуле.
+
+        Возвращает (png, отрисована ли сейчас)
+        """
+        image = self._images.get(key)
+        if image is not None:
+            self._images.move_to_end(key)
+            return image, False
+
+        future = self._pending.get(key)
+        if future is None:
+            if self._pool is None:
+                # spawn: в процессы пула не попадают потоки и соединения бота
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            future = asyncio.get_running_loop().run_in_executor(self._pool, func, *args)
+            self._pending[key] = future
+            try:
+                image = await future
+            finally:
+                del self._pending[key]
+            self._images[key] = image
+            while len(self._images) > self.cache_size:
+                self._images.popitem(last=False)
+            return image, True
+
+        return await asyncio.shield(future), False
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,70 @@
+"""Ежедневное обслуживание истории достижений.
+
+Записи старше HISTORY_HORIZON_DAYS сжимаются в архив дневных сумм
+с кодами категорий и типов, затем освободившиеся страницы небольшими
+шагами возвращаются системе (incremental VACUUM). Все изменения идут
+через общую очередь записей короткими транзакциями, бот продолжает
+отвечать. Сводные таблицы не меняются, поэтому экраны статистики
+показывают то же, что и до сжатия.
+"""
+import asyncio
+import logging
+from datetime import date, datetime, timedelta
+
+import database
+
+logger = logging.getLogger(__name__)
+
+
+class Compactor:
+    def __init__(self, at, horizon_days=database.HISTORY_HORIZON_DAYS, vacuum_pages=database.VACUUM_STEP_PAGES):
+        # Время запуска (datetime.time) по часам сервера
+        self.at = at
+        self.horizon_days = horizon_days
+        self.vacuum_pages = vacuum_pages
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._schedule_loop())
+        logger.info(f"Сжатие истории старше {self.horizon_days} дней запланировано на {self.at.strftime('%H:%M')}")
+
+    async def stop(self):
+        """Прервать обслуживание между пачками: каждая пачка атомарна"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _schedule_loop(self):
+        while True:
+            now = datetime.now()
+            start = datetime.combine(now.date(), self.at)
+            if start <= now:
+                start += timedelta(days=1)
+            await asyncio.sleep((start - now).total_seconds())
+
+            try:
+                await self.run()
+            except Exception as e:
+                logger.error(f"Ошибка обслуживания истории: {e}")
+
+    async def run(self):
+        """Сжать старые записи и вернуть освободившееся место"""
+        before = date.today() - timedelta(days=self.horizon_days)
+        compacted = await database.compact_history(before)
+
+        freed = 0
+        while True:
+            step, remaining = await database.vacuum_step(self.vacuum_pages)
+            freed += step
+            # Без auto_vacuum = INCREMENTAL страницы не освобождаются (см. manage.py vacuum)
+            if not remaining or not step:
+                break
+            # Между шагами пропускаем вперед записи обработчиков
+            await asyncio.sleep(0.1)
+
+        logger.info(f"Сжато записей до {before}: {compacted}, освобождено страниц: {freed}")
+        return compacted
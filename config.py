@@ -4,3 +4,79 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN не найден! Установите переменную окружения BOT_TOKEN")
+
+# Сколько обновлений разных пользователей обрабатывается одновременно
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', 64))
+
+# Режим получения обновлений: webhook или polling (запасной режим)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+
+# Порт HTTP сервера: /health и webhook
+PORT = int(os.getenv('PORT', 10000))
+
+# Публичный адрес сервиса (Render передает его в RENDER_EXTERNAL_URL)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', os.getenv('RENDER_EXTERNAL_URL'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token, без него генерируется при запуске
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
+if BOT_MODE not in ('webhook', 'polling'):
+    raise ValueError(f"Неизвестный режим BOT_MODE={BOT_MODE}, ожидается webhook или polling")
+
+if BOT_MODE == 'webhook' and not WEBHOOK_URL:
+    raise ValueError("Для режима webhook установите переменную окружения WEBHOOK_URL")
+
+# Адрес Bot API, например локального сервера или fake_bot_api.py (по умолчанию api.telegram.org)
+BOT_API_URL = os.getenv('BOT_API_URL')
+
+# Доля трассируемых обновлений (0 - трассировка выключена) и порог медленного обновления, с
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))
+SLOW_UPDATE_THRESHOLD = float(os.getenv('SLOW_UPDATE_THRESHOLD', 1.0))
+
+# Токен для служебных маршрутов /admin/*, без него они отключены
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+# Ограничения частоты исходящих сообщений: всего в секунду, в один чат в секунду
+# и запас сообщений в чат подряд (0 - без ограничения)
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 30))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', 3))
+
+# Ответ на достижение: merge - одно сообщение, edit - подтверждение с последующей
+# правкой, off - два сообщения
+ACHIEVEMENT_REPLY_MODE = os.getenv('ACHIEVEMENT_REPLY_MODE', 'merge')
+
+if ACHIEVEMENT_REPLY_MODE not in ('merge', 'edit', 'off'):
+    raise ValueError(f"Неизвестный ACHIEVEMENT_REPLY_MODE={ACHIEVEMENT_REPLY_MODE}, ожидается merge, edit или off")
+
+# Время ежедневных рассылок по часам сервера (ЧЧ:ММ, пусто - рассылка выключена)
+REMINDER_TIME = os.getenv('REMINDER_TIME', '')
+DIGEST_TIME = os.getenv('DIGEST_TIME', '')
+# Сколько минут после начала рассылка может продолжаться, в том числе после перезапуска.
+# При SEND_GLOBAL_RATE=30 100 000 сообщений отправляются примерно за 56 минут
+BROADCAST_WINDOW_MINUTES = int(os.getenv('BROADCAST_WINDOW_MINUTES', 120))
+
+# Состояния диалогов (подтверждение отказа от челленджа): время жизни в секундах,
+# сколько пользователей хранить в памяти и сохранять ли в базу
+CONVERSATION_TTL = int(os.getenv('CONVERSATION_TTL', 600))
+CONVERSATION_MAX_USERS = int(os.getenv('CONVERSATION_MAX_USERS', 10000))
+CONVERSATION_PERSIST = os.getenv('CONVERSATION_PERSIST', '1') == '1'
+
+# Число процессов-обработчиков: обновления распределяются по user_id, у каждого
+# процесса своя база (achievements.shard<N>.db). 1 - все в одном процессе
+SHARDS = int(os.getenv('SHARDS', 1))
+
+# Файл аренды лидерства (по умолчанию рядом с базой) и через сколько секунд
+# аренда упавшего экземпляра считается свободной
+LEASE_PATH = os.getenv('LEASE_PATH')
+LEASE_TTL = float(os.getenv('LEASE_TTL', 10))
+
+# Время ежедневного сжатия старой истории и VACUUM по часам сервера, например 04:00.
+# По умолчанию выключено: сжатие необратимо заменяет отдельные записи дневными суммами.
+# Горизонт сжатия задает HISTORY_HORIZON_DAYS (database.py)
+COMPACTION_TIME = os.getenv('COMPACTION_TIME', '')
+
+# Графики прогресса: процессов отрисовки и сколько готовых картинок держать в памяти.
+# Без matplotlib кнопка графика отвечает текстом
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', 2))
+CHART_CACHE_SIZE = int(os.getenv('CHART_CACHE_SIZE', 128))
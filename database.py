@@ -1,10 +1,52 @@
-import sqlite3
-from datetime import date, datetime
+import logging
+import os
+import time
+from datetime import date, datetime, timedelta
 
-def init_db():
-    conn = sqlite3.connect('achievements.db')
+from cache import DailyProgressCache, RecentIds
+from goals import GOAL_BITS, GOAL_LIMITS
+import metrics
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv('DB_PATH', 'achievements.db')
+DB_READERS = int(os.getenv('DB_READERS', 4))
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', 100))
+WRITE_BATCH_DELAY = float(os.getenv('WRITE_BATCH_DELAY', 0.01))
+PROGRESS_CACHE_SIZE = int(os.getenv('PROGRESS_CACHE_SIZE', 10000))
+# Сколько последних update_id достижений помнить в памяти
+RECENT_UPDATES_SIZE = int(os.getenv('RECENT_UPDATES_SIZE', 10000))
+# Записи старше стольких дней сжимаются в дневные суммы (0 - не сжимать)
+HISTORY_HORIZON_DAYS = int(os.getenv('HISTORY_HORIZON_DAYS', 90))
+# Пользователей в одной транзакции сжатия и страниц за один шаг incremental_vacuum
+COMPACTION_BATCH_USERS = int(os.getenv('COMPACTION_BATCH_USERS', 200))
+VACUUM_STEP_PAGES = int(os.getenv('VACUUM_STEP_PAGES', 1000))
+# Движок данных горячего пути: sqlite или memory (memory_engine.py)
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite')
+ENGINES = ('sqlite', 'memory')
+
+# Общее хранилище процесса и движок поверх него, создаются в init_db
+_storage = None
+_engine = None
+
+# Маски выполненных сегодня целей активных пользователей
+progress_cache = DailyProgressCache(PROGRESS_CACHE_SIZE)
+metrics.watch_cache('progress', progress_cache)
+# update_id уже записанных достижений: повторы отсекаются до очереди записей
+recent_updates = RecentIds(RECENT_UPDATES_SIZE)
+metrics.watch_cache('recent_updates', recent_updates)
+
+# Результаты add_achievement
+RECORDED = 'recorded'
+# Обновление уже обработано (повторная доставка, повтор после перезапуска)
+DUPLICATE_UPDATE = 'update_id'
+# Цель уже засчитана max_per_day раз за день
+DAILY_LIMIT = 'daily_limit'
+
+def _create_schema(conn):
     cur = conn.cursor()
-    
+
     cur.execute('''
         CREATE TABLE IF NOT EXISTS achievements (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -15,7 +57,7 @@ def init_db():
             date DATE
         )
     ''')
-    
+
     cur.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
@@ -26,49 +68,379 @@ def init_db():
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP
         )
     ''')
-    
-    conn.commit()
-    conn.close()
 
-def add_achievement(user_id, category, achievement_type, points):
-    conn = sqlite3.connect('achievements.db')
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT INTO achievements (user_id, category, achievement_type, points, date)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, category, achievement_type, points, date.today()))
-    conn.commit()
-    conn.close()
+def _add_achievement_indexes(conn):
+    # Покрывающий индекс: все запросы статистики читаются из него без обращения к таблице
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_achievements_user_date
+        ON achievements (user_id, date, achievement_type, category, points)
+    ''')
 
-def get_or_create_user(user_id, username, first_name):
-    conn = sqlite3.connect('achievements.db')
-    cur = conn.cursor()
-    
-    cur.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-    user = cur.fetchone()
-    
-    if not user:
-        cur.execute('''
-            INSERT INTO users (user_id, username, first_name, challenge_start_date, challenge_active)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, username, first_name, date.today(), 1))
+def _goals_mask_sql():
+    # Маска выполненных целей из строк достижений: у каждой цели свой бит,
+    # DISTINCT не дает повторной записи цели сложить бит дважды
+    cases = ' '.join(f"WHEN '{goal_id}' THEN {bit}" for goal_id, bit in GOAL_BITS.items())
+    return f"SUM(DISTINCT CASE achievement_type {cases} ELSE 0 END)"
+
+# Сводные таблицы: колонки и та же выборка, посчитанная по исходным записям
+# (source - таблица или представление с колонками achievements).
+# По ним сводные таблицы пересчитываются и сверяются
+ROLLUPS = {
+    'daily_stats': (
+        "user_id, day, category, points",
+        "SELECT user_id, date, category, SUM(points) FROM {source} GROUP BY user_id, date, category",
+    ),
+    'monthly_stats': (
+        "user_id, month, points",
+        "SELECT user_id, substr(date, 1, 7), SUM(points) FROM {source} GROUP BY user_id, substr(date, 1, 7)",
+    ),
+    'daily_summary': (
+        "user_id, day, goals_mask, points",
+        f"SELECT user_id, date, {_goals_mask_sql()}, SUM(points) FROM {{source}} GROUP BY user_id, date",
+    ),
+}
+
+# Все достижения: свежие записи и сжатый архив (с миграции #7)
+HISTORY_SOURCE = 'all_achievements'
+
+def rebuild_rollups(conn, tables=None, source=HISTORY_SOURCE):
+    """Пересчитать сводные таблицы по исходным записям достижений"""
+    for table in tables or ROLLUPS:
+        columns, raw_sql = ROLLUPS[table]
+        conn.execute(f"DELETE FROM {table}")
+        conn.execute(f"INSERT INTO {table} ({columns}) {raw_sql.format(source=source)}")
+
+def check_rollups(conn):
+    """Число строк, в которых сводная таблица расходится с исходными записями"""
+    mismatches = {}
+    for table, (columns, raw_sql) in ROLLUPS.items():
+        raw_sql = raw_sql.format(source=HISTORY_SOURCE)
+        rollup_sql = f"SELECT {columns} FROM {table}"
+        cur = conn.execute(f"""
+            SELECT COUNT(*) FROM (
+                SELECT * FROM ({rollup_sql} EXCEPT {raw_sql})
+                UNION ALL
+                SELECT * FROM ({raw_sql} EXCEPT {rollup_sql})
+            )
+        """)
+        mismatches[table] = cur.fetchone()[0]
+    return mismatches
+
+def _create_rollups(conn):
+    # Предрассчитанные суммы баллов, обновляются вместе с каждой записью достижения
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            user_id INTEGER,
+            day DATE,
+            category TEXT,
+            points INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day, category)
+        ) WITHOUT ROWID
+    ''')
+
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS monthly_stats (
+            user_id INTEGER,
+            month TEXT,
+            points INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, month)
+        ) WITHOUT ROWID
+    ''')
+
+    # Архива на этой версии схемы еще нет
+    rebuild_rollups(conn, ('daily_stats', 'monthly_stats'), source='achievements')
+
+def _create_daily_summary(conn):
+    # Одна строка на пользователя и день: маска выполненных целей и сумма баллов
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_summary (
+            user_id INTEGER,
+            day DATE,
+            goals_mask INTEGER NOT NULL DEFAULT 0,
+            points INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+    ''')
+
+    rebuild_rollups(conn, ('daily_summary',), source='achievements')
+
+def _create_broadcast_runs(conn):
+    # Прогресс рассылок: после перезапуска рассылка продолжается с last_user_id
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_runs (
+            kind TEXT,
+            day DATE,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            finished BOOLEAN NOT NULL DEFAULT 0,
+            PRIMARY KEY (kind, day)
+        ) WITHOUT ROWID
+    ''')
+
+def _create_conversation_state(conn):
+    # Состояния диалогов (ConversationStore), переживают перезапуск бота
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_state (
+            user_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+def _create_achievement_archive(conn):
+    # Коды категорий и типов достижений для сжатого архива
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS achievement_codes (
+            code INTEGER PRIMARY KEY,
+            kind TEXT NOT NULL,
+            name TEXT NOT NULL,
+            UNIQUE (kind, name)
+        )
+    ''')
+
+    # Старые записи, сжатые до одной строки на пользователя, день и тип достижения
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS achievement_archive (
+            user_id INTEGER,
+            day DATE,
+            type_code INTEGER,
+            category_code INTEGER,
+            points INTEGER NOT NULL,
+            taps INTEGER NOT NULL,
+            PRIMARY KEY (user_id, day, type_code, category_code)
+        ) WITHOUT ROWID
+    ''')
+
+    # Вся история с колонками achievements: по ней пересчитываются сводные таблицы
+    conn.execute(f'''
+        CREATE VIEW IF NOT EXISTS {HISTORY_SOURCE} AS
+        SELECT user_id, date, category, achievement_type, points
+        FROM achievements
+        UNION ALL
+        SELECT a.user_id, a.day, c.name, t.name, a.points
+        FROM achievement_archive a
+        JOIN achievement_codes t ON t.code = a.type_code
+        JOIN achievement_codes c ON c.code = a.category_code
+    ''')
+
+def _create_journal_state(conn):
+    # Последний сегмент журнала memory_engine, перенесенный в SQLite
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS journal_state (
+            name TEXT PRIMARY KEY,
+            segment INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+def _create_chart_files(conn):
+    # file_id картинок, уже загруженных в Telegram, по ключу графика (charts.chart_key)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chart_files (
+            key TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+def _add_achievement_update_id(conn):
+    # Telegram update_id, по которому записано достижение: одно обновление - одна запись.
+    # У импортированных и старых записей update_id нет
+    conn.execute("ALTER TABLE achievements ADD COLUMN update_id INTEGER")
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_achievements_update
+        ON achievements (user_id, update_id) WHERE update_id IS NOT NULL
+    ''')
+
+# Миграции применяются по порядку, номер последней хранится в PRAGMA user_version.
+# Новые миграции добавляются только в конец списка
+MIGRATIONS = [
+    _create_schema,
+    _add_achievement_indexes,
+    _create_rollups,
+    _create_daily_summary,
+    _create_broadcast_runs,
+    _create_conversation_state,
+    _create_achievement_archive,
+    _create_chart_files,
+    _add_achievement_update_id,
+    _create_journal_state,
+]
+
+def _schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def _apply_migrations(conn):
+    version = _schema_version(conn)
+
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        # Миграция и новый номер версии фиксируются одной транзакцией. BEGIN явный:
+        # без него sqlite3 выполняет CREATE/ALTER вне транзакции и фиксирует сразу,
+        # и падение до смены номера оставило бы миграцию примененной наполовину
+        conn.execute("BEGIN")
+        try:
+            migration(conn)
+            # PRAGMA не поддерживает параметры, номер подставляется как целое число
+            conn.execute(f"PRAGMA user_version = {int(number)}")
+        except BaseException:
+            conn.rollback()
+            raise
         conn.commit()
-    
-    conn.close()
+        logger.info(f"Применена миграция #{number}: {migration.__name__}")
 
-def get_challenge_day(user_id):
-    conn = sqlite3.connect('achievements.db')
-    cur = conn.cursor()
-    
-    cur.execute('''
-        SELECT challenge_start_date, challenge_active 
-        FROM users 
+def _make_engine(name, storage):
+    if name == 'sqlite':
+        return SqliteEngine(storage)
+    if name == 'memory':
+        from memory_engine import MemoryEngine
+        return MemoryEngine(storage)
+    raise ValueError(f"Неизвестный DB_ENGINE={name!r}, ожидается {' или '.join(ENGINES)}")
+
+def init_db(path=None, engine=None):
+    """Открыть соединения, создать таблицы и загрузить движок (по умолчанию DB_ENGINE)"""
+    global _storage, _engine
+
+    close_db()
+
+    _storage = Storage(
+        path or DB_PATH,
+        readers=DB_READERS,
+        batch_size=WRITE_BATCH_SIZE,
+        batch_delay=WRITE_BATCH_DELAY,
+    )
+    progress_cache.clear()
+    recent_updates.clear()
+    _storage.write_sync(_apply_migrations)
+    _engine = _make_engine(engine or DB_ENGINE, _storage)
+    _engine.load()
+
+def close_db():
+    """Сохранить данные движка, зафиксировать очередь записей и закрыть соединения с базой"""
+    global _storage, _engine
+
+    if _engine is not None:
+        _engine.close()
+        _engine = None
+    if _storage is not None:
+        _storage.close()
+        _storage = None
+
+def set_query_trace(callback):
+    """Вызывать callback(sql) для каждого запроса к базе (None - отключить)"""
+    _storage.set_trace_callback(callback)
+
+def drain_writes():
+    """Синхронно зафиксировать записи, ожидающие в очереди"""
+    if _storage is not None:
+        return _storage.drain()
+    return 0
+
+def _insert_achievement(conn, user_id, category, achievement_type, points, day, update_id=None, max_per_day=None):
+    # Проверки и запись в одной транзакции единственного писателя: гонки нет.
+    # Повтор обновления проверяется первым - на него не нужен ответ про дневной лимит
+    if update_id is not None and _query(conn, 'recorded_update', (user_id, update_id), one=True):
+        return DUPLICATE_UPDATE
+    if max_per_day is not None:
+        taps = _query(conn, 'goal_taps', (user_id, day.isoformat(), achievement_type), one=True)[0]
+        if taps >= max_per_day:
+            return DAILY_LIMIT
+
+    cur = conn.execute('''
+        INSERT OR IGNORE INTO achievements (user_id, category, achievement_type, points, date, update_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, category, achievement_type, points, day.isoformat(), update_id))
+    if not cur.rowcount:
+        # Уникальный индекс по (user_id, update_id): обновление уже записано
+        return DUPLICATE_UPDATE
+
+    # Сводные таблицы обновляются в той же транзакции
+    conn.execute('''
+        INSERT INTO daily_stats (user_id, day, category, points)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id, day, category) DO UPDATE SET points = points + excluded.points
+    ''', (user_id, day.isoformat(), category, points))
+
+    conn.execute('''
+        INSERT INTO monthly_stats (user_id, month, points)
+        VALUES (?, ?, ?)
+        ON CONFLICT (user_id, month) DO UPDATE SET points = points + excluded.points
+    ''', (user_id, day.strftime('%Y-%m'), points))
+
+    conn.execute('''
+        INSERT INTO daily_summary (user_id, day, goals_mask, points)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id, day) DO UPDATE SET
+            goals_mask = goals_mask | excluded.goals_mask,
+            points = points + excluded.points
+    ''', (user_id, day.isoformat(), GOAL_BITS.get(achievement_type, 0), points))
+    return RECORDED
+
+async def add_achievement(user_id, category, achievement_type, points, update_id=None, day=None):
+    """Записать достижение, если оно не повтор. Возвращает RECORDED, DUPLICATE_UPDATE или DAILY_LIMIT.
+
+    day - день записи, по умолчанию сегодня
+    """
+    today = day or date.today()
+    bit = GOAL_BITS.get(achievement_type, 0)
+    max_per_day = GOAL_LIMITS.get(achievement_type)
+
+    # Большинство повторов (двойные нажатия, повторная доставка) отсекается в памяти
+    if update_id is not None and update_id in recent_updates:
+        metrics.ACHIEVEMENT_DUPLICATES.inc(DUPLICATE_UPDATE, 'memory')
+        return DUPLICATE_UPDATE
+    if max_per_day == 1 and bit and (progress_cache.get(user_id, today) or 0) & bit:
+        metrics.ACHIEVEMENT_DUPLICATES.inc(DAILY_LIMIT, 'memory')
+        return DAILY_LIMIT
+
+    result = await _engine.add_achievement(user_id, category, achievement_type, points, today, update_id, max_per_day)
+    if update_id is not None:
+        recent_updates.add(update_id)
+    if result == RECORDED:
+        progress_cache.add(user_id, today, bit)
+    else:
+        metrics.ACHIEVEMENT_DUPLICATES.inc(result, 'db')
+    return result
+
+def _insert_user_if_missing(conn, user_id, username, first_name, day):
+    conn.execute('''
+        INSERT OR IGNORE INTO users (user_id, username, first_name, challenge_start_date, challenge_active)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (user_id, username, first_name, day.isoformat(), 1))
+
+def _user_exists(conn, user_id):
+    cur = conn.execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,))
+    return cur.fetchone() is not None
+
+def _import_history(conn, users, achievements):
+    for user_id, username, first_name, start_day in users:
+        _insert_user_if_missing(conn, user_id, username, first_name, start_day)
+    for row in achievements:
+        _insert_achievement(conn, *row)
+
+def import_history(users, achievements):
+    """Загрузить пользователей и прошлые достижения одной транзакцией.
+
+    users - (user_id, username, first_name, дата начала челленджа),
+    achievements - (user_id, category, achievement_type, points, дата).
+    """
+    _engine.flush_sync()
+    _storage.write_sync(_import_history, users, achievements)
+    # Движок перечитывает данные, загруженные в обход него
+    _engine.load()
+
+async def get_or_create_user(user_id, username, first_name):
+    await _engine.create_user(user_id, username, first_name, date.today())
+
+def _select_challenge(conn, user_id):
+    cur = conn.execute('''
+        SELECT challenge_start_date, challenge_active
+        FROM users
         WHERE user_id = ?
     ''', (user_id,))
-    
-    result = cur.fetchone()
-    conn.close()
-    
+    return cur.fetchone()
+
+async def get_challenge_day(user_id):
+    result = await _engine.challenge(user_id)
+
     if result and result[1]:
         start_date = datetime.strptime(result[0], '%Y-%m-%d').date()
         today = date.today()
@@ -77,15 +449,601 @@ def get_challenge_day(user_id):
     else:
         return None
 
-def deactivate_challenge(user_id):
-    conn = sqlite3.connect('achievements.db')
-    cur = conn.cursor()
-    
-    cur.execute('''
-        UPDATE users 
-        SET challenge_active = 0 
+def _update_challenge_inactive(conn, user_id):
+    conn.execute('''
+        UPDATE users
+        SET challenge_active = 0
         WHERE user_id = ?
     ''', (user_id,))
-    
-    conn.commit()
-    conn.close()
+
+async def deactivate_challenge(user_id):
+    await _engine.deactivate(user_id)
+
+# Запросы горячего пути. Каждый должен обслуживаться индексом,
+# это проверяет check_query_plans
+QUERIES = {
+    'completed_mask': """
+        SELECT goals_mask
+        FROM daily_summary
+        WHERE user_id = ? AND day = ?
+    """,
+    'day_masks': """
+        SELECT day, goals_mask
+        FROM daily_summary
+        WHERE user_id = ?
+        ORDER BY day
+    """,
+    'month_masks': """
+        SELECT day, goals_mask
+        FROM daily_summary
+        WHERE user_id = ? AND day >= ? AND day < ?
+        ORDER BY day
+    """,
+    'recorded_update': """
+        SELECT 1 FROM achievements
+        WHERE user_id = ? AND update_id = ?
+    """,
+    # Сколько раз цель засчитана за день (проверка max_per_day при записи)
+    'goal_taps': """
+        SELECT COUNT(*)
+        FROM achievements
+        WHERE user_id = ? AND date = ? AND achievement_type = ?
+    """,
+    'day_stats': """
+        SELECT category, points
+        FROM daily_stats
+        WHERE user_id = ? AND day = ?
+    """,
+    'month_history': """
+        SELECT day, SUM(points) as daily_points
+        FROM daily_stats
+        WHERE user_id = ? AND day >= ? AND day < ?
+        GROUP BY day
+        ORDER BY day DESC
+    """,
+    'month_total': """
+        SELECT points FROM monthly_stats
+        WHERE user_id = ? AND month = ?
+    """,
+    # Получатели рассылки одной страницей: активные пользователи после user_id
+    # с маской и баллами за день. Пользователи с маской skip_mask пропускаются
+    'broadcast_targets': """
+        SELECT u.user_id, COALESCE(s.goals_mask, 0), COALESCE(s.points, 0)
+        FROM users u
+        LEFT JOIN daily_summary s ON s.user_id = u.user_id AND s.day = ?
+        WHERE u.user_id > ? AND u.challenge_active = 1
+          AND COALESCE(s.goals_mask, 0) != ?
+        ORDER BY u.user_id
+        LIMIT ?
+    """,
+    'chart_file': """
+        SELECT file_id FROM chart_files
+        WHERE key = ?
+    """,
+    'export_user': f"""
+        SELECT user_id, date, category, achievement_type, points
+        FROM {HISTORY_SOURCE}
+        WHERE user_id = ?
+        ORDER BY date
+    """,
+}
+
+# Выгрузка всех пользователей читает таблицу целиком по индексу,
+# поэтому не входит в QUERIES, проверяемые на отсутствие SCAN
+EXPORT_ALL_SQL = f"""
+    SELECT user_id, date, category, achievement_type, points
+    FROM {HISTORY_SOURCE}
+    ORDER BY user_id, date
+"""
+
+# Сколько строк выгрузки читается из курсора за раз
+EXPORT_FETCH_SIZE = 1000
+
+def month_bounds(day):
+    """Первый день месяца и первый день следующего месяца в формате ISO"""
+    start = day.replace(day=1)
+    end = (start + timedelta(days=32)).replace(day=1)
+    return start.isoformat(), end.isoformat()
+
+def _query(conn, name, params, one=False):
+    """Выполнить запрос из QUERIES и записать его время в метрики"""
+    started = time.perf_counter()
+    cur = conn.execute(QUERIES[name], params)
+    result = cur.fetchone() if one else cur.fetchall()
+    metrics.DB_QUERY_SECONDS.observe(time.perf_counter() - started, name)
+    return result
+
+def _select_recorded_update(conn, user_id, update_id):
+    return _query(conn, 'recorded_update', (user_id, update_id), one=True) is not None
+
+def _select_completed_mask(conn, user_id, day):
+    result = _query(conn, 'completed_mask', (user_id, day.isoformat()), one=True)
+    return result[0] if result else 0
+
+async def get_completed_mask(user_id, day):
+    """Битовая маска целей, выполненных пользователем за день"""
+    mask = progress_cache.get(user_id, day)
+    if mask is not None:
+        return mask
+
+    generation = progress_cache.generation(user_id)
+    mask = await _engine.completed_mask(user_id, day)
+    progress_cache.put(user_id, day, mask, generation)
+    return mask
+
+def _select_day_masks(conn, user_id):
+    return _query(conn, 'day_masks', (user_id,))
+
+async def get_day_masks(user_id):
+    """Пары (день, маска выполненных целей) за всю историю, по возрастанию дня"""
+    return await _engine.day_masks(user_id)
+
+def _select_month_masks(conn, user_id, day):
+    return _query(conn, 'month_masks', (user_id, *month_bounds(day)))
+
+async def get_month_masks(user_id, day):
+    """Пары (день, маска выполненных целей) за месяц, по возрастанию дня"""
+    return await _engine.month_masks(user_id, day)
+
+def _select_day_stats(conn, user_id, day):
+    category_stats = _query(conn, 'day_stats', (user_id, day.isoformat()))
+    total = sum(points for _, points in category_stats)
+    return total, category_stats
+
+async def get_day_stats(user_id, day):
+    """Сумма баллов за день и разбивка по категориям"""
+    return await _engine.day_stats(user_id, day)
+
+def _select_month_history(conn, user_id, day):
+    return _query(conn, 'month_history', (user_id, *month_bounds(day)))
+
+async def get_month_history(user_id, day):
+    """Баллы по дням месяца, от новых к старым"""
+    return await _engine.month_history(user_id, day)
+
+def _select_month_total(conn, user_id, day):
+    result = _query(conn, 'month_total', (user_id, day.strftime('%Y-%m')), one=True)
+    return result[0] if result else 0
+
+async def get_month_total(user_id, day):
+    """Сумма баллов за месяц"""
+    return await _engine.month_total(user_id, day)
+
+def _select_totals(conn):
+    users, active_users = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(challenge_active), 0) FROM users"
+    ).fetchone()
+    achievements = conn.execute("SELECT COUNT(*) FROM achievements").fetchone()[0]
+    points = conn.execute("SELECT COALESCE(SUM(points), 0) FROM monthly_stats").fetchone()[0]
+    return {'users': users, 'active_users': active_users, 'achievements': achievements, 'points': points}
+
+async def get_totals():
+    """Общие итоги по базе для администратора (читает таблицы целиком)"""
+    await _engine.flush()
+    return await _storage.read(_select_totals)
+
+async def flushed_path():
+    """Путь к файлу базы, доведенному до состояния движка (для чтения другим процессом)"""
+    await _engine.flush()
+    return _storage.path
+
+def flushed_path_sync():
+    """То же, что flushed_path, блокирующе"""
+    _engine.flush_sync()
+    return _storage.path
+
+def _select_broadcast_targets(conn, day, after_user_id, skip_mask, limit):
+    return _query(conn, 'broadcast_targets', (day.isoformat(), after_user_id, skip_mask, limit))
+
+async def get_broadcast_targets(day, after_user_id, limit, skip_mask=-1):
+    """Страница получателей рассылки: (user_id, маска целей за день, баллы за день)"""
+    return await _engine.broadcast_targets(day, after_user_id, skip_mask, limit)
+
+class Engine:
+    """Движок данных горячего пути: пользователи, челленджи, достижения и сводки
+    по дням. Остальные данные (рассылки, диалоги, графики, выгрузка, сжатие)
+    читаются и пишутся прямо через storage, перед их чтением вызывается flush.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def load(self):
+        """Подготовить движок к работе (после миграций и import_history)"""
+
+    def close(self):
+        """Перенести все данные в SQLite перед закрытием соединений"""
+        self.flush_sync()
+
+    async def flush(self):
+        """Довести таблицы SQLite до текущего состояния движка"""
+
+    def flush_sync(self):
+        """То же, что flush, блокирующе"""
+
+    async def create_user(self, user_id, username, first_name, day):
+        raise NotImplementedError
+
+    async def challenge(self, user_id):
+        """(дата начала челленджа ISO, активен) или None"""
+        raise NotImplementedError
+
+    async def deactivate(self, user_id):
+        raise NotImplementedError
+
+    async def add_achievement(self, user_id, category, achievement_type, points, day, update_id, max_per_day):
+        """Записать достижение, вернуть RECORDED, DUPLICATE_UPDATE или DAILY_LIMIT"""
+        raise NotImplementedError
+
+    async def completed_mask(self, user_id, day):
+        raise NotImplementedError
+
+    async def day_masks(self, user_id):
+        raise NotImplementedError
+
+    async def month_masks(self, user_id, day):
+        raise NotImplementedError
+
+    async def day_stats(self, user_id, day):
+        raise NotImplementedError
+
+    async def month_history(self, user_id, day):
+        raise NotImplementedError
+
+    async def month_total(self, user_id, day):
+        raise NotImplementedError
+
+    async def broadcast_targets(self, day, after_user_id, skip_mask, limit):
+        raise NotImplementedError
+
+
+class SqliteEngine(Engine):
+    """Все данные в SQLite: чтения в пуле читателей, записи через очередь групповых транзакций"""
+
+    async def create_user(self, user_id, username, first_name, day):
+        # Проверка на читателе избавляет от записи для уже известных пользователей
+        if await self.storage.read(_user_exists, user_id):
+            return
+        await self.storage.write(_insert_user_if_missing, user_id, username, first_name, day)
+
+    async def challenge(self, user_id):
+        return await self.storage.read(_select_challenge, user_id)
+
+    async def deactivate(self, user_id):
+        await self.storage.write(_update_challenge_inactive, user_id)
+
+    async def add_achievement(self, user_id, category, achievement_type, points, day, update_id, max_per_day):
+        return await self.storage.write(
+            _insert_achievement, user_id, category, achievement_type, points, day, update_id, max_per_day
+        )
+
+    async def recorded_update(self, user_id, update_id):
+        """Записано ли уже достижение с этим update_id"""
+        return await self.storage.read(_select_recorded_update, user_id, update_id)
+
+    async def completed_mask(self, user_id, day):
+        return await self.storage.read(_select_completed_mask, user_id, day)
+
+    async def day_masks(self, user_id):
+        return await self.storage.read(_select_day_masks, user_id)
+
+    async def month_masks(self, user_id, day):
+        return await self.storage.read(_select_month_masks, user_id, day)
+
+    async def day_stats(self, user_id, day):
+        return await self.storage.read(_select_day_stats, user_id, day)
+
+    async def month_history(self, user_id, day):
+        return await self.storage.read(_select_month_history, user_id, day)
+
+    async def month_total(self, user_id, day):
+        return await self.storage.read(_select_month_total, user_id, day)
+
+    async def broadcast_targets(self, day, after_user_id, skip_mask, limit):
+        return await self.storage.read(_select_broadcast_targets, day, after_user_id, skip_mask, limit)
+
+def _select_broadcast_run(conn, kind, day):
+    cur = conn.execute('''
+        SELECT last_user_id, sent, failed, finished
+        FROM broadcast_runs
+        WHERE kind = ? AND day = ?
+    ''', (kind, day.isoformat()))
+    return cur.fetchone()
+
+async def get_broadcast_run(kind, day):
+    """Сохраненный прогресс рассылки за день или None"""
+    return await _storage.read(_select_broadcast_run, kind, day)
+
+def _upsert_broadcast_run(conn, kind, day, last_user_id, sent, failed, finished):
+    conn.execute('''
+        INSERT INTO broadcast_runs (kind, day, last_user_id, sent, failed, finished)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (kind, day) DO UPDATE SET
+            last_user_id = excluded.last_user_id,
+            sent = excluded.sent,
+            failed = excluded.failed,
+            finished = excluded.finished
+    ''', (kind, day.isoformat(), last_user_id, sent, failed, int(finished)))
+
+async def save_broadcast_run(kind, day, last_user_id, sent, failed, finished=False):
+    """Сохранить прогресс рассылки после очередной страницы"""
+    await _storage.write(_upsert_broadcast_run, kind, day, last_user_id, sent, failed, finished)
+
+def _purge_and_select_conversation_states(conn, now):
+    conn.execute("DELETE FROM conversation_state WHERE expires_at <= ?", (now,))
+    cur = conn.execute('''
+        SELECT user_id, state, expires_at
+        FROM conversation_state
+        ORDER BY expires_at
+    ''')
+    return cur.fetchall()
+
+def load_conversation_states(now):
+    """Удалить истекшие состояния диалогов и вернуть остальные (при запуске)"""
+    return _storage.write_sync(_purge_and_select_conversation_states, now)
+
+def _upsert_conversation_state(conn, user_id, state, expires_at):
+    conn.execute('''
+        INSERT INTO conversation_state (user_id, state, expires_at)
+        VALUES (?, ?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET state = excluded.state, expires_at = excluded.expires_at
+    ''', (user_id, state, expires_at))
+
+async def save_conversation_state(user_id, state, expires_at):
+    await _storage.write(_upsert_conversation_state, user_id, state, expires_at)
+
+def _delete_conversation_state(conn, user_id):
+    conn.execute("DELETE FROM conversation_state WHERE user_id = ?", (user_id,))
+
+async def delete_conversation_state(user_id):
+    await _storage.write(_delete_conversation_state, user_id)
+
+def _select_chart_file(conn, key):
+    result = _query(conn, 'chart_file', (key,), one=True)
+    return result[0] if result else None
+
+async def get_chart_file(key):
+    """file_id загруженной картинки графика или None"""
+    return await _storage.read(_select_chart_file, key)
+
+def _upsert_chart_file(conn, key, file_id):
+    conn.execute('''
+        INSERT INTO chart_files (key, file_id) VALUES (?, ?)
+        ON CONFLICT (key) DO UPDATE SET file_id = excluded.file_id
+    ''', (key, file_id))
+
+async def save_chart_file(key, file_id):
+    await _storage.write(_upsert_chart_file, key, file_id)
+
+def _delete_chart_file(conn, key):
+    conn.execute("DELETE FROM chart_files WHERE key = ?", (key,))
+
+async def forget_chart_file(key):
+    """Забыть file_id, который Telegram больше не принимает"""
+    await _storage.write(_delete_chart_file, key)
+
+def iter_cursor(cur, size=EXPORT_FETCH_SIZE):
+    """Строки курсора порциями по size, без загрузки результата целиком"""
+    while True:
+        rows = cur.fetchmany(size)
+        if not rows:
+            return
+        yield from rows
+
+def _export_achievements(conn, write, user_id):
+    if user_id is None:
+        cur = conn.execute(EXPORT_ALL_SQL)
+    else:
+        cur = conn.execute(QUERIES['export_user'], (user_id,))
+    try:
+        return write(iter_cursor(cur))
+    finally:
+        cur.close()
+
+async def export_achievements(write, user_id=None):
+    """Передать write(rows) генератор строк (user_id, date, category, achievement_type, points)
+    одного пользователя или всех (user_id=None) и вернуть ее результат.
+
+    write выполняется в потоке читателя, строки читаются из курсора по мере записи.
+    """
+    await _engine.flush()
+    return await _storage.read(_export_achievements, write, user_id)
+
+# Записи журнала memory_engine: новый пользователь, достижение, отказ от челленджа.
+# Дни в записях - date.toordinal()
+JOURNAL_USER = 'u'
+JOURNAL_ACHIEVEMENT = 'a'
+JOURNAL_DEACTIVATE = 'd'
+
+def _apply_journal(conn, name, segment, entries):
+    for entry in entries:
+        kind = entry[0]
+        if kind == JOURNAL_ACHIEVEMENT:
+            _, user_id, category, achievement_type, points, day, update_id = entry
+            # Дневной лимит уже проверен движком при записи в журнал
+            _insert_achievement(conn, user_id, category, achievement_type, points, date.fromordinal(day), update_id)
+        elif kind == JOURNAL_USER:
+            _, user_id, username, first_name, day = entry
+            _insert_user_if_missing(conn, user_id, username, first_name, date.fromordinal(day))
+        elif kind == JOURNAL_DEACTIVATE:
+            _update_challenge_inactive(conn, entry[1])
+        else:
+            raise ValueError(f"Неизвестная запись журнала {entry!r}")
+
+    # Номер сегмента только растет: снимки могут зафиксироваться не по порядку вызова
+    conn.execute('''
+        INSERT INTO journal_state (name, segment) VALUES (?, ?)
+        ON CONFLICT (name) DO UPDATE SET segment = MAX(segment, excluded.segment)
+    ''', (name, segment))
+
+async def save_journal(name, segment, entries):
+    """Перенести записи журнала в таблицы и отметить сегмент одной транзакцией"""
+    await _storage.write(_apply_journal, name, segment, entries)
+
+def save_journal_sync(name, segment, entries):
+    _storage.write_sync(_apply_journal, name, segment, entries)
+
+def _select_journal_segment(conn, name):
+    row = conn.execute("SELECT segment FROM journal_state WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
+def journal_segment(name):
+    """Последний сегмент журнала, перенесенный в SQLite (0 - ни одного)"""
+    return _storage.read_sync(_select_journal_segment, name)
+
+def _read_hot_window(conn, since, today, load):
+    since, today = since.isoformat(), today.isoformat()
+    load('users', iter_cursor(conn.execute(
+        "SELECT user_id, challenge_start_date, challenge_active FROM users"
+    )))
+    # Полный проход по первичному ключу: строки идут по пользователям и дням
+    load('summary', iter_cursor(conn.execute('''
+        SELECT user_id, day, goals_mask FROM daily_summary
+        WHERE day >= ?
+        ORDER BY user_id, day
+    ''', (since,))))
+    load('stats', iter_cursor(conn.execute('''
+        SELECT user_id, day, category, points FROM daily_stats
+        WHERE day >= ?
+        ORDER BY user_id, day, category
+    ''', (since,))))
+    # Сегодняшние достижения только тех, у кого они есть: поиск по индексу на пользователя
+    load('taps', iter_cursor(conn.execute('''
+        SELECT a.user_id, a.achievement_type
+        FROM daily_summary s
+        JOIN achievements a ON a.user_id = s.user_id AND a.date = s.day
+        WHERE s.day = ?
+    ''', (today,))))
+    # Наибольший update_id каждого пользователя из уникального индекса
+    load('updates', iter_cursor(conn.execute('''
+        SELECT user_id, MAX(update_id) FROM achievements
+        WHERE update_id IS NOT NULL
+        GROUP BY user_id
+    ''')))
+
+def read_hot_window(since, today, load):
+    """Передать load(name, rows) пользователей ('users'), маски и баллы по дням
+    начиная с since ('summary', 'stats'), сегодняшние достижения ('taps')
+    и наибольшие update_id пользователей ('updates')"""
+    _storage.read_sync(_read_hot_window, since, today, load)
+
+def _compact_batch(conn, after_user_id, before_day, limit):
+    users = conn.execute('''
+        SELECT DISTINCT user_id FROM achievements
+        WHERE user_id > ?
+        ORDER BY user_id
+        LIMIT ?
+    ''', (after_user_id, limit)).fetchall()
+    if not users:
+        return None, 0
+
+    # Сжимаются только полные записи: NULL не восстановить из кода
+    params = (after_user_id, users[-1][0], before_day.isoformat())
+    condition = '''
+        user_id > ? AND user_id <= ? AND date < ?
+        AND category IS NOT NULL AND achievement_type IS NOT NULL AND points IS NOT NULL
+    '''
+    for kind, column in (('category', 'category'), ('type', 'achievement_type')):
+        conn.execute(f'''
+            INSERT OR IGNORE INTO achievement_codes (kind, name)
+            SELECT DISTINCT '{kind}', {column} FROM achievements WHERE {condition}
+        ''', params)
+
+    conn.execute(f'''
+        INSERT INTO achievement_archive (user_id, day, type_code, category_code, points, taps)
+        SELECT a.user_id, a.date, t.code, c.code, SUM(a.points), COUNT(*)
+        FROM (SELECT * FROM achievements WHERE {condition}) a
+        JOIN achievement_codes t ON t.kind = 'type' AND t.name = a.achievement_type
+        JOIN achievement_codes c ON c.kind = 'category' AND c.name = a.category
+        GROUP BY a.user_id, a.date, t.code, c.code
+        ON CONFLICT (user_id, day, type_code, category_code) DO UPDATE SET
+            points = points + excluded.points,
+            taps = taps + excluded.taps
+    ''', params)
+
+    cur = conn.execute(f"DELETE FROM achievements WHERE {condition}", params)
+    return users[-1][0], cur.rowcount
+
+async def compact_history(before_day, batch_users=COMPACTION_BATCH_USERS):
+    """Сжать записи достижений раньше before_day в архив дневных сумм.
+
+    Каждая пачка пользователей - отдельная запись в общей очереди, поэтому
+    записи обработчиков не ждут всего сжатия. Сводные таблицы не меняются.
+    Возвращает число сжатых записей.
+    """
+    after_user_id, total = 0, 0
+    while True:
+        after_user_id, count = await _storage.write(_compact_batch, after_user_id, before_day, batch_users)
+        if after_user_id is None:
+            return total
+        total += count
+
+def compact_history_sync(before_day, batch_users=COMPACTION_BATCH_USERS):
+    """То же, что compact_history, блокирующе (для manage.py)"""
+    after_user_id, total = 0, 0
+    while True:
+        after_user_id, count = _storage.write_sync(_compact_batch, after_user_id, before_day, batch_users)
+        if after_user_id is None:
+            return total
+        total += count
+
+def _incremental_vacuum(conn, pages):
+    before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    # Без fetchall PRAGMA освобождает только одну страницу
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    remaining = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return before - remaining, remaining
+
+async def vacuum_step(pages=VACUUM_STEP_PAGES):
+    """Вернуть системе до pages свободных страниц: (освобождено, осталось)"""
+    return await _storage.write(_incremental_vacuum, pages)
+
+def incremental_vacuum_sync(pages):
+    """То же, что vacuum_step, блокирующе (для manage.py)"""
+    return _storage.write_sync(_incremental_vacuum, pages)
+
+def _full_vacuum(conn):
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+def full_vacuum():
+    """Перестроить файл базы целиком (блокирует запись, только вне работы бота)"""
+    _storage.write_sync(_full_vacuum)
+
+def file_stats():
+    """Размер файла базы: страниц всего, свободных и размер страницы"""
+    def read(conn):
+        return {
+            name: conn.execute(f"PRAGMA {name}").fetchone()[0]
+            for name in ('page_count', 'freelist_count', 'page_size', 'auto_vacuum')
+        }
+    return _storage.read_sync(read)
+
+def _explain(conn, sql):
+    # Параметры не влияют на выбор плана, подставляем NULL
+    params = (None,) * sql.count('?')
+    cur = conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+    return [row[3] for row in cur.fetchall()]
+
+def check_query_plans(conn):
+    """Вернуть список (запрос, шаг плана) для запросов, читающих таблицу целиком"""
+    problems = []
+    for name, sql in QUERIES.items():
+        for detail in _explain(conn, sql):
+            # SEARCH - поиск по индексу, SCAN - полный проход таблицы или индекса
+            if detail.startswith('SCAN'):
+                problems.append((name, detail))
+    return problems
+
+def query_plan_problems():
+    """Проверить планы горячих запросов на открытой базе"""
+    return _storage.read_sync(check_query_plans)
+
+def rebuild_and_check_rollups():
+    """Пересчитать сводные таблицы на открытой базе и проверить результат"""
+    _storage.write_sync(rebuild_rollups)
+    return _storage.read_sync(check_rollups)
+
+def rollup_mismatches():
+    """Проверить сводные таблицы на открытой базе"""
+    return _storage.read_sync(check_rollups)
@@ -0,0 +1,110 @@
+"""Выгрузка истории достижений в CSV или JSON Lines со сжатием gzip.
+
+Строки читаются из курсора порциями, форматируются генератором и сразу
+сжимаются во временный файл, поэтому память не зависит от размера истории.
+Команда /export и выгрузка всех пользователей для администратора
+используют один и тот же путь.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+
+import database
+
+COLUMNS = ('user_id', 'date', 'category', 'achievement_type', 'points')
+
+
+class _Echo:
+    """Файл для csv.writer, который возвращает строку вместо записи"""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows, header=True):
+    writer = csv.writer(_Echo())
+    if header:
+        yield writer.writerow(COLUMNS)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def jsonl_lines(rows, header=True):
+    # Строки JSON Lines самоописательны, заголовка нет
+    for row in rows:
+        yield json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + '\n'
+
+
+FORMATS = {
+    'csv': csv_lines,
+    'jsonl': jsonl_lines,
+}
+
+
+def _counted(rows, counter):
+    for row in rows:
+        counter[0] += 1
+        yield row
+
+
+def write_gzip(lines, fileobj):
+    """Сжать строки в fileobj по мере их поступления"""
+    with gzip.GzipFile(fileobj=fileobj, mode='wb') as compressed:
+        with io.TextIOWrapper(compressed, encoding='utf-8', newline='') as text:
+            text.writelines(lines)
+
+
+async def export_to_file(fmt, user_id=None, header=True):
+    """Выгрузить историю пользователя (или всех при user_id=None) во временный файл.
+
+    Возвращает (путь к файлу .gz, число строк). Файл удаляет вызывающий.
+    header=False - без строки заголовка CSV (части выгрузки шардов, кроме первой)
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки {fmt!r}")
+
+    def write(rows):
+        counter = [0]
+        fd, path = tempfile.mkstemp(prefix='export-', suffix=f'.{fmt}.gz')
+        try:
+            with os.fdopen(fd, 'wb') as raw:
+                write_gzip(FORMATS[fmt](_counted(rows, counter), header), raw)
+        except BaseException:
+            os.remove(path)
+            raise
+        return path, counter[0]
+
+    return await database.export_achievements(write, user_id)
+
+
+def join_parts(parts, fmt):
+    """Склеить выгрузки шардов [(путь, строк)] в один файл и удалить их.
+
+    Несколько потоков gzip подряд - тоже файл gzip, части не распаковываются.
+    Шарды работают на той же машине, их временные файлы доступны
+    """
+    fd, path = tempfile.mkstemp(prefix='export-', suffix=f'.{fmt}.gz')
+    try:
+        with os.fdopen(fd, 'wb') as joined:
+            for part, _ in parts:
+                with open(part, 'rb') as source:
+                    shutil.copyfileobj(source, joined)
+    except BaseException:
+        os.remove(path)
+        raise
+    finally:
+        for part, _ in parts:
+            try:
+                os.remove(part)
+            except FileNotFoundError:
+                pass
+    return path, sum(rows for _, rows in parts)
+
+
+def export_filename(fmt, user_id=None):
+    name = 'achievements' if user_id is None else f'achievements_{user_id}'
+    return f'{name}.{fmt}.gz'
@@ -0,0 +1,292 @@
+"""Локальная замена Telegram Bot API.
+
+Позволяет запустить бота без доступа к Telegram в обоих режимах:
+в polling обновления отдаются через getUpdates, в webhook - отправляются
+POST запросом на адрес из setWebhook с секретным заголовком. Все исходящие
+вызовы бота записываются в FakeBotApi.calls.
+
+Запуск вручную:
+    python fake_bot_api.py --port 8081
+    BOT_API_URL=http://127.0.0.1:8081 BOT_TOKEN=1:fake python bot.py
+    curl -d '{"user_id": 1, "text": "/start"}' http://127.0.0.1:8081/_push
+    curl http://127.0.0.1:8081/_sent?chat_id=1
+"""
+import argparse
+import asyncio
+import collections
+import email.parser
+import json
+import logging
+import time
+from urllib.parse import parse_qsl
+
+import httpx
+
+from http_server import HttpServer, Response
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {
+    'id': 1000000,
+    'is_bot': True,
+    'first_name': 'FakeBot',
+    'username': 'fake_bot',
+    'can_join_groups': False,
+    'can_read_all_group_messages': False,
+    'supports_inline_queries': False,
+}
+
+
+def _decode_value(value):
+    # Bot API клиенты передают сложные значения как JSON, строки - как есть
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def parse_params(request):
+    """Параметры вызова из form-urlencoded, multipart или JSON тела"""
+    content_type = request.headers.get('content-type', '')
+    params = dict(request.query)
+
+    if content_type.startswith('application/json'):
+        params.update(json.loads(request.body or b'{}'))
+    elif content_type.startswith('multipart/form-data'):
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode('latin-1') + request.body
+        )
+        for part in message.get_payload():
+            name = part.get_param('name', header='content-disposition')
+            payload = part.get_payload(decode=True)
+            if part.get_filename():
+                params[name] = {'filename': part.get_filename(), 'size': len(payload)}
+            else:
+                params[name] = _decode_value(payload.decode('utf-8'))
+    else:
+        for name, value in parse_qsl(request.body.decode('utf-8'), keep_blank_values=True):
+            params[name] = _decode_value(value)
+
+    return params
+
+
+# Вызовы, на которые распространяется ограничение частоты
+FLOOD_METHODS = {'sendMessage', 'editMessageText', 'sendDocument', 'sendPhoto'}
+
+
+class FakeBotApi:
+    """HTTP сервер, отвечающий как Bot API для одного бота"""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, flood_limit=0):
+        self.latency = latency
+        # Как Telegram: больше flood_limit сообщений в секунду - ответ 429 с retry_after
+        self.flood_limit = flood_limit
+        self._recent_sends = collections.deque()
+        self.rejected_calls = 0
+        self.server = HttpServer(host, port)
+        self.server.fallback = self._handle
+        self.server.route('POST', '/_push', self._handle_push)
+        self.server.route('GET', '/_sent', self._handle_sent)
+
+        self.calls = []
+        self.webhook_url = None
+        self.webhook_secret = None
+        self.webhook_responses = []
+
+        self._updates = []
+        self._next_update_id = 1
+        self._next_message_id = 1
+        self._new_updates = asyncio.Condition()
+        self._client = None
+
+        self._methods = {
+            'getMe': self._get_me,
+            'getUpdates': self._get_updates,
+            'setWebhook': self._set_webhook,
+            'deleteWebhook': self._delete_webhook,
+            'getWebhookInfo': self._get_webhook_info,
+            'sendMessage': self._send_message,
+            'editMessageText': self._send_message,
+            'sendDocument': self._send_message,
+            'sendPhoto': self._send_message,
+        }
+
+    @property
+    def url(self):
+        return f"http://{self.server.host}:{self.server.port}"
+
+    async def start(self):
+        self._client = httpx.AsyncClient()
+        await self.server.start()
+
+    async def stop(self):
+        await self.server.stop()
+        if self._client is not None:
+            await self._client.aclose()
+
+    def make_message_update(self, user_id, text):
+        """Словарь Update с текстовым сообщением от пользователя"""
+        user = {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+        message = {
+            'message_id': self._take_message_id(),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': user['first_name']},
+            'from': user,
+            'text': text,
+        }
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return {'message': message}
+
+    async def push_update(self, update):
+        """Передать обновление боту: через webhook, если он задан, иначе в getUpdates"""
+        update = dict(update, update_id=self._next_update_id)
+        self._next_update_id += 1
+
+        if self.webhook_url:
+            headers = {}
+            if self.webhook_secret:
+                headers['X-Telegram-Bot-Api-Secret-Token'] = self.webhook_secret
+            response = await self._client.post(self.webhook_url, json=update, headers=headers)
+            self.webhook_responses.append(response.status_code)
+        else:
+            async with self._new_updates:
+                self._updates.append(update)
+                self._new_updates.notify_all()
+        return update['update_id']
+
+    async def push_message(self, user_id, text):
+        return await self.push_update(self.make_message_update(user_id, text))
+
+    def sent_messages(self, chat_id=None):
+        """Исходящие сообщения бота, при необходимости только для одного чата"""
+        return [
+            params for method, params, _ in self.calls
+            if method.startswith('send') and (chat_id is None or params.get('chat_id') == chat_id)
+        ]
+
+    def _take_message_id(self):
+        message_id = self._next_message_id
+        self._next_message_id += 1
+        return message_id
+
+    async def _handle_push(self, request):
+        data = json.loads(request.body)
+        update_id = await self.push_message(int(data['user_id']), data['text'])
+        return Response(200, json.dumps({'update_id': update_id}), content_type='application/json')
+
+    async def _handle_sent(self, request):
+        chat_id = int(request.query['chat_id']) if 'chat_id' in request.query else None
+        return Response(200, json.dumps(self.sent_messages(chat_id), ensure_ascii=False), content_type='application/json')
+
+    async def _handle(self, request):
+        # Путь вида /bot<token>/<method>
+        parts = request.path.strip('/').split('/')
+        if len(parts) != 2 or not parts[0].startswith('bot'):
+            return Response(404, '404 Not Found')
+
+        method = parts[1]
+        params = parse_params(request)
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self.flood_limit and method in FLOOD_METHODS and self._is_flooded():
+            self.rejected_calls += 1
+            return Response(429, json.dumps({
+                'ok': False,
+                'error_code': 429,
+                'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1},
+            }), content_type='application/json')
+
+        self.calls.append((method, params, time.monotonic()))
+
+        handler = self._methods.get(method)
+        result = await handler(params) if handler else True
+        return Response(200, json.dumps({'ok': True, 'result': result}), content_type='application/json')
+
+    def _is_flooded(self):
+        now = time.monotonic()
+        while self._recent_sends and now - self._recent_sends[0] > 1.0:
+            self._recent_sends.popleft()
+        if len(self._recent_sends) >= self.flood_limit:
+            return True
+        self._recent_sends.append(now)
+        return False
+
+    async def _get_me(self, params):
+        return BOT_USER
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        timeout = float(params.get('timeout') or 0)
+
+        async with self._new_updates:
+            # Подтвержденные обновления (id < offset) больше не отдаются
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            if not self._updates and timeout:
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return list(self._updates[:int(params.get('limit') or 100)])
+
+    async def _set_webhook(self, params):
+        self.webhook_url = params.get('url')
+        self.webhook_secret = params.get('secret_token')
+        if params.get('drop_pending_updates'):
+            self._updates.clear()
+        return True
+
+    async def _delete_webhook(self, params):
+        self.webhook_url = None
+        self.webhook_secret = None
+        if params.get('drop_pending_updates'):
+            self._updates.clear()
+        return True
+
+    async def _get_webhook_info(self, params):
+        return {'url': self.webhook_url or '', 'has_custom_certificate': False, 'pending_update_count': len(self._updates)}
+
+    async def _send_message(self, params):
+        chat_id = params.get('chat_id')
+        message = {
+            'message_id': params.get('message_id') or self._take_message_id(),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+        }
+        if 'text' in params:
+            message['text'] = str(params['text'])
+        if 'document' in params:
+            message['document'] = {'file_id': f"doc{message['message_id']}", 'file_unique_id': f"udoc{message['message_id']}"}
+        if 'photo' in params:
+            message['photo'] = [{
+                'file_id': f"photo{message['message_id']}",
+                'file_unique_id': f"uphoto{message['message_id']}",
+                'width': 1, 'height': 1,
+            }]
+        return message
+
+
+async def _serve(port):
+    api = FakeBotApi(port=port)
+    await api.start()
+    logger.info(f"Fake Bot API: {api.url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.stop()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Локальная замена Telegram Bot API")
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args()
+    try:
+        asyncio.run(_serve(args.port))
+    except KeyboardInterrupt:
+        pass
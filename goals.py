@@ -0,0 +1,63 @@
+# Реестр целей и кнопок бота. Новая цель или кнопка добавляется
+# только записью здесь - маршрутизатор строится по реестру при запуске
+
+# Ежедневные цели. buttons: текст кнопки -> (баллы, название в подтверждении),
+# необязательный max_per_day - сколько раз за день цель засчитывается (по умолчанию без ограничения)
+DAILY_GOALS = {
+    'workout': {
+        'name': 'Тренировка', 'points': 10, 'emoji': '💪', 'percent': 15, 'category': 'body',
+        'buttons': {'💪 Тренировка': (10, "тренировку")},
+    },
+    'meditation': {
+        'name': 'Медитация', 'points': 5, 'emoji': '🧘', 'percent': 10, 'category': 'mind',
+        'buttons': {'🧘 Медитация': (5, "медитацию")},
+    },
+    'reading': {
+        'name': 'Книга (30 минут)', 'points': 5, 'emoji': '📚', 'percent': 15, 'category': 'mind',
+        'buttons': {'📚 Книга 30 мин': (5, "чтение 30 минут")},
+    },
+    'steps': {
+        'name': '10.000 шагов', 'points': 10, 'emoji': '🚶', 'percent': 20, 'category': 'body',
+        'buttons': {'🚶 10.000 шагов': (10, "10.000 шагов")},
+    },
+    'chinese': {
+        'name': 'Китайский (1 час)', 'points': 10, 'emoji': '🀅', 'percent': 20, 'category': 'mind',
+        'buttons': {
+            '🀅 1 час': (10, "китайский язык (1 час)"),
+            '🀅 2 часа': (20, "китайский язык (2 часа)"),
+        },
+    },
+    'thesis': {
+        'name': 'Диссертация (1 страница)', 'points': 10, 'emoji': '📝', 'percent': 20, 'category': 'mind',
+        'buttons': {'📝 Диссертация': (10, "страницу диссертации")},
+    },
+}
+
+# Кнопки навигации: текст кнопки -> (действие, аргументы действия)
+MENU_BUTTONS = {
+    '💪 Тело': ('menu', "Что выполнил для тела?", [['🚶 10.000 шагов', '💪 Тренировка'], ['← Назад']]),
+    '🧠 Разум': ('menu', "Что выполнил для разума?", [['📚 Книга 30 мин', '🀅 Китайский'], ['📝 Диссертация', '← Назад']]),
+    '🀅 Китайский': ('menu', "Сколько времени уделил китайскому?", [['🀅 1 час', '🀅 2 часа'], ['← Назад']]),
+    '📊 Статистика': ('stats_menu',),
+    '🔧 Управление челленджем': ('challenge_management',),
+    '← Назад': ('start',),
+    '❌ Отказаться от челленджа': ('confirm_quit',),
+    '📈 Статистика за сегодня': ('today_stats',),
+    '📅 История за месяц': ('month_history',),
+    '💰 Общий итог за месяц': ('month_total',),
+    '📉 График за месяц': ('month_chart',),
+}
+
+# Кнопки, которые действуют только пока пользователь подтверждает отказ от челленджа
+CONFIRMATION_BUTTONS = {
+    '✅ Да, отказаться': ('quit_challenge',),
+    '❌ Нет, продолжить': ('keep_challenge',),
+}
+
+# Бит каждой цели в маске выполненных за день целей, порядок как в DAILY_GOALS.
+# Маски хранятся в базе, поэтому новые цели добавляются только в конец DAILY_GOALS
+GOAL_BITS = {goal_id: 1 << index for index, goal_id in enumerate(DAILY_GOALS)}
+ALL_GOALS_MASK = (1 << len(DAILY_GOALS)) - 1
+
+# Дневные ограничения целей для проверки при записи достижения
+GOAL_LIMITS = {goal_id: goal.get('max_per_day') for goal_id, goal in DAILY_GOALS.items()}
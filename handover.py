@@ -0,0 +1,164 @@
+"""Проверка передачи работы между экземплярами бота без Telegram.
+
+Запускает fake_bot_api.py и первый экземпляр bot.py, подает поток
+сообщений от разных пользователей, затем запускает второй экземпляр.
+Второй запрашивает аренду лидерства, первый дообрабатывает обновления
+и уступает. По времени ответов в fake_bot_api считается перерыв
+в обслуживании, потерянные и повторные ответы.
+
+Пример:
+    python handover.py --rate 50 --max-gap 1.0
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_bot_api import FakeBotApi
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+# Кнопка с одним ответом и без записи в базу
+MESSAGE_TEXT = '📊 Статистика'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_instance(name, api_url, workdir):
+    env = dict(
+        os.environ,
+        BOT_TOKEN='1:handover',
+        BOT_MODE='polling',
+        BOT_API_URL=api_url,
+        DB_PATH=os.path.join(workdir, 'bot.db'),
+        LEASE_PATH=os.path.join(workdir, 'bot.lease'),
+        PORT=str(free_port()),
+        SEND_GLOBAL_RATE='0',
+        SEND_CHAT_RATE='0',
+    )
+    log = open(os.path.join(workdir, f'{name}.log'), 'w')
+    process = subprocess.Popen([sys.executable, BOT_SCRIPT], env=env, stdout=log, stderr=subprocess.STDOUT)
+    print(f"Экземпляр {name}: PID {process.pid}, лог {log.name}")
+    return process
+
+
+async def wait_for_reply(api, chat_id, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if api.sent_messages(chat_id):
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+async def run_handover(args, workdir=None):
+    workdir = workdir or tempfile.mkdtemp(prefix='handover-')
+    api = FakeBotApi()
+    await api.start()
+
+    first = second = None
+    pushed = {}
+    try:
+        first = start_instance('first', api.url, workdir)
+        await api.push_message(1, '/start')
+        if not await wait_for_reply(api, 1, args.startup_timeout):
+            raise RuntimeError("Первый экземпляр не ответил")
+
+        stop_traffic = asyncio.Event()
+
+        async def traffic():
+            # Каждое сообщение от нового пользователя: ответ однозначно указывает на обновление
+            user_id = 1000
+            while not stop_traffic.is_set():
+                user_id += 1
+                await api.push_message(user_id, MESSAGE_TEXT)
+                pushed[user_id] = time.monotonic()
+                await asyncio.sleep(1 / args.rate)
+
+        traffic_task = asyncio.create_task(traffic())
+        await asyncio.sleep(args.warmup)
+
+        second_started = time.monotonic()
+        second = start_instance('second', api.url, workdir)
+        loop = asyncio.get_running_loop()
+        first_code = await asyncio.wait_for(loop.run_in_executor(None, first.wait), args.startup_timeout + 30)
+        first_exited = time.monotonic()
+
+        await asyncio.sleep(args.after)
+        stop_traffic.set()
+        await traffic_task
+        # Ответы на последние сообщения
+        await asyncio.sleep(args.settle)
+    finally:
+        for process in (first, second):
+            if process is not None and process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+                await asyncio.get_running_loop().run_in_executor(None, process.wait)
+        await api.stop()
+
+    replies = {}
+    for method, params, at in api.calls:
+        if method == 'sendMessage' and params.get('chat_id') in pushed:
+            replies.setdefault(params['chat_id'], []).append(at)
+
+    reply_times = sorted(times[0] for times in replies.values())
+    gaps = [b - a for a, b in zip(reply_times, reply_times[1:])]
+    latencies = [replies[user_id][0] - at for user_id, at in pushed.items() if user_id in replies]
+
+    return {
+        'config': {'rate': args.rate, 'warmup_s': args.warmup, 'after_s': args.after},
+        'messages': len(pushed),
+        'answered': len(replies),
+        'lost': len(pushed) - len(replies),
+        'duplicated': sum(1 for times in replies.values() if len(times) > 1),
+        'first_exit_code': first_code,
+        'first_exit_after_second_start_s': round(first_exited - second_started, 3),
+        'max_gap_s': round(max(gaps), 3) if gaps else None,
+        'normal_gap_s': round(1 / args.rate, 3),
+        'latency_p50_ms': round(statistics.median(latencies) * 1000, 1) if latencies else None,
+        'latency_max_ms': round(max(latencies) * 1000, 1) if latencies else None,
+        'logs': workdir,
+    }
+
+
+def main():
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.WARNING,
+        handlers=[logging.StreamHandler(sys.stdout)],
+    )
+
+    parser = argparse.ArgumentParser(description="Перерыв в обслуживании при передаче работы новому экземпляру")
+    parser.add_argument('--rate', type=float, default=50, help="сообщений в секунду")
+    parser.add_argument('--warmup', type=float, default=2.0, help="секунд работы первого экземпляра до запуска второго")
+    parser.add_argument('--after', type=float, default=2.0, help="секунд потока после остановки первого")
+    parser.add_argument('--settle', type=float, default=1.0, help="секунд ожидания последних ответов")
+    parser.add_argument('--startup-timeout', type=float, default=30.0)
+    parser.add_argument('--max-gap', type=float, help="код возврата 1, если перерыв дольше стольких секунд")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_handover(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    if result['lost']:
+        print(f"Потеряно ответов: {result['lost']}")
+        return 1
+    if args.max_gap is not None and (result['max_gap_s'] or 0) > args.max_gap:
+        print(f"Перерыв {result['max_gap_s']} с дольше {args.max_gap} с")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,217 @@
+import asyncio
+import itertools
+import logging
+import os
+from collections import namedtuple
+from urllib.parse import parse_qsl, urlsplit
+
+logger = logging.getLogger(__name__)
+
+Request = namedtuple('Request', ['method', 'path', 'query', 'headers', 'body'])
+
+STATUS_TEXT = {
+    200: 'OK',
+    202: 'Accepted',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    429: 'Too Many Requests',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+}
+
+# Ответы без кэширования: health checks Render должны видеть актуальное состояние
+NO_CACHE_HEADERS = {
+    'Cache-Control': 'no-cache, no-store, must-revalidate',
+    'Pragma': 'no-cache',
+    'Expires': '0',
+}
+
+
+class Response:
+    def __init__(self, status=200, body=b'', content_type='text/plain; charset=utf-8', headers=None):
+        self.status = status
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        self.content_type = content_type
+        self.headers = headers or {}
+
+
+class FileResponse(Response):
+    """Ответ с содержимым файла: отправляется частями, не читается в память целиком.
+    При remove файл удаляется после отправки"""
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, path, status=200, content_type='application/octet-stream', headers=None, remove=False):
+        super().__init__(status, b'', content_type, headers)
+        self.path = path
+        self.remove = remove
+        self.size = os.path.getsize(path)
+
+    async def write_body(self, writer):
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+
+    def close(self):
+        if self.remove:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class HttpServer:
+    """Минимальный HTTP/1.1 сервер на asyncio.
+
+    Маршруты задаются парами (метод, путь). HEAD обслуживается
+    обработчиком GET без тела ответа. Запросы, не подошедшие ни к одному
+    маршруту, передаются в fallback, если он задан.
+    """
+
+    def __init__(self, host='0.0.0.0', port=10000, max_body_size=1024 * 1024, max_headers=100, read_timeout=30.0):
+        self.host = host
+        self.port = port
+        self.max_body_size = max_body_size
+        # Больше строк заголовков - ответ 431, соединение закрывается
+        self.max_headers = max_headers
+        # Сколько ждать следующего запроса: простаивающие соединения закрываются
+        self.read_timeout = read_timeout
+        self.fallback = None
+        self._routes = {}
+        self._server = None
+        self._connections = set()
+
+    def route(self, method, path, handler):
+        self._routes[(method, path)] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        # Порт 0 означает любой свободный - запоминаем выданный системой
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"HTTP сервер запущен на порту {self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # Открытые keep-alive соединения закрываем сами
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), self.read_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if request is None:
+                    break
+
+                if isinstance(request, Response):
+                    response = request
+                else:
+                    response = await self._dispatch(request)
+
+                keep_alive = (
+                    isinstance(request, Request)
+                    and request.headers.get('connection', '').lower() != 'close'
+                )
+                head_only = isinstance(request, Request) and request.method == 'HEAD'
+                self._write_response(writer, response, head_only, keep_alive)
+                if isinstance(response, FileResponse):
+                    try:
+                        if not head_only:
+                            await response.write_body(writer)
+                    finally:
+                        response.close()
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # Отмена приходит из stop() - соединение просто закрывается
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _read_request(self, reader):
+        """Request, Response с ошибкой (соединение затем закрывается) или None при закрытии"""
+        try:
+            return await self._parse_request(reader)
+        except (asyncio.LimitOverrunError, ValueError):
+            # Слишком длинная строка заголовков или неверный Content-Length
+            return Response(400, '400 Bad Request')
+
+    async def _parse_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+
+        try:
+            method, target, _ = line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            return Response(400, '400 Bad Request')
+
+        headers = {}
+        # Считаются строки, а не имена: повтор одного заголовка тоже занимает время чтения
+        for count in itertools.count():
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if count >= self.max_headers:
+                return Response(431, '431 Request Header Fields Too Large')
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get('content-length') or 0)
+        if length < 0:
+            return Response(400, '400 Bad Request')
+        if length > self.max_body_size:
+            return Response(413, '413 Payload Too Large')
+        body = await reader.readexactly(length) if length else b''
+
+        url = urlsplit(target)
+        return Request(method.upper(), url.path, dict(parse_qsl(url.query)), headers, body)
+
+    async def _dispatch(self, request):
+        method = 'GET' if request.method == 'HEAD' else request.method
+        handler = self._routes.get((method, request.path))
+
+        if handler is None:
+            handler = self.fallback
+        if handler is None:
+            if any(path == request.path for _, path in self._routes):
+                return Response(405, '405 Method Not Allowed')
+            return Response(404, '404 Not Found')
+
+        try:
+            return await handler(request)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке {request.method} {request.path}: {e}")
+            return Response(500, '500 Internal Server Error')
+
+    def _write_response(self, writer, response, head_only, keep_alive):
+        lines = [f"HTTP/1.1 {response.status} {STATUS_TEXT.get(response.status, '')}"]
+        headers = {
+            'Content-Type': response.content_type,
+            'Content-Length': str(response.size if isinstance(response, FileResponse) else len(response.body)),
+            'Connection': 'keep-alive' if keep_alive else 'close',
+            **response.headers,
+        }
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        if not head_only:
+            writer.write(response.body)
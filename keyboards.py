@@ -0,0 +1,28 @@
+from telegram import ReplyKeyboardMarkup
+
+# Клавиатуры неизменяемы, поэтому создаются один раз при запуске
+# и используются во всех ответах
+
+def make_keyboard(rows):
+    return ReplyKeyboardMarkup(rows, resize_keyboard=True)
+
+MAIN_KEYBOARD = make_keyboard([
+    ['💪 Тело', '🧠 Разум', '🧘 Медитация'],
+    ['📊 Статистика', '🔧 Управление челленджем']
+])
+
+CONTINUE_KEYBOARD = make_keyboard([
+    ['💪 Тело', '🧠 Разум', '🧘 Медитация'],
+    ['📊 Статистика', '← Назад']
+])
+
+STATS_KEYBOARD = make_keyboard([
+    ['📈 Статистика за сегодня', '📅 История за месяц'],
+    ['💰 Общий итог за месяц', '📉 График за месяц'],
+    ['← Назад']
+])
+
+CHALLENGE_ACTIVE_KEYBOARD = make_keyboard([['❌ Отказаться от челленджа'], ['← Назад']])
+CHALLENGE_INACTIVE_KEYBOARD = make_keyboard([['← Назад']])
+CONFIRM_QUIT_KEYBOARD = make_keyboard([['✅ Да, отказаться', '❌ Нет, продолжить']])
+RESTART_KEYBOARD = make_keyboard([['/start']])
@@ -0,0 +1,165 @@
+"""Аренда лидерства: обновления получает только один экземпляр бота.
+
+Аренда хранится в небольшом файле SQLite рядом с базой. Лидер продлевает
+ее, пока работает. Новый экземпляр при запуске записывает запрос на
+передачу и ждет: лидер замечает запрос, дообрабатывает принятые
+обновления, отправляет очередь сообщений, закрывает базу и освобождает
+аренду. Если лидер упал, аренда освобождается сама через ttl секунд.
+"""
+import asyncio
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+LEASE_NAME = 'bot'
+
+
+class LeaderLease:
+    def __init__(self, path, holder, ttl=10.0, interval=0.1):
+        self.path = path
+        # Имя экземпляра: хост и PID
+        self.holder = holder
+        self.ttl = ttl
+        # Как часто ожидающий экземпляр проверяет аренду, а лидер - запрос на передачу
+        self.interval = interval
+        # Лидер уступил аренду новому экземпляру или потерял ее
+        self.superseded = False
+        self._conn = None
+        self._watcher = None
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS leader_lease (
+                    name TEXT PRIMARY KEY,
+                    holder TEXT,
+                    expires_at REAL NOT NULL DEFAULT 0,
+                    requested_by TEXT
+                )
+            ''')
+        return self._conn
+
+    def try_acquire(self):
+        """Занять аренду, если она свободна или истекла, иначе запросить передачу"""
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT holder, expires_at, requested_by FROM leader_lease WHERE name = ?", (LEASE_NAME,)
+            ).fetchone()
+            if row is None or row[0] is None or row[0] == self.holder or row[1] <= now:
+                conn.execute(
+                    "INSERT OR REPLACE INTO leader_lease (name, holder, expires_at, requested_by) VALUES (?, ?, ?, NULL)",
+                    (LEASE_NAME, self.holder, now + self.ttl),
+                )
+                self.superseded = False
+                return True, None
+            if row[2] != self.holder:
+                conn.execute("UPDATE leader_lease SET requested_by = ? WHERE name = ?", (self.holder, LEASE_NAME))
+            return False, row[0]
+        finally:
+            conn.execute("COMMIT")
+
+    def wait(self):
+        """Дождаться аренды (блокирующе), вернуть время ожидания в секундах"""
+        started = time.monotonic()
+        acquired, leader = self.try_acquire()
+        if not acquired:
+            logger.info(f"Лидер {leader}, запрошена передача работы")
+            while not acquired:
+                time.sleep(self.interval)
+                acquired, _ = self.try_acquire()
+
+        waited = time.monotonic() - started
+        logger.info(f"Аренда лидерства получена ({self.holder}), ожидание {waited:.3f} с")
+        return waited
+
+    def _check(self, renew):
+        """Продлить аренду (при renew) и вернуть (мы лидер, кто просит передачу)"""
+        conn = self._connection()
+        if renew:
+            cur = conn.execute(
+                "UPDATE leader_lease SET expires_at = ? WHERE name = ? AND holder = ?",
+                (time.time() + self.ttl, LEASE_NAME, self.holder),
+            )
+            if cur.rowcount != 1:
+                return False, None
+        row = conn.execute(
+            "SELECT holder, requested_by FROM leader_lease WHERE name = ?", (LEASE_NAME,)
+        ).fetchone()
+        if row is None or row[0] != self.holder:
+            return False, None
+        return True, row[1]
+
+    def current_holder(self):
+        """Кто держит неистекшую аренду (None - свободна), без запроса передачи"""
+        row = self._connection().execute(
+            "SELECT holder, expires_at FROM leader_lease WHERE name = ?", (LEASE_NAME,)
+        ).fetchone()
+        if row is None or row[0] is None or row[1] <= time.time():
+            return None
+        return row[0]
+
+    def start(self, on_lost):
+        """Продлевать аренду в event loop и вызвать on_lost() при запросе передачи или потере.
+
+        После запроса передачи аренда продлевается дальше, пока идет остановка:
+        новый экземпляр не начнет работу, пока старый не освободит ее в release.
+        """
+        self._watcher = asyncio.get_running_loop().create_task(self._watch(on_lost))
+
+    async def _watch(self, on_lost):
+        renewed = time.monotonic()
+        while True:
+            await asyncio.sleep(self.interval)
+            renew = time.monotonic() - renewed >= self.ttl / 3
+            try:
+                leader, requested_by = await asyncio.to_thread(self._check, renew)
+            except sqlite3.Error as e:
+                # Аренда продлевается с запасом, разовая ошибка не страшна
+                logger.warning(f"Не удалось проверить аренду лидерства: {e}")
+                continue
+            if renew:
+                renewed = time.monotonic()
+
+            if self.superseded:
+                if not leader:
+                    return
+                continue
+            if not leader:
+                logger.error("Аренда лидерства потеряна, останавливаемся")
+            elif requested_by:
+                logger.info(f"Экземпляр {requested_by} запросил передачу работы, останавливаемся")
+            else:
+                continue
+
+            self.superseded = True
+            on_lost()
+
+    async def stop(self):
+        """Перестать продлевать аренду (она остается за нами до release)"""
+        if self._watcher is not None:
+            self._watcher.cancel()
+            try:
+                await self._watcher
+            except asyncio.CancelledError:
+                pass
+            self._watcher = None
+
+    def release(self):
+        """Освободить аренду: ожидающий экземпляр займет ее сразу"""
+        if self._conn is None:
+            return
+        cur = self._conn.execute(
+            "UPDATE leader_lease SET holder = NULL, expires_at = 0 WHERE name = ? AND holder = ?",
+            (LEASE_NAME, self.holder),
+        )
+        if cur.rowcount:
+            logger.info("Аренда лидерства освобождена")
+        self._conn.close()
+        self._conn = None
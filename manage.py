@@ -0,0 +1,418 @@
+"""Служебные команды для обслуживания базы данных.
+
+Примеры:
+    python manage.py migrate
+    python manage.py check-plans
+    python manage.py rebuild-rollups
+    HISTORY_HORIZON_DAYS=90 python manage.py compact
+    python manage.py check-engines
+    python manage.py analytics
+    SHARDS=4 python manage.py split-shards
+"""
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+import analytics
+import database
+from goals import ALL_GOALS_MASK, DAILY_GOALS
+from leadership import LeaderLease
+import sharding
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO,
+    handlers=[
+        logging.StreamHandler(sys.stdout)
+    ]
+)
+logger = logging.getLogger(__name__)
+
+def cmd_migrate(args):
+    """Применить миграции (выполняется при открытии базы)"""
+    logger.info(f"Схема базы {args.db or database.DB_PATH} в актуальном состоянии")
+    return 0
+
+def cmd_check_plans(args):
+    """Завершиться с ошибкой, если горячий запрос читает таблицу целиком"""
+    problems = database.query_plan_problems()
+
+    for name, detail in problems:
+        logger.error(f"Запрос {name} выполняет полный проход: {detail}")
+
+    if problems:
+        return 1
+
+    logger.info(f"Все {len(database.QUERIES)} запросов используют индексы ✅")
+    return 0
+
+def _report_rollups(mismatches):
+    for table, count in mismatches.items():
+        if count:
+            logger.error(f"{table}: {count} строк расходятся с историей достижений")
+        else:
+            logger.info(f"{table}: согласована с историей достижений ✅")
+    return 1 if any(mismatches.values()) else 0
+
+def cmd_rebuild_rollups(args):
+    """Пересчитать сводные таблицы по исходным записям и проверить их"""
+    return _report_rollups(database.rebuild_and_check_rollups())
+
+def cmd_check_rollups(args):
+    """Сверить сводные таблицы с исходными записями"""
+    return _report_rollups(database.rollup_mismatches())
+
+def _report_file(stats):
+    size = stats['page_count'] * stats['page_size']
+    free = stats['freelist_count'] * stats['page_size']
+    logger.info(f"Размер базы: {size / 2**20:.1f} МБ, свободно {free / 2**20:.1f} МБ")
+
+def cmd_compact(args):
+    """Сжать записи старше HISTORY_HORIZON_DAYS в архив и освободить место (можно при работающем боте)"""
+    if not database.HISTORY_HORIZON_DAYS:
+        logger.info("HISTORY_HORIZON_DAYS=0, сжатие выключено")
+        return 0
+
+    before = date.today() - timedelta(days=database.HISTORY_HORIZON_DAYS)
+    compacted = database.compact_history_sync(before)
+    logger.info(f"Сжато записей до {before}: {compacted}")
+
+    stats = database.file_stats()
+    if stats['auto_vacuum'] != 2:
+        logger.warning("Для базы не включен auto_vacuum = INCREMENTAL, выполните manage.py vacuum при остановленном боте")
+    else:
+        database.incremental_vacuum_sync(stats['freelist_count'])
+    _report_file(database.file_stats())
+    return _report_rollups(database.rollup_mismatches())
+
+def cmd_vacuum(args):
+    """Перестроить файл базы и включить incremental VACUUM (только при остановленном боте)"""
+    _report_file(database.file_stats())
+    database.full_vacuum()
+    _report_file(database.file_stats())
+    return 0
+
+async def _engine_reads(users, old_day):
+    """Все чтения движка для пользователей: сегодня, в текущем месяце и за окном памяти"""
+    today = date.today()
+    reads = {}
+    for user_id in users:
+        reads[f'challenge {user_id}'] = await database.get_challenge_day(user_id)
+        reads[f'day_masks {user_id}'] = await database.get_day_masks(user_id)
+        for day in (today, old_day):
+            reads[f'mask {user_id} {day}'] = await database.get_completed_mask(user_id, day)
+            reads[f'month_masks {user_id} {day}'] = await database.get_month_masks(user_id, day)
+            reads[f'day_stats {user_id} {day}'] = await database.get_day_stats(user_id, day)
+            reads[f'month_history {user_id} {day}'] = await database.get_month_history(user_id, day)
+            reads[f'month_total {user_id} {day}'] = await database.get_month_total(user_id, day)
+
+    for day in (today, old_day):
+        for skip_mask in (-1, ALL_GOALS_MASK):
+            pages, after = [], 0
+            while True:
+                page = await database.get_broadcast_targets(day, after, 7, skip_mask)
+                if not page:
+                    break
+                pages.append(page)
+                after = page[-1][0]
+            reads[f'broadcast {day} {skip_mask}'] = pages
+
+    reads['totals'] = await database.get_totals()
+    reads['export'] = await database.export_achievements(lambda rows: sorted(rows))
+    # Значения, прошедшие через базу и через память, сравниваются в одном виде
+    return {key: repr(value).replace('[', '(').replace(']', ')') for key, value in reads.items()}
+
+def _engine_scenario(engine, workdir, seed=7):
+    """Один и тот же сценарий на движке engine: импорт, нажатия с повторами,
+    отказы, перезапуск и восстановление после падения (копия файлов без закрытия)"""
+    rng = random.Random(seed)
+    today = date.today()
+    old_day = today - timedelta(days=80)
+    goals = list(DAILY_GOALS.items())
+    users = list(range(1, 31))
+    path = os.path.join(workdir, f'{engine}.db')
+    crash = os.path.join(workdir, f'{engine}-crash.db')
+
+    user_rows = [(user_id, None, f'user{user_id}', today - timedelta(days=100)) for user_id in users[:20]]
+    history = []
+    for _ in range(600):
+        goal_id, goal = rng.choice(goals)
+        day = today - timedelta(days=rng.randrange(1, 100))
+        history.append((rng.choice(users[:20]), goal['category'], goal_id, goal['points'], day))
+
+    calls = []
+
+    async def live():
+        results = []
+        for user_id in users:
+            await database.get_or_create_user(user_id, None, f'user{user_id}')
+        for update_id in range(1001, 1400):
+            goal_id, goal = rng.choice(goals)
+            # Каждое пятое обновление - повторная доставка одного из прошлых
+            if update_id % 5 == 0:
+                update_id = rng.randrange(1000, update_id)
+            calls.append((rng.choice(users), goal['category'], goal_id, goal['points'], update_id))
+            results.append(await database.add_achievement(*calls[-1]))
+        for user_id in users[::4]:
+            await database.deactivate_challenge(user_id)
+        return results
+
+    async def after_restart():
+        # Повторная доставка после перезапуска: памяти недавних update_id уже нет
+        return [await database.add_achievement(*call) for call in calls[-40:]]
+
+    async def next_day():
+        # Повторная доставка после полуночи: сегодняшние нажатия уже не за текущий день
+        tomorrow = today + timedelta(days=1)
+        return [await database.add_achievement(*call, day=tomorrow) for call in calls[:60]]
+
+    runs = {}
+    database.init_db(path, engine=engine)
+    try:
+        database.import_history(user_rows, history)
+        runs['import'] = asyncio.run(_engine_reads(users, old_day))
+        runs['live results'] = {'results': repr(asyncio.run(live()))}
+        # Копия файлов без закрытия базы: так их оставило бы падение процесса
+        database.drain_writes()
+        for source in glob.glob(glob.escape(path) + '*'):
+            shutil.copy(source, crash + source[len(path):])
+        runs['live'] = asyncio.run(_engine_reads(users, old_day))
+    finally:
+        database.close_db()
+
+    database.init_db(path, engine=engine)
+    try:
+        runs['restart'] = asyncio.run(_engine_reads(users, old_day))
+        runs['restart results'] = {'results': repr(asyncio.run(after_restart()))}
+        runs['next day results'] = {'results': repr(asyncio.run(next_day()))}
+    finally:
+        database.close_db()
+
+    database.init_db(crash, engine=engine)
+    try:
+        runs['crash'] = asyncio.run(_engine_reads(users, old_day))
+        runs['rollups'] = database.rollup_mismatches()
+    finally:
+        database.close_db()
+    return runs
+
+def _report_differences(title, expected, actual, limit=5):
+    keys = sorted(key for key in expected.keys() | actual.keys() if expected.get(key) != actual.get(key))
+    for key in keys[:limit]:
+        logger.error(f"{title}, {key}: {expected.get(key)} != {actual.get(key)}")
+    return len(keys)
+
+# Дневные ограничения целей на время сценария: проверка max_per_day тоже сравнивается
+SCENARIO_LIMITS = {'workout': 1, 'reading': 2, 'chinese': 3}
+
+def cmd_check_engines(args):
+    """Прогнать один сценарий на всех движках и сравнить результаты всех чтений"""
+    workdir = tempfile.mkdtemp(prefix='engines-')
+    limits = dict(database.GOAL_LIMITS)
+    database.GOAL_LIMITS.update(SCENARIO_LIMITS)
+    try:
+        runs = {engine: _engine_scenario(engine, workdir) for engine in database.ENGINES}
+    finally:
+        database.GOAL_LIMITS.update(limits)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    differences = 0
+    reference, expected = database.ENGINES[0], runs[database.ENGINES[0]]
+    for engine, engine_runs in runs.items():
+        if any(engine_runs['rollups'].values()):
+            logger.error(f"{engine}: сводные таблицы расходятся с историей: {engine_runs['rollups']}")
+            differences += 1
+        # После перезапуска и восстановления чтения те же, что до них
+        differences += _report_differences(f"{engine} перезапуск", engine_runs['live'], engine_runs['restart'])
+        differences += _report_differences(f"{engine} восстановление", engine_runs['live'], engine_runs['crash'])
+        for stage in ('import', 'live results', 'live', 'restart results', 'next day results'):
+            differences += _report_differences(f"{engine} против {reference}, {stage}", expected[stage], engine_runs[stage])
+
+    if differences:
+        logger.error(f"Движки расходятся: {differences} различий")
+        return 1
+    logger.info(f"Движки {', '.join(database.ENGINES)} ведут себя одинаково ✅")
+    return 0
+
+def cmd_analytics(args):
+    """Выполнение целей, удержание по дням челленджа, баллы за день и отказы (JSON в stdout)"""
+    if not analytics.AVAILABLE:
+        logger.error("Аналитика недоступна: не установлен numpy")
+        return 1
+
+    started = time.monotonic()
+    result = analytics.report_sync()
+    logger.info(f"Аналитика по {result['users']} пользователям и {result['user_days']} дням за {time.monotonic() - started:.2f} с")
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    return 0
+
+# Строки этих таблиц уходят в базу шарда пользователя (сводные таблицы пересчитываются)
+SHARDED_TABLES = {
+    'users': "user_id, username, first_name, challenge_start_date, challenge_active, created_at",
+    # id назначается заново: у баз шардов свои последовательности
+    'achievements': "user_id, category, achievement_type, points, date, update_id",
+    'conversation_state': "user_id, state, expires_at",
+}
+# file_id графиков не зависят от пользователя и копируются в каждую базу
+SHARED_TABLES = {
+    'chart_files': "key, file_id",
+}
+
+def _move_db(source, target):
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(source + suffix):
+            os.replace(source + suffix, target + suffix)
+
+def _copy_shard(conn, index):
+    """Перенести строки пользователей шарда index из базы src в main"""
+    for table, columns in SHARDED_TABLES.items():
+        # Пользователь, оказавшийся в нескольких базах, берется из первой по списку
+        conn.execute(
+            f"INSERT OR IGNORE INTO main.{table} ({columns}) SELECT {columns} FROM src.{table} WHERE shard_for(user_id) = ?",
+            (index,),
+        )
+    for table, columns in SHARED_TABLES.items():
+        conn.execute(f"INSERT OR IGNORE INTO main.{table} ({columns}) SELECT {columns} FROM src.{table}")
+
+    # Коды архива у каждой базы свои: строки архива переводятся через имена
+    conn.execute('''
+        INSERT OR IGNORE INTO main.achievement_codes (kind, name)
+        SELECT kind, name FROM src.achievement_codes ORDER BY code
+    ''')
+    conn.execute('''
+        INSERT INTO main.achievement_archive (user_id, day, type_code, category_code, points, taps)
+        SELECT a.user_id, a.day, mt.code, mc.code, a.points, a.taps
+        FROM src.achievement_archive a
+        JOIN src.achievement_codes st ON st.code = a.type_code
+        JOIN src.achievement_codes sc ON sc.code = a.category_code
+        JOIN main.achievement_codes mt ON mt.kind = st.kind AND mt.name = st.name
+        JOIN main.achievement_codes mc ON mc.kind = sc.kind AND mc.name = sc.name
+        WHERE shard_for(a.user_id) = ?
+        ON CONFLICT DO UPDATE SET points = points + excluded.points, taps = taps + excluded.taps
+    ''', (index,))
+
+    # Рассылка за день считается завершенной, только если она завершена во всех базах.
+    # Счетчики по пользователям не делятся: у каждой базы остаются наибольшие
+    conn.execute('''
+        INSERT INTO main.broadcast_runs (kind, day, last_user_id, sent, failed, finished)
+        SELECT kind, day, last_user_id, sent, failed, finished FROM src.broadcast_runs WHERE true
+        ON CONFLICT DO UPDATE SET
+            last_user_id = MIN(last_user_id, excluded.last_user_id),
+            sent = MAX(sent, excluded.sent),
+            failed = MAX(failed, excluded.failed),
+            finished = finished AND excluded.finished
+    ''')
+
+def cmd_split_shards(args):
+    """Перераспределить пользователей по базам шардов для SHARDS (при остановленном боте)"""
+    path = args.db or database.DB_PATH
+    shards = int(os.getenv('SHARDS', 1))
+    if shards < 1:
+        logger.error(f"SHARDS={shards}, ожидается 1 или больше")
+        return 1
+
+    lease = LeaderLease(os.getenv('LEASE_PATH') or f"{path}.lease", holder='manage.py')
+    try:
+        holder = lease.current_holder()
+    finally:
+        lease.release()
+    if holder is not None:
+        logger.error(f"Бот работает ({holder}): остановите его перед перераспределением")
+        return 1
+
+    # Основная база и все базы шардов, в том числе от прежнего SHARDS
+    sources = [path] if os.path.exists(path) else []
+    sources += [sharding.shard_db_path(path, index) for index in sharding.existing_shards(path)]
+    if not sources:
+        logger.info(f"Баз {path} и ее шардов нет, перераспределять нечего")
+        return 0
+
+    for source in sources:
+        # Миграции и перенос журнала движка memory: источники приводятся к одной схеме
+        journaled = glob.glob(glob.escape(source) + '.journal.*')
+        database.init_db(source, engine='memory' if journaled else 'sqlite')
+        database.close_db()
+
+    targets = [path] if shards == 1 else [sharding.shard_db_path(path, index) for index in range(shards)]
+    building = [f"{target}.split" for target in targets]
+    for index, temporary in enumerate(building):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(temporary + suffix):
+                os.remove(temporary + suffix)
+        database.init_db(temporary, engine='sqlite')
+        database.close_db()
+
+        conn = sqlite3.connect(temporary, isolation_level=None)
+        try:
+            conn.create_function('shard_for', 1, lambda user_id: sharding.shard_for(user_id, shards), deterministic=True)
+            for source in sources:
+                conn.execute("ATTACH DATABASE ? AS src", (source,))
+                conn.execute("BEGIN")
+                _copy_shard(conn, index)
+                conn.execute("COMMIT")
+                conn.execute("DETACH DATABASE src")
+            conn.execute("BEGIN")
+            database.rebuild_rollups(conn)
+            conn.execute("COMMIT")
+            users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        finally:
+            conn.close()
+        logger.info(f"{targets[index]}: {users} пользователей")
+
+    # Старые файлы остаются рядом как резервная копия
+    suffix = time.strftime('%Y%m%d%H%M%S')
+    for source in sources:
+        _move_db(source, f"{source}.pre-split-{suffix}")
+    for temporary, target in zip(building, targets):
+        _move_db(temporary, target)
+
+    logger.info(f"Данные {len(sources)} баз распределены по {len(targets)} базам для SHARDS={shards}, "
+                f"прежние файлы сохранены с суффиксом .pre-split-{suffix} ✅")
+    return 0
+
+COMMANDS = {
+    'migrate': cmd_migrate,
+    'check-plans': cmd_check_plans,
+    'rebuild-rollups': cmd_rebuild_rollups,
+    'check-rollups': cmd_check_rollups,
+    'compact': cmd_compact,
+    'vacuum': cmd_vacuum,
+    'check-engines': cmd_check_engines,
+    'analytics': cmd_analytics,
+    'split-shards': cmd_split_shards,
+}
+
+# Команды со своими временными базами: основная база не открывается
+STANDALONE = {'check-engines', 'split-shards'}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Обслуживание базы данных бота")
+    parser.add_argument('--db', help="путь к файлу базы (по умолчанию DB_PATH)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    for name, command in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=command.__doc__)
+        subparser.set_defaults(func=command)
+
+    args = parser.parse_args(argv)
+    if args.command in STANDALONE:
+        return args.func(args)
+
+    database.init_db(args.db)
+    try:
+        return args.func(args)
+    finally:
+        database.close_db()
+
+if __name__ == '__main__':
+    sys.exit(main())
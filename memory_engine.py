@@ -0,0 +1,531 @@
+"""Движок данных в памяти (DB_ENGINE=memory).
+
+Пользователи, челленджи и сводки по дням за последние HOT_DAYS дней
+хранятся в памяти в компактных записях: дни, маски целей и баллы по
+категориям лежат в массивах array. Чтения горячего пути не выходят
+из event loop. Каждая запись сначала дописывается в журнал - файл
+<база>.journal.<сегмент> рядом с базой, затем меняет память; ответ
+на запись ждет fsync журнала, один fsync подтверждает все записи,
+накопившиеся за время предыдущего (групповая фиксация). Раз
+в SNAPSHOT_INTERVAL секунд сегмент закрывается и его записи переносятся
+в таблицы SQLite одной транзакцией, после чего файл удаляется.
+
+При запуске окно загружается из сводных таблиц SQLite, а сегменты,
+не успевшие попасть в базу, применяются заново. Дни старше окна и
+вся история масок читаются из SQLite, как у движка sqlite.
+"""
+import asyncio
+import bisect
+import glob
+import json
+import logging
+import os
+import time
+from array import array
+from datetime import date
+
+import database
+from goals import GOAL_BITS
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних дней держать в памяти: не меньше месяца, чтобы
+# экраны "сегодня" и "за месяц" всегда читались из памяти
+HOT_DAYS = max(int(os.getenv('HOT_DAYS', 62)), 32)
+# Как часто переносить журнал в SQLite, с
+SNAPSHOT_INTERVAL = float(os.getenv('SNAPSHOT_INTERVAL', 60))
+# Имя движка в таблице journal_state
+JOURNAL_NAME = 'memory'
+
+
+class UserRecord:
+    """Данные одного пользователя в окне HOT_DAYS"""
+    __slots__ = ('start_day', 'active', 'days', 'masks', 'points', 'taps_day', 'taps', 'last_update')
+
+    def __init__(self, start_day=None, active=None):
+        # День начала челленджа (toordinal) и challenge_active; active=None - строки в users нет
+        self.start_day = start_day
+        self.active = active
+        # Дни с достижениями по возрастанию и параллельные им маски целей
+        self.days = array('i')
+        self.masks = array('i')
+        # Категория -> баллы по дням, параллельно days
+        self.points = {}
+        # Достижения по целям за последний день с достижениями
+        self.taps_day = 0
+        self.taps = None
+        # Наибольший записанный update_id за все дни: update_id растут,
+        # больший номер - заведомо новое обновление
+        self.last_update = 0
+
+    def day_index(self, day, create=False):
+        """Позиция дня в массивах или None (create - добавить день)"""
+        days = self.days
+        index = bisect.bisect_left(days, day)
+        if index < len(days) and days[index] == day:
+            return index
+        if not create:
+            return None
+
+        days.insert(index, day)
+        self.masks.insert(index, 0)
+        for values in self.points.values():
+            values.insert(index, 0)
+        return index
+
+    def day_range(self, start, end):
+        """Позиции дней start <= день < end"""
+        return range(bisect.bisect_left(self.days, start), bisect.bisect_left(self.days, end))
+
+    def day_points(self, index):
+        return sum(values[index] for values in self.points.values())
+
+    def category_points(self, category):
+        values = self.points.get(category)
+        if values is None:
+            values = self.points[category] = array('i', bytes(4 * len(self.days)))
+        return values
+
+    def drop_before(self, day):
+        count = bisect.bisect_left(self.days, day)
+        if count:
+            del self.days[:count]
+            del self.masks[:count]
+            for values in self.points.values():
+                del values[:count]
+
+
+def _ordinal_range(day):
+    start, end = database.month_bounds(day)
+    return date.fromisoformat(start).toordinal(), date.fromisoformat(end).toordinal()
+
+
+def _settle(waiters, error=None):
+    """Ответить ожидающим fsync журнала"""
+    for waiter in waiters:
+        if waiter.done():
+            continue
+        if error is None:
+            waiter.set_result(None)
+        else:
+            waiter.set_exception(error)
+
+
+def _fsync_and_close(fd):
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _read_segment(path):
+    entries = []
+    with open(path, encoding='utf-8') as journal:
+        for line in journal:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                # Строка, оборванная падением процесса: дальше записей нет
+                logger.warning(f"Журнал {path}: пропущена неполная запись")
+                break
+    return entries
+
+
+class MemoryEngine(database.Engine):
+    def __init__(self, storage, interval=SNAPSHOT_INTERVAL):
+        super().__init__(storage)
+        self.interval = interval
+        # Дни старше window_start читаются из SQLite
+        self._cold = database.SqliteEngine(storage)
+        self._users = {}
+        # Зарегистрированные пользователи по возрастанию user_id (страницы рассылок)
+        self._ids = []
+        self._window_start = 0
+        # Записи журнала, еще не перенесенные в SQLite, и текущий сегмент
+        self._entries = []
+        self._segment = 0
+        self._journal = None
+        # Ожидающие fsync журнала и задача, которая его выполняет
+        self._unsynced = []
+        self._syncer = None
+        self._flush_lock = asyncio.Lock()
+        self._snapshots = None
+
+    # Журнал
+
+    def _segment_path(self, segment):
+        return f"{self.storage.path}.journal.{segment}"
+
+    def _segments(self):
+        """Номера сегментов журнала на диске по возрастанию"""
+        prefix = f"{self.storage.path}.journal."
+        segments = []
+        for path in glob.glob(glob.escape(prefix) + '*'):
+            suffix = path[len(prefix):]
+            if suffix.isdigit():
+                segments.append(int(suffix))
+        return sorted(segments)
+
+    def _open_segment(self, segment):
+        self._segment = segment
+        self._journal = open(self._segment_path(segment), 'a', encoding='utf-8')
+
+    def _close_journal(self):
+        if self._journal is None:
+            return
+        self._journal.close()
+        if not os.path.getsize(self._journal.name):
+            os.remove(self._journal.name)
+        self._journal = None
+
+    def _remove_segments(self, up_to):
+        for segment in self._segments():
+            if segment <= up_to:
+                os.remove(self._segment_path(segment))
+
+    def _rotate(self):
+        """Начать следующий сегмент. Вернуть записи закрываемого, его номер, файл
+        и ожидающих fsync: их подтверждает fsync закрываемого файла, а не нового"""
+        rotated = self._entries, self._segment, self._journal, self._unsynced
+        self._entries = []
+        self._unsynced = []
+        self._open_segment(self._segment + 1)
+        return rotated
+
+    def _write(self, entry):
+        """Дописать запись в журнал и применить к памяти. Возвращает future:
+        запись надежна (fsync), когда он выполнен"""
+        self._journal.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self._apply(entry)
+        self._entries.append(entry)
+
+        loop = asyncio.get_running_loop()
+        synced = loop.create_future()
+        self._unsynced.append(synced)
+        if self._syncer is None or self._syncer.done():
+            self._syncer = loop.create_task(self._sync_journal())
+        if self._snapshots is None or self._snapshots.done():
+            self._snapshots = loop.create_task(self._snapshot_loop())
+        return synced
+
+    async def _sync_journal(self):
+        """Групповая фиксация: один fsync на все записи, накопившиеся к его началу"""
+        loop = asyncio.get_running_loop()
+        while self._unsynced:
+            waiters, self._unsynced = self._unsynced, []
+            self._journal.flush()
+            # Копия дескриптора: сегмент может закрыться при снимке, пока идет fsync
+            fd = os.dup(self._journal.fileno())
+            try:
+                await loop.run_in_executor(None, _fsync_and_close, fd)
+            except OSError as e:
+                logger.error(f"Не удалось зафиксировать журнал: {e}")
+                _settle(waiters, e)
+                continue
+            _settle(waiters)
+
+    def _apply(self, entry):
+        """Применить запись журнала к памяти (без проверок)"""
+        kind, user_id = entry[0], entry[1]
+        record = self._users.get(user_id)
+
+        if kind == database.JOURNAL_ACHIEVEMENT:
+            _, _, category, achievement_type, points, day, update_id = entry
+            if record is None:
+                record = self._users[user_id] = UserRecord()
+            index = record.day_index(day, create=True)
+            record.masks[index] |= GOAL_BITS.get(achievement_type, 0)
+            record.category_points(category)[index] += points
+
+            if day > record.taps_day:
+                record.taps_day = day
+                record.taps = {}
+            if day == record.taps_day:
+                record.taps[achievement_type] = record.taps.get(achievement_type, 0) + 1
+            if update_id is not None and update_id > record.last_update:
+                record.last_update = update_id
+
+        elif kind == database.JOURNAL_USER:
+            if record is None:
+                record = self._users[user_id] = UserRecord()
+            if record.active is None:
+                record.start_day = entry[4]
+                record.active = 1
+                bisect.insort(self._ids, user_id)
+
+        elif kind == database.JOURNAL_DEACTIVATE:
+            if record is not None and record.active is not None:
+                record.active = 0
+
+    # Загрузка и снимки
+
+    def _load_rows(self, name, rows):
+        users = self._users
+        # Одинаковые строки дат превращаются в число один раз
+        ordinals = {}
+
+        def ordinal(day):
+            value = ordinals.get(day)
+            if value is None:
+                value = ordinals[day] = date.fromisoformat(day).toordinal()
+            return value
+
+        if name == 'users':
+            for user_id, start_day, active in rows:
+                start = ordinal(start_day) if start_day else None
+                # NULL в challenge_active ведет себя как неактивный челлендж
+                users[user_id] = UserRecord(start, active or 0)
+                self._ids.append(user_id)
+        elif name == 'summary':
+            for user_id, day, mask in rows:
+                record = users.get(user_id)
+                if record is None:
+                    record = users[user_id] = UserRecord()
+                # Строки идут по возрастанию дня
+                record.days.append(ordinal(day))
+                record.masks.append(mask)
+        elif name == 'stats':
+            for user_id, day, category, points in rows:
+                record = users.get(user_id)
+                if record is None:
+                    record = users[user_id] = UserRecord()
+                index = record.day_index(ordinal(day), create=True)
+                record.category_points(category)[index] = points
+        elif name == 'taps':
+            today = date.today().toordinal()
+            for user_id, achievement_type in rows:
+                record = users[user_id]
+                if record.taps_day != today:
+                    record.taps_day = today
+                    record.taps = {}
+                record.taps[achievement_type] = record.taps.get(achievement_type, 0) + 1
+        elif name == 'updates':
+            for user_id, update_id in rows:
+                record = users.get(user_id)
+                if record is None:
+                    record = users[user_id] = UserRecord()
+                record.last_update = update_id
+
+    def load(self):
+        """Загрузить окно из SQLite и применить сегменты журнала, не попавшие в базу"""
+        started = time.perf_counter()
+        self._close_journal()
+        self._users = {}
+        self._ids = []
+        self._entries = []
+
+        today = date.today()
+        self._window_start = today.toordinal() - HOT_DAYS
+        database.read_hot_window(date.fromordinal(self._window_start), today, self._load_rows)
+        self._ids.sort()
+
+        applied = database.journal_segment(JOURNAL_NAME)
+        segments = self._segments()
+        for segment in segments:
+            if segment > applied:
+                for entry in _read_segment(self._segment_path(segment)):
+                    self._apply(entry)
+                    self._entries.append(entry)
+        self._segment = max([applied, *segments])
+
+        # Восстановленные записи сразу переносятся в базу: SQLite снова совпадает с памятью
+        replayed = len(self._entries)
+        if self._entries:
+            database.save_journal_sync(JOURNAL_NAME, self._segment, self._entries)
+            self._entries = []
+        self._remove_segments(self._segment)
+        self._open_segment(self._segment + 1)
+
+        logger.info(
+            f"Движок memory: {len(self._users)} пользователей за {HOT_DAYS} дней, "
+            f"из журнала {replayed} записей, загрузка {time.perf_counter() - started:.2f} с"
+        )
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Не удалось перенести журнал в SQLite: {e}")
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._entries:
+                return
+            entries, segment, journal, waiters = self._rotate()
+            # fsync закрытого сегмента в пуле потоков: обработчики в это время
+            # пишут уже в новый сегмент
+            error = None
+            try:
+                journal.flush()
+                await asyncio.get_running_loop().run_in_executor(None, os.fsync, journal.fileno())
+            except OSError as e:
+                error = e
+            finally:
+                journal.close()
+            _settle(waiters, error)
+            try:
+                if error is not None:
+                    raise error
+                await database.save_journal(JOURNAL_NAME, segment, entries)
+            except Exception:
+                # Записи остаются в журнале на диске и уйдут со следующим снимком
+                self._entries[:0] = entries
+                raise
+            self._saved(segment)
+
+    def flush_sync(self):
+        if self._entries:
+            entries, segment, journal, waiters = self._rotate()
+            journal.flush()
+            os.fsync(journal.fileno())
+            journal.close()
+            _settle(waiters)
+            database.save_journal_sync(JOURNAL_NAME, segment, entries)
+            self._saved(segment)
+
+    def _saved(self, segment):
+        """Сегменты до segment включительно в базе: удалить их и сдвинуть окно"""
+        self._remove_segments(segment)
+
+        window_start = date.today().toordinal() - HOT_DAYS
+        if window_start > self._window_start:
+            for record in self._users.values():
+                record.drop_before(window_start)
+            self._window_start = window_start
+
+    def close(self):
+        if self._snapshots is not None and not self._snapshots.done():
+            try:
+                self._snapshots.cancel()
+            except RuntimeError:
+                # Event loop уже закрыт
+                pass
+            self._snapshots = None
+        # Снимок, уже стоящий в очереди записей, фиксируется первым
+        self.storage.drain()
+        self.flush_sync()
+        self._close_journal()
+
+    # Данные
+
+    async def create_user(self, user_id, username, first_name, day):
+        record = self._users.get(user_id)
+        if record is None or record.active is None:
+            await self._write([database.JOURNAL_USER, user_id, username, first_name, day.toordinal()])
+
+    async def challenge(self, user_id):
+        record = self._users.get(user_id)
+        if record is None or record.active is None:
+            return None
+        start = date.fromordinal(record.start_day).isoformat() if record.start_day else None
+        return start, record.active
+
+    async def deactivate(self, user_id):
+        record = self._users.get(user_id)
+        if record is not None and record.active:
+            await self._write([database.JOURNAL_DEACTIVATE, user_id])
+
+    async def add_achievement(self, user_id, category, achievement_type, points, day, update_id, max_per_day):
+        day = day.toordinal()
+        record = self._users.get(user_id)
+        if update_id is not None and record is not None and update_id <= record.last_update:
+            # Повторная доставка (или обновление не по порядку): проверка по базе,
+            # как у движка sqlite. Журнал переносится в базу, чтобы она была полной
+            await self.flush()
+            if await self._cold.recorded_update(user_id, update_id):
+                return database.DUPLICATE_UPDATE
+        if record is not None and record.taps_day == day:
+            if max_per_day is not None and record.taps.get(achievement_type, 0) >= max_per_day:
+                return database.DAILY_LIMIT
+        elif max_per_day is not None and max_per_day <= 0:
+            return database.DAILY_LIMIT
+
+        await self._write([database.JOURNAL_ACHIEVEMENT, user_id, category, achievement_type, points, day, update_id])
+        return database.RECORDED
+
+    async def completed_mask(self, user_id, day):
+        day = day.toordinal()
+        if day < self._window_start:
+            return await self._cold.completed_mask(user_id, date.fromordinal(day))
+        record = self._users.get(user_id)
+        index = record.day_index(day) if record is not None else None
+        return record.masks[index] if index is not None else 0
+
+    async def day_masks(self, user_id):
+        # Вся история: старые дни из SQLite, окно из памяти
+        older = [
+            (day, mask) for day, mask in await self._cold.day_masks(user_id)
+            if date.fromisoformat(day).toordinal() < self._window_start
+        ]
+        record = self._users.get(user_id)
+        if record is None:
+            return older
+        window = record.day_range(self._window_start, date.max.toordinal())
+        return older + [(date.fromordinal(record.days[i]).isoformat(), record.masks[i]) for i in window]
+
+    async def month_masks(self, user_id, day):
+        start, end = _ordinal_range(day)
+        if start < self._window_start:
+            return await self._cold.month_masks(user_id, day)
+        record = self._users.get(user_id)
+        if record is None:
+            return []
+        return [(date.fromordinal(record.days[i]).isoformat(), record.masks[i]) for i in record.day_range(start, end)]
+
+    async def day_stats(self, user_id, day):
+        if day.toordinal() < self._window_start:
+            return await self._cold.day_stats(user_id, day)
+        record = self._users.get(user_id)
+        index = record.day_index(day.toordinal()) if record is not None else None
+        if index is None:
+            return 0, []
+        category_stats = [
+            (category, values[index]) for category, values in sorted(record.points.items()) if values[index]
+        ]
+        return sum(points for _, points in category_stats), category_stats
+
+    async def month_history(self, user_id, day):
+        start, end = _ordinal_range(day)
+        if start < self._window_start:
+            return await self._cold.month_history(user_id, day)
+        record = self._users.get(user_id)
+        if record is None:
+            return []
+        return [
+            (date.fromordinal(record.days[i]).isoformat(), record.day_points(i))
+            for i in reversed(record.day_range(start, end))
+        ]
+
+    async def month_total(self, user_id, day):
+        start, end = _ordinal_range(day)
+        if start < self._window_start:
+            return await self._cold.month_total(user_id, day)
+        record = self._users.get(user_id)
+        if record is None:
+            return 0
+        return sum(record.day_points(i) for i in record.day_range(start, end))
+
+    async def broadcast_targets(self, day, after_user_id, skip_mask, limit):
+        day = day.toordinal()
+        if day < self._window_start:
+            # Список пользователей и их активность в SQLite должны быть свежими
+            await self.flush()
+            return await self._cold.broadcast_targets(date.fromordinal(day), after_user_id, skip_mask, limit)
+
+        targets = []
+        ids = self._ids
+        position = bisect.bisect_right(ids, after_user_id)
+        while position < len(ids) and len(targets) < limit:
+            user_id = ids[position]
+            position += 1
+            record = self._users[user_id]
+            if not record.active:
+                continue
+            index = record.day_index(day)
+            mask = record.masks[index] if index is not None else 0
+            if mask == skip_mask:
+                continue
+            targets.append((user_id, mask, record.day_points(index) if index is not None else 0))
+        return targets
@@ -0,0 +1,268 @@
+"""Метрики бота в текстовом формате Prometheus (/metrics).
+
+Счетчики и гистограммы хранятся в памяти процесса. Запись значения -
+поиск по словарю, bisect и пара сложений под блокировкой, поэтому
+метрики можно не отключать в продакшене.
+"""
+import asyncio
+import bisect
+import threading
+import time
+
+from telegram.request import HTTPXRequest
+
+import tracing
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Запросы SQLite обычно укладываются в доли миллисекунды
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Если задан function, значения (метки, значение) считываются из него при выводе:
+    так выводятся величины, которые ведет сам объект (например, счетчики кэша)"""
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _collect(self):
+        if self.function is None:
+            return
+        for label_values, value in self.function():
+            self._check(label_values)
+            with self._lock:
+                self._values[label_values] = value
+
+    def _check(self, label_values):
+        if len(label_values) != len(self.labels):
+            raise ValueError(f"{self.name}: ожидаются метки {self.labels}, получено {label_values}")
+
+    def samples(self):
+        """Строки (имя, метки, значение) для вывода"""
+        self._collect()
+        with self._lock:
+            items = list(self._values.items())
+        for label_values, value in sorted(items):
+            yield self.name, _format_labels(self.labels, label_values), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        self._check(label_values)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    """Текущее значение"""
+    kind = 'gauge'
+
+    def set(self, value, *label_values):
+        self._check(label_values)
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        self._check(label_values)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                # Счетчики корзин (последняя - +Inf), сумма и количество
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for label_values, (counts, total, count) in sorted(items):
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, float('inf')), counts):
+                cumulative += bucket_count
+                le = _format_value(bound if bound == float('inf') else float(bound))
+                yield f"{self.name}_bucket", _format_labels(self.labels, label_values, [('le', le)]), cumulative
+            yield f"{self.name}_sum", _format_labels(self.labels, label_values), total
+            yield f"{self.name}_count", _format_labels(self.labels, label_values), count
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Обновления бота по действиям реестра (command_start - команда /start)
+UPDATES = Counter('bot_updates_total', "Обработанные обновления", ['handler'])
+UPDATE_ERRORS = Counter('bot_update_errors_total', "Обновления, завершившиеся исключением", ['handler'])
+UPDATE_SECONDS = Histogram('bot_update_duration_seconds', "Время обработки обновления", ['handler'])
+ERRORS = Counter('bot_errors_total', "Ошибки, дошедшие до error_handler", ['type'])
+
+DB_QUERY_SECONDS = Histogram(
+    'bot_db_query_duration_seconds', "Время запроса SQLite по имени из QUERIES", ['query'], buckets=DB_BUCKETS
+)
+DB_WRITE_BATCH_SECONDS = Histogram(
+    'bot_db_write_batch_duration_seconds', "Время фиксации пачки записей", buckets=DB_BUCKETS
+)
+DB_WRITE_BATCH_SIZE = Histogram(
+    'bot_db_write_batch_size', "Записей в одной транзакции", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+
+API_REQUEST_SECONDS = Histogram('bot_api_request_duration_seconds', "Время вызова Bot API", ['method'])
+API_ERRORS = Counter('bot_api_errors_total', "Ошибки вызовов Bot API", ['method', 'error'])
+
+SEND_WAIT_SECONDS = Histogram('bot_send_queue_wait_seconds', "Ожидание в очереди отправки", ['priority'])
+SEND_RETRY_AFTER = Counter('bot_send_retry_after_total', "Ответы 429 (RetryAfter) от Bot API")
+
+BROADCAST_MESSAGES = Counter('bot_broadcast_messages_total', "Сообщения рассылок", ['kind', 'result'])
+
+ACHIEVEMENT_DUPLICATES = Counter(
+    'bot_achievement_duplicates_total', "Отклоненные повторные достижения", ['reason', 'source']
+)
+
+CHART_REQUESTS = Counter('bot_chart_requests_total', "Показы графиков по источнику картинки", ['source'])
+
+SHARD_UPDATES = Counter('bot_shard_updates_total', "Обновления, переданные процессам шардов", ['shard'])
+SHARD_RESTARTS = Counter('bot_shard_restarts_total', "Перезапуски упавших процессов шардов", ['shard'])
+
+LOOP_LAG_SECONDS = Histogram('bot_event_loop_lag_seconds', "Опоздание event loop относительно таймера")
+
+_caches = {}
+
+
+def _cache_samples(attribute):
+    def collect():
+        for name, cache in list(_caches.items()):
+            yield (name,), attribute(cache)
+    return collect
+
+
+def _hit_ratio(cache):
+    total = cache.hits + cache.misses
+    return cache.hits / total if total else 0.0
+
+
+# Попадания и промахи ведет сам кэш, значения только растут
+CACHE_HITS = Counter('bot_cache_hits_total', "Попадания в кэш", ['cache'], function=_cache_samples(lambda c: c.hits))
+CACHE_MISSES = Counter('bot_cache_misses_total', "Промахи кэша", ['cache'], function=_cache_samples(lambda c: c.misses))
+CACHE_HIT_RATIO = Gauge('bot_cache_hit_ratio', "Доля попаданий в кэш", ['cache'], function=_cache_samples(_hit_ratio))
+CACHE_ENTRIES = Gauge('bot_cache_entries', "Записей в кэше", ['cache'], function=_cache_samples(len))
+
+
+def watch_cache(name, cache):
+    """Выводить счетчики кэша с полями hits и misses"""
+    _caches[name] = cache
+
+
+class track_update:
+    """Контекстный менеджер: число, ошибки и длительность обработки обновления"""
+
+    __slots__ = ('handler', 'started')
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        UPDATE_SECONDS.observe(time.perf_counter() - self.started, self.handler)
+        UPDATES.inc(self.handler)
+        if exc_type is not None:
+            UPDATE_ERRORS.inc(self.handler)
+        return False
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, который замеряет время и ошибки вызовов Bot API"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            with tracing.span(f"api {api_method}"):
+                code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            API_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            API_REQUEST_SECONDS.observe(time.perf_counter() - started, api_method)
+
+        if code >= 400:
+            API_ERRORS.inc(api_method, str(code))
+        return code, payload
+
+
+class LoopLagMonitor:
+    """Фоновая задача: насколько позже срабатывает таймер event loop"""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            LOOP_LAG_SECONDS.observe(max(loop.time() - expected, 0.0))
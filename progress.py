@@ -0,0 +1,27 @@
+from goals import DAILY_GOALS, GOAL_BITS
+
+def render_progress(mask):
+    """Текст прогресса по ежедневным целям для маски выполненных целей"""
+    progress_text = "📊 Ежедневные цели:\n\n"
+    
+    completed_percent = 0
+    total_goals = len(DAILY_GOALS)
+    completed_count = 0
+    
+    for goal_id, goal_info in DAILY_GOALS.items():
+        if mask & GOAL_BITS[goal_id]:
+            status = "✅"
+            completed_percent += goal_info['percent']
+            completed_count += 1
+        else:
+            status = "⭕"
+        
+        progress_text += f"{status} {goal_info['emoji']} {goal_info['name']}\n"
+    
+    progress_text += f"\n📈 Прогресс: {completed_percent}% выполнено"
+    
+    return progress_text, completed_count, total_goals
+
+# Экранов прогресса всего 2^N (N - число целей), поэтому все они
+# строятся один раз при запуске. Индекс - маска выполненных целей
+PROGRESS_SCREENS = tuple(render_progress(mask) for mask in range(1 << len(DAILY_GOALS)))
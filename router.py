@@ -0,0 +1,57 @@
+from collections import namedtuple
+
+from goals import CONFIRMATION_BUTTONS, DAILY_GOALS, MENU_BUTTONS
+
+# action - имя действия из реестра, handler - корутина действия, args - ее аргументы
+Route = namedtuple('Route', ['action', 'handler', 'args'])
+
+
+class Router:
+    """Диспетчер нажатий: словарь текст кнопки -> маршрут, поиск за O(1)"""
+
+    def __init__(self, actions):
+        self.actions = actions
+        self._routes = {}
+
+    def __len__(self):
+        return len(self._routes)
+
+    def __contains__(self, text):
+        return text in self._routes
+
+    def add(self, text, action, *args):
+        if text in self._routes:
+            raise ValueError(f"Кнопка {text!r} зарегистрирована дважды")
+        if action not in self.actions:
+            raise ValueError(f"Для кнопки {text!r} не найдено действие {action!r}")
+        self._routes[text] = Route(action, self.actions[action], args)
+
+    def resolve(self, text):
+        """Маршрут для текста кнопки или None"""
+        return self._routes.get(text)
+
+
+def build_routers(actions, make_keyboard=None):
+    """Построить основной маршрутизатор и маршрутизатор подтверждения по реестру.
+
+    actions - словарь имя действия -> корутина, которая вызывается
+    как handler(update, context, *args). make_keyboard, если задан,
+    заранее превращает строки кнопок подменю в готовую клавиатуру.
+    """
+    router = Router(actions)
+
+    for goal_id, goal in DAILY_GOALS.items():
+        for text, (points, title) in goal['buttons'].items():
+            router.add(text, 'achievement', goal_id, points, title)
+
+    for text, (action, *args) in MENU_BUTTONS.items():
+        if action == 'menu' and make_keyboard is not None:
+            title, rows = args
+            args = (title, make_keyboard(rows))
+        router.add(text, action, *args)
+
+    confirmation_router = Router(actions)
+    for text, (action, *args) in CONFIRMATION_BUTTONS.items():
+        confirmation_router.add(text, action, *args)
+
+    return router, confirmation_router
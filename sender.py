@@ -0,0 +1,270 @@
+"""Очередь исходящих вызовов Bot API с ограничением частоты.
+
+Telegram ограничивает частоту сообщений в один чат и общую частоту
+для бота. Sender пропускает вызовы через token bucket на каждый чат и
+общий token bucket, интерактивные ответы идут раньше рассылок, а ответ
+429 (RetryAfter) приостанавливает отправку на указанное время и вызов
+повторяется. Сообщения одного чата отправляются строго по порядку.
+"""
+import asyncio
+import collections
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: меньше - раньше
+INTERACTIVE = 0
+BROADCAST = 10
+
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', BROADCAST: 'broadcast'}
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity. rate=0 - без ограничения"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Сколько ждать до появления токена"""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        if self.rate:
+            self._refill(now)
+            self.tokens -= 1
+
+    def full_after(self, now):
+        """Через сколько секунд корзина снова будет полной"""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        return (self.capacity - self.tokens) / self.rate
+
+
+class _Job:
+    __slots__ = ('func', 'kwargs', 'priority', 'seq', 'future', 'context', 'queued', 'attempts')
+
+    def __init__(self, func, kwargs, priority, seq, future):
+        self.func = func
+        self.kwargs = kwargs
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        # Контекст отправителя: интервалы трассировки попадают в его обновление
+        self.context = contextvars.copy_context()
+        self.queued = time.monotonic()
+        self.attempts = 0
+
+
+class _Chat:
+    __slots__ = ('bucket', 'jobs', 'busy', 'timer')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.jobs = collections.deque()
+        self.busy = False
+        self.timer = None
+
+
+class Sender:
+    def __init__(self, bot, global_rate=30, chat_rate=1, chat_burst=3, concurrency=8, max_retries=5):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+
+        self._global = TokenBucket(global_rate, global_rate)
+        self._paused_until = 0.0
+        self._chats = {}
+        # Чаты, готовые к отправке: (приоритет, порядковый номер, chat_id)
+        self._ready = []
+        self._seq = itertools.count()
+        self._pending = 0
+
+        self._wakeup = None
+        self._idle = None
+        self._slots = None
+        self._dispatcher = None
+        self._tasks = set()
+        self._closed = False
+
+    @property
+    def pending(self):
+        return self._pending
+
+    async def send(self, chat_id, func, priority=INTERACTIVE, /, **kwargs):
+        """Поставить вызов func(**kwargs) для чата в очередь и дождаться результата"""
+        if self._closed:
+            raise RuntimeError("Очередь отправки закрыта")
+
+        loop = asyncio.get_running_loop()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._idle = asyncio.Event()
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._dispatcher = loop.create_task(self._dispatch())
+
+        job = _Job(func, kwargs, priority, next(self._seq), loop.create_future())
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(TokenBucket(self.chat_rate, self.chat_burst))
+        if chat.timer is not None and not chat.jobs:
+            # Отменяем удаление простаивающего чата
+            chat.timer.cancel()
+            chat.timer = None
+
+        chat.jobs.append(job)
+        self._pending += 1
+        self._idle.clear()
+        if len(chat.jobs) == 1 and not chat.busy:
+            self._schedule(chat_id, chat)
+
+        return await job.future
+
+    async def send_message(self, chat_id, text, priority=INTERACTIVE, **kwargs):
+        return await self.send(chat_id, self.bot.send_message, priority, chat_id=chat_id, text=text, **kwargs)
+
+    async def edit_message_text(self, chat_id, message_id, text, priority=INTERACTIVE, **kwargs):
+        return await self.send(
+            chat_id, self.bot.edit_message_text, priority, chat_id=chat_id, message_id=message_id, text=text, **kwargs
+        )
+
+    def _schedule(self, chat_id, chat):
+        """Поставить чат в очередь готовых, когда у него появится токен"""
+        now = time.monotonic()
+        delay = max(chat.bucket.delay(now), self._paused_until - now)
+        if delay > 0:
+            chat.timer = asyncio.get_running_loop().call_later(delay, self._push, chat_id, chat)
+        else:
+            self._push(chat_id, chat)
+
+    def _push(self, chat_id, chat):
+        chat.timer = None
+        job = chat.jobs[0]
+        heapq.heappush(self._ready, (job.priority, job.seq, chat_id))
+        self._wakeup.set()
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            delay = max(self._global.delay(now), self._paused_until - now)
+            if delay > 0:
+                # После ожидания снова выбираем самый приоритетный чат
+                await asyncio.sleep(delay)
+                continue
+
+            await self._slots.acquire()
+            _, _, chat_id = heapq.heappop(self._ready)
+            chat = self._chats[chat_id]
+            job = chat.jobs[0]
+
+            now = time.monotonic()
+            self._global.take(now)
+            chat.bucket.take(now)
+            chat.busy = True
+            metrics.SEND_WAIT_SECONDS.observe(now - job.queued, PRIORITY_NAMES.get(job.priority, str(job.priority)))
+            task = loop.create_task(self._run(chat_id, chat, job), context=job.context)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, chat_id, chat, job):
+        try:
+            result = await job.func(**job.kwargs)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if hasattr(retry_after, 'total_seconds'):
+                retry_after = retry_after.total_seconds()
+            metrics.SEND_RETRY_AFTER.inc()
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            job.attempts += 1
+            if job.attempts <= self.max_retries:
+                logger.warning(f"Telegram просит подождать {retry_after} с, отправка в чат {chat_id} будет повторена")
+                self._slots.release()
+                chat.busy = False
+                self._schedule(chat_id, chat)
+                return
+            self._finish(chat_id, chat, job, error=e)
+        except Exception as e:
+            self._finish(chat_id, chat, job, error=e)
+        else:
+            self._finish(chat_id, chat, job, result=result)
+
+    def _finish(self, chat_id, chat, job, result=None, error=None):
+        self._slots.release()
+        chat.jobs.popleft()
+        chat.busy = False
+        self._pending -= 1
+
+        if not job.future.done():
+            if error is not None:
+                job.future.set_exception(error)
+            else:
+                job.future.set_result(result)
+
+        if chat.jobs:
+            self._schedule(chat_id, chat)
+        else:
+            # Корзину простаивающего чата храним, пока она не наполнится
+            idle = chat.bucket.full_after(time.monotonic())
+            chat.timer = asyncio.get_running_loop().call_later(idle, self._forget, chat_id, chat)
+
+        if not self._pending:
+            self._idle.set()
+
+    def _forget(self, chat_id, chat):
+        if not chat.jobs and not chat.busy and self._chats.get(chat_id) is chat:
+            del self._chats[chat_id]
+
+    async def close(self, timeout=10.0):
+        """Дождаться отправки очереди (не дольше timeout) и остановить диспетчер"""
+        self._closed = True
+        if self._dispatcher is None:
+            return
+
+        if self._pending:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Не отправлено {self._pending} сообщений при остановке")
+
+        self._dispatcher.cancel()
+        try:
+            await self._dispatcher
+        except asyncio.CancelledError:
+            pass
+
+        for chat in self._chats.values():
+            if chat.timer is not None:
+                chat.timer.cancel()
+            for job in chat.jobs:
+                if not job.future.done():
+                    job.future.set_exception(RuntimeError("Очередь отправки закрыта"))
+        self._chats.clear()
+        self._ready.clear()
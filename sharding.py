@@ -0,0 +1,328 @@
+"""Распределение пользователей по процессам-обработчикам.
+
+Принимающий процесс (webhook или polling) получает обновления и по хешу
+user_id передает каждое в один из N процессов. У каждого процесса своя
+база SQLite (шард) и своя очередь отправки, обновления одного пользователя
+всегда попадают в один процесс и обрабатываются по порядку. Служебные
+запросы (итоги, аналитика, выгрузка, рассылки) рассылаются всем шардам, результаты объединяются.
+"""
+import asyncio
+import glob
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sqlite3
+import zlib
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать сообщения из очереди между проверками остановки, с
+POLL_INTERVAL = 0.5
+# Аналитика и выгрузка читают базы целиком, им дается больше времени, чем остальным запросам
+ANALYTICS_TIMEOUT = 300.0
+EXPORT_TIMEOUT = 600.0
+# Пауза перед перезапуском упавшего шарда, с: падение при старте не превращается в цикл
+RESTART_DELAY = 1.0
+
+
+class ShardLayoutError(RuntimeError):
+    """Пользователи лежат в базах, которые бот с этим SHARDS не откроет"""
+
+
+def shard_for(user_id, shards):
+    """Номер шарда пользователя: не меняется между перезапусками"""
+    return zlib.crc32(user_id.to_bytes(8, 'little', signed=True)) % shards
+
+
+def shard_db_path(path, index):
+    """achievements.db -> achievements.shard0.db"""
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext or '.db'}"
+
+
+def existing_shards(path):
+    """Номера баз шардов рядом с path, которые есть на диске"""
+    root, ext = os.path.splitext(path)
+    ext = ext or '.db'
+    prefix = f"{root}.shard"
+    found = []
+    for name in glob.glob(glob.escape(prefix) + '*' + glob.escape(ext)):
+        index = name[len(prefix):len(name) - len(ext)]
+        if index.isdigit():
+            found.append(int(index))
+    return sorted(found)
+
+
+def has_users(path):
+    """Есть ли в файле базы пользователи (файл не создается)"""
+    if not os.path.exists(path):
+        return False
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        return conn.execute("SELECT EXISTS (SELECT 1 FROM users)").fetchone()[0] == 1
+    except sqlite3.OperationalError:
+        # Таблиц еще нет
+        return False
+    finally:
+        conn.close()
+
+
+def check_layout(path, shards):
+    """Не запускаться, если при этом SHARDS часть пользователей окажется в непрочитанных базах.
+
+    Иначе такие пользователи молча начали бы челлендж заново в пустой базе
+    """
+    unread = [path] if shards > 1 and has_users(path) else []
+    unread += [
+        shard_db_path(path, index) for index in existing_shards(path)
+        if (shards == 1 or index >= shards) and has_users(shard_db_path(path, index))
+    ]
+    if unread:
+        raise ShardLayoutError(
+            f"При SHARDS={shards} не будут прочитаны базы с пользователями: {', '.join(unread)}. "
+            f"Перераспределите данные: SHARDS={shards} python manage.py split-shards"
+        )
+
+
+def update_user_id(update):
+    """Пользователь, по которому выбирается шард (0 для обновлений без пользователя)"""
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return 0
+
+
+def _get(source):
+    try:
+        return source.get(timeout=POLL_INTERVAL)
+    except queue.Empty:
+        return None
+
+
+class ShardPool:
+    """Процессы-обработчики и очереди к ним (в принимающем процессе)"""
+
+    def __init__(self, shards, db_path, port):
+        self.shards = shards
+        self.db_path = db_path
+        # Процесс i обслуживает /metrics и /admin/* на порту port + 1 + i
+        self.port = port
+        self._context = multiprocessing.get_context('spawn')
+        self._inboxes = []
+        self._processes = []
+        self._results = None
+        self._reader = None
+        self._supervisor = None
+        self._calls = {}
+        self._call_ids = itertools.count(1)
+        self._stopping = False
+
+    def start(self):
+        """Запустить процессы шардов"""
+        self._stopping = False
+        self._results = self._context.Queue()
+        for index in range(self.shards):
+            self._inboxes.append(self._context.Queue())
+            self._processes.append(self._spawn(index))
+        loop = asyncio.get_running_loop()
+        self._reader = loop.create_task(self._read_results())
+        self._supervisor = loop.create_task(self._supervise())
+
+    def _spawn(self, index):
+        process = self._context.Process(
+            target=worker_main,
+            args=(index, self.shards, shard_db_path(self.db_path, index), self.port + 1 + index,
+                  self._inboxes[index], self._results),
+            name=f'shard-{index}',
+        )
+        process.start()
+        logger.info(f"Запущен шард {index}: PID {process.pid}, база {shard_db_path(self.db_path, index)}")
+        return process
+
+    async def _supervise(self):
+        """Перезапускать упавшие процессы шардов"""
+        while not self._stopping:
+            await asyncio.sleep(POLL_INTERVAL)
+            for index, process in enumerate(self._processes):
+                if process.exitcode is None or self._stopping:
+                    continue
+                logger.error(f"Шард {index} (PID {process.pid}) завершился с кодом {process.exitcode}, перезапуск")
+                metrics.SHARD_RESTARTS.inc(str(index))
+                self._fail_calls(index, RuntimeError(f"Шард {index} завершился с кодом {process.exitcode}"))
+                self._replace_inbox(index)
+                await asyncio.sleep(RESTART_DELAY)
+                if not self._stopping:
+                    self._processes[index] = self._spawn(index)
+
+    def _fail_calls(self, index, error):
+        """Ответить ошибкой на запросы, которые ждут упавший шард"""
+        for futures in self._calls.values():
+            if not futures[index].done():
+                futures[index].set_exception(error)
+
+    def _replace_inbox(self, index):
+        """Новая очередь для перезапущенного шарда.
+
+        Упавший процесс мог оставить захваченной блокировку чтения старой
+        очереди. Непрочитанные обновления переносятся, если блокировка свободна
+        """
+        old, new = self._inboxes[index], self._context.Queue()
+        # Обработчик forward с этого момента пишет в новую очередь
+        self._inboxes[index] = new
+        moved = 0
+        while True:
+            try:
+                message = old.get_nowait()
+            except (queue.Empty, OSError, ValueError):
+                break
+            if message[0] == 'update':
+                new.put(message)
+                moved += 1
+        old.close()
+        logger.info(f"Шард {index}: в новую очередь перенесено обновлений: {moved}")
+
+    async def forward(self, update, context):
+        """Обработчик принимающего процесса: передать обновление шарду пользователя"""
+        index = shard_for(update_user_id(update), self.shards)
+        self._inboxes[index].put(('update', update.to_dict()))
+        metrics.SHARD_UPDATES.inc(str(index))
+
+    async def call(self, name, *args, timeout=30.0):
+        """Выполнить name(*args) на всех шардах и вернуть список результатов по номеру шарда"""
+        loop = asyncio.get_running_loop()
+        call_id = next(self._call_ids)
+        futures = [loop.create_future() for _ in range(self.shards)]
+        self._calls[call_id] = futures
+        try:
+            for inbox in self._inboxes:
+                inbox.put(('call', call_id, name, args))
+            return await asyncio.wait_for(asyncio.gather(*futures), timeout)
+        finally:
+            self._calls.pop(call_id, None)
+
+    async def _read_results(self):
+        loop = asyncio.get_running_loop()
+        while not self._stopping:
+            message = await loop.run_in_executor(None, _get, self._results)
+            if message is None:
+                continue
+            call_id, index, result, error = message
+            futures = self._calls.get(call_id)
+            if futures is None or futures[index].done():
+                continue
+            if error is not None:
+                futures[index].set_exception(RuntimeError(f"Шард {index}: {error}"))
+            else:
+                futures[index].set_result(result)
+
+    async def analytics(self):
+        """Аналитика всех шардов: счетчики складываются, доли считаются по сумме"""
+        import analytics
+
+        return analytics.summarize(analytics.merge(await self.call('analytics', timeout=ANALYTICS_TIMEOUT)))
+
+    async def export(self, fmt):
+        """Выгрузка всех шардов одним файлом (как export.export_to_file)"""
+        import export
+
+        parts = await self.call('export', fmt, timeout=EXPORT_TIMEOUT)
+        return await asyncio.to_thread(export.join_parts, parts, fmt)
+
+    async def totals(self):
+        """Итоги всех шардов: сумма по каждому показателю"""
+        merged = {}
+        for result in await self.call('totals'):
+            for key, value in result.items():
+                merged[key] = merged.get(key, 0) + value
+        merged['shards'] = self.shards
+        return merged
+
+    def trigger(self, kind, day=None):
+        """Запустить рассылку на всех шардах (как Broadcaster.trigger)"""
+        from broadcast import KINDS
+
+        if kind not in KINDS:
+            raise ValueError(f"Неизвестная рассылка {kind!r}")
+        return asyncio.get_running_loop().create_task(self.call('broadcast', kind, day))
+
+    async def stop(self, timeout=30.0):
+        """Остановить шарды: каждый обрабатывает принятые обновления и закрывает базу"""
+        if not self._processes:
+            return
+
+        # Шарды сейчас завершатся сами - это не падение
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+            self._supervisor = None
+        for inbox in self._inboxes:
+            inbox.put(('stop',))
+
+        loop = asyncio.get_running_loop()
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logger.warning(f"Шард {process.name} не остановился за {timeout} с, завершаем принудительно")
+                process.terminate()
+                await loop.run_in_executor(None, process.join)
+
+        self._stopping = True
+        if self._reader is not None:
+            await self._reader
+        self._inboxes.clear()
+        self._processes.clear()
+        logger.info("Шарды остановлены")
+
+
+def worker_main(index, shards, db_path, port, inbox, results):
+    """Точка входа процесса шарда"""
+    # Ctrl+C получает вся группа процессов - остановкой шардов управляет принимающий процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import bot
+    import config
+    import database
+
+    # Настройки шарда: своя база, свой порт /metrics и доля общего лимита отправки.
+    # Расписание рассылок общее - каждый шард рассылает своим пользователям
+    database.DB_PATH = db_path
+    config.PORT = port
+    config.SEND_GLOBAL_RATE = config.SEND_GLOBAL_RATE / shards
+
+    asyncio.run(bot.serve_shard(index, inbox, results))
+
+
+async def _answer_call(index, results, calls, call_id, name, args):
+    try:
+        results.put((call_id, index, await calls[name](*args), None))
+    except Exception as e:
+        logger.error(f"Шард {index}: ошибка {name}: {e}")
+        results.put((call_id, index, None, str(e)))
+
+
+async def worker_loop(index, inbox, results, handle_update, calls):
+    """Читать очередь шарда до команды остановки или SIGTERM"""
+    loop = asyncio.get_running_loop()
+    pending = set()
+    stopping = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+
+    while not stopping.is_set():
+        message = await loop.run_in_executor(None, _get, inbox)
+        if message is None:
+            continue
+
+        if message[0] == 'update':
+            await handle_update(message[1])
+        elif message[0] == 'call':
+            # Долгие запросы (аналитика) не задерживают обновления шарда
+            task = loop.create_task(_answer_call(index, results, calls, *message[1:]))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        elif message[0] == 'stop':
+            break
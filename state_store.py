@@ -0,0 +1,73 @@
+import time
+from collections import OrderedDict
+
+import database
+
+
+class ConversationStore:
+    """Состояние диалога пользователя (например, ожидание подтверждения).
+
+    Все чтения идут из памяти за O(1). Записи ограничены по времени жизни
+    ttl и числу пользователей max_users (вытесняются давно не
+    использованные). При persist изменения сохраняются в SQLite через
+    очередь записей и загружаются при запуске, поэтому ожидающие
+    подтверждения переживают перезапуск бота.
+    """
+
+    def __init__(self, ttl=600, max_users=10000, persist=True):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.persist = persist
+        # user_id -> (состояние, момент истечения по time.time())
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def load(self):
+        """Загрузить неистекшие состояния из базы (база должна быть открыта)"""
+        if not self.persist:
+            return 0
+
+        self._entries.clear()
+        for user_id, state, expires_at in database.load_conversation_states(time.time()):
+            self._entries[user_id] = (state, expires_at)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+        return len(self._entries)
+
+    def get(self, user_id):
+        """Текущее состояние пользователя или None"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+
+        state, expires_at = entry
+        if expires_at <= time.time():
+            # Строка в базе удалится при следующей загрузке
+            del self._entries[user_id]
+            return None
+
+        self._entries.move_to_end(user_id)
+        return state
+
+    async def set(self, user_id, state):
+        expires_at = time.time() + self.ttl
+        self._entries[user_id] = (state, expires_at)
+        self._entries.move_to_end(user_id)
+
+        evicted = []
+        while len(self._entries) > self.max_users:
+            evicted.append(self._entries.popitem(last=False)[0])
+
+        if self.persist:
+            await database.save_conversation_state(user_id, state, expires_at)
+            for evicted_user_id in evicted:
+                await database.delete_conversation_state(evicted_user_id)
+
+    async def pop(self, user_id):
+        """Удалить состояние пользователя и вернуть его"""
+        entry = self._entries.pop(user_id, None)
+        if self.persist and entry is not None:
+            await database.delete_conversation_state(user_id)
+        return entry[0] if entry is not None else None
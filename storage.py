@@ -0,0 +1,206 @@
+import asyncio
+import collections
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Настройки соединений: WAL позволяет читателям не ждать писателя,
+# synchronous=NORMAL в режиме WAL не теряет целостность при сбое
+CONNECTION_PRAGMAS = (
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -8000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 134217728",
+)
+
+
+class Storage:
+    """Долгоживущие соединения с SQLite: один писатель и пул читателей.
+
+    Вся блокирующая работа выполняется в отдельных потоках, поэтому
+    обработчики бота не останавливают event loop. Записи из обработчиков
+    накапливаются в очереди и фиксируются группами: одна транзакция
+    на окно batch_delay секунд или на batch_size записей.
+    """
+
+    def __init__(self, path='achievements.db', readers=4, batch_size=100, batch_delay=0.01):
+        self.path = path
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._closed = False
+
+        self._writer = self._connect()
+        # Должно идти до включения WAL: для новой базы действует сразу,
+        # существующую переводит в этот режим только полный VACUUM
+        self._writer.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._writer.execute("PRAGMA journal_mode = WAL")
+        self._write_lock = threading.Lock()
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+
+        # Очередь записей: (func, args, future, loop)
+        self._pending = collections.deque()
+        self._wakeup = None
+        self._flusher = None
+
+        self._readers = queue.Queue()
+        for _ in range(readers):
+            reader = self._connect()
+            reader.execute("PRAGMA query_only = ON")
+            self._readers.put(reader)
+        self._read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def set_trace_callback(self, callback):
+        """Вызывать callback(sql) для каждого запроса на всех соединениях (None - отключить)"""
+        with self._write_lock:
+            self._writer.set_trace_callback(callback)
+        readers = [self._readers.get() for _ in range(self._readers.qsize())]
+        for reader in readers:
+            reader.set_trace_callback(callback)
+            self._readers.put(reader)
+
+    def write_sync(self, func, *args):
+        """Выполнить func(conn, *args) в транзакции писателя (блокирующе)"""
+        with self._write_lock:
+            with self._writer:
+                return func(self._writer, *args)
+
+    def read_sync(self, func, *args):
+        """Выполнить func(conn, *args) на свободном соединении читателя (блокирующе)"""
+        conn = self._readers.get()
+        try:
+            return func(conn, *args)
+        finally:
+            self._readers.put(conn)
+
+    async def write(self, func, *args):
+        """Поставить запись в очередь и дождаться ее фиксации на диске"""
+        if self._closed:
+            raise RuntimeError("Хранилище закрыто")
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((func, args, future, loop))
+
+        if self._flusher is None or self._flusher.done():
+            self._wakeup = asyncio.Event()
+            self._flusher = loop.create_task(self._flush_loop())
+        self._wakeup.set()
+
+        with tracing.span(f"db write {func.__name__}"):
+            return await future
+
+    async def read(self, func, *args):
+        """Выполнить чтение вне event loop"""
+        loop = asyncio.get_running_loop()
+        with tracing.span(f"db read {func.__name__}"):
+            return await loop.run_in_executor(self._read_executor, self.read_sync, func, *args)
+
+    async def _flush_loop(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            # Окно накопления: ждем, пока подтянутся записи соседних обновлений
+            if len(self._pending) < self.batch_size and self.batch_delay:
+                await asyncio.sleep(self.batch_delay)
+
+            while self._pending:
+                batch = self._take_batch()
+                await loop.run_in_executor(self._write_executor, self._commit_batch, batch)
+
+    def _take_batch(self):
+        batch = []
+        while self._pending and len(batch) < self.batch_size:
+            batch.append(self._pending.popleft())
+        return batch
+
+    def _commit_batch(self, batch):
+        """Зафиксировать пачку записей одной транзакцией и сообщить результаты"""
+        results = []
+
+        with self._write_lock:
+            conn = self._writer
+            started = time.perf_counter()
+            try:
+                conn.execute("BEGIN")
+                for func, args, _, _ in batch:
+                    # Ошибка одной записи откатывает только ее, а не всю пачку
+                    conn.execute("SAVEPOINT write_item")
+                    try:
+                        results.append((func(conn, *args), None))
+                    except Exception as e:
+                        conn.execute("ROLLBACK TO write_item")
+                        results.append((None, e))
+                    conn.execute("RELEASE write_item")
+                conn.commit()
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                logger.error(f"Ошибка фиксации пачки из {len(batch)} записей: {e}")
+                results = [(None, e)] * len(batch)
+
+        metrics.DB_WRITE_BATCH_SECONDS.observe(time.perf_counter() - started)
+        metrics.DB_WRITE_BATCH_SIZE.observe(len(batch))
+
+        for (_, _, future, loop), (result, error) in zip(batch, results):
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(_resolve, future, result, error)
+
+    def drain(self):
+        """Синхронно зафиксировать все записи, ожидающие в очереди"""
+        count = 0
+        while self._pending:
+            batch = self._take_batch()
+            self._commit_batch(batch)
+            count += len(batch)
+
+        if count:
+            logger.info(f"Зафиксировано {count} записей из очереди")
+        return count
+
+    def close(self):
+        """Зафиксировать очередь, дождаться текущих операций и закрыть соединения"""
+        if self._closed:
+            return
+        self._closed = True
+
+        self.drain()
+        if self._flusher is not None:
+            self._flusher.cancel()
+
+        self._write_executor.shutdown(wait=True)
+        self._read_executor.shutdown(wait=True)
+        # Записи, поставленные пока выполнялась последняя пачка
+        self.drain()
+
+        with self._write_lock:
+            self._writer.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+        logger.info("Соединения с базой данных закрыты")
+
+
+def _resolve(future, result, error):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
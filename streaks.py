@@ -0,0 +1,89 @@
+from array import array
+from collections import namedtuple
+from datetime import date
+
+from goals import ALL_GOALS_MASK, DAILY_GOALS, GOAL_BITS
+
+# current - текущая серия дней, longest - самая длинная серия за историю
+Streak = namedtuple('Streak', ['current', 'longest'])
+StreakReport = namedtuple('StreakReport', ['any_goal', 'all_goals', 'goals'])
+
+
+def build_day_vectors(day_masks, today):
+    """Маски по дням -> векторы дней в виде целых чисел, по одному на цель.
+
+    Бит i вектора означает, что цель выполнена за i дней до today.
+    Кроме векторов целей возвращаются векторы «хоть одна цель» и «все цели».
+    """
+    offsets = array('I')
+    masks = array('Q')
+    for day, mask in day_masks:
+        if isinstance(day, str):
+            day = date.fromisoformat(day)
+        offset = (today - day).days
+        if offset >= 0:
+            offsets.append(offset)
+            masks.append(mask)
+
+    goal_vectors = {goal_id: 0 for goal_id in GOAL_BITS}
+    any_vector = 0
+    all_vector = 0
+
+    for offset, mask in zip(offsets, masks):
+        day_bit = 1 << offset
+        if mask:
+            any_vector |= day_bit
+        if mask & ALL_GOALS_MASK == ALL_GOALS_MASK:
+            all_vector |= day_bit
+        for goal_id, goal_bit in GOAL_BITS.items():
+            if mask & goal_bit:
+                goal_vectors[goal_id] |= day_bit
+
+    return any_vector, all_vector, goal_vectors
+
+
+def current_streak(vector):
+    """Число подряд идущих дней до сегодня включительно.
+
+    Если сегодня цель еще не выполнена, серия продолжается со вчерашнего дня.
+    """
+    if not vector & 1:
+        vector >>= 1
+    # Число младших единичных битов
+    return (~vector & (vector + 1)).bit_length() - 1
+
+
+def longest_streak(vector):
+    """Длина самой длинной серии единичных битов"""
+    # Каждый шаг укорачивает все серии на один день
+    length = 0
+    while vector:
+        vector &= vector >> 1
+        length += 1
+    return length
+
+
+def compute_streaks(day_masks, today):
+    """Серии по истории пользователя: любой цели, всех целей и каждой цели"""
+    any_vector, all_vector, goal_vectors = build_day_vectors(day_masks, today)
+
+    def streak(vector):
+        return Streak(current_streak(vector), longest_streak(vector))
+
+    return StreakReport(
+        any_goal=streak(any_vector),
+        all_goals=streak(all_vector),
+        goals={goal_id: streak(vector) for goal_id, vector in goal_vectors.items()},
+    )
+
+
+def render_streaks(report):
+    """Текст блока серий для экрана управления челленджем"""
+    text = (
+        f"🔥 Серия активных дней: {report.any_goal.current} (рекорд {report.any_goal.longest})\n"
+        f"🏆 Серия дней со всеми целями: {report.all_goals.current} (рекорд {report.all_goals.longest})\n"
+    )
+    for goal_id, goal_info in DAILY_GOALS.items():
+        streak = report.goals[goal_id]
+        text += f"{goal_info['emoji']} {goal_info['name']}: {streak.current} (рекорд {streak.longest})\n"
+    return text
@@ -0,0 +1,102 @@
+"""Одно и то же поведение движков sqlite и memory"""
+import asyncio
+import glob
+import shutil
+from datetime import date, timedelta
+
+import pytest
+
+import database
+import manage
+from goals import DAILY_GOALS
+
+GOAL_ID = 'workout'
+GOAL = DAILY_GOALS[GOAL_ID]
+
+
+@pytest.fixture(params=database.ENGINES)
+def engine(request, tmp_path):
+    database.init_db(str(tmp_path / 'bot.db'), engine=request.param)
+    yield request.param
+    database.close_db()
+
+
+def tap(user_id, update_id, day=None):
+    return database.add_achievement(user_id, GOAL['category'], GOAL_ID, GOAL['points'], update_id, day=day)
+
+
+def test_redelivered_update_is_not_recorded(engine):
+    async def scenario():
+        await database.get_or_create_user(1, None, 'user1')
+        results = [await tap(1, 100), await tap(1, 100)]
+        # Память недавних update_id потеряна (вытеснение, перезапуск): повтор находит движок
+        database.recent_updates.clear()
+        results.append(await tap(1, 100))
+        # Повторная доставка после полуночи
+        database.recent_updates.clear()
+        results.append(await tap(1, 100, day=date.today() + timedelta(days=1)))
+        return results, await database.get_totals()
+
+    results, totals = asyncio.run(scenario())
+
+    assert results == [database.RECORDED] + [database.DUPLICATE_UPDATE] * 3
+    assert totals['achievements'] == 1
+
+
+def test_goals_are_unlimited_by_default(engine):
+    async def scenario():
+        await database.get_or_create_user(1, None, 'user1')
+        return [await tap(1, 100 + i) for i in range(5)]
+
+    assert asyncio.run(scenario()) == [database.RECORDED] * 5
+
+
+def test_daily_limit(engine, monkeypatch):
+    monkeypatch.setitem(database.GOAL_LIMITS, GOAL_ID, 2)
+
+    async def scenario():
+        await database.get_or_create_user(1, None, 'user1')
+        today = [await tap(1, 100 + i) for i in range(3)]
+        tomorrow = await tap(1, 200, day=date.today() + timedelta(days=1))
+        return today, tomorrow
+
+    today, tomorrow = asyncio.run(scenario())
+
+    assert today == [database.RECORDED, database.RECORDED, database.DAILY_LIMIT]
+    assert tomorrow == database.RECORDED
+
+
+def test_recovery_after_crash(engine, tmp_path):
+    path = str(tmp_path / 'bot.db')
+    crash = str(tmp_path / 'crash.db')
+
+    async def before_crash():
+        for user_id in (1, 2):
+            await database.get_or_create_user(user_id, None, f'user{user_id}')
+        return [await tap(user_id, 100 + user_id * 10 + i) for user_id in (1, 2) for i in range(3)]
+
+    assert asyncio.run(before_crash()) == [database.RECORDED] * 6
+    # Копия файлов без закрытия базы: так их оставило бы падение процесса
+    database.drain_writes()
+    for source in glob.glob(glob.escape(path) + '*'):
+        shutil.copy(source, crash + source[len(path):])
+    database.close_db()
+
+    database.init_db(crash, engine=engine)
+
+    async def after_crash():
+        mask = await database.get_completed_mask(1, date.today())
+        return mask, await tap(1, 110), await database.get_totals()
+
+    mask, redelivered, totals = asyncio.run(after_crash())
+
+    assert mask == database.GOAL_BITS[GOAL_ID]
+    assert redelivered == database.DUPLICATE_UPDATE
+    assert totals['users'] == 2
+    assert totals['achievements'] == 6
+    assert not any(database.rollup_mismatches().values())
+
+
+def test_engines_agree_on_full_scenario():
+    # Сценарий manage.py check-engines: импорт, повторы, лимиты, перезапуск, падение
+    assert manage.cmd_check_engines(None) == 0
@@ -0,0 +1,57 @@
+"""Аренда лидерства и передача работы между экземплярами бота"""
+import argparse
+import asyncio
+import time
+
+from handover import run_handover
+from leadership import LeaderLease
+
+
+def lease(tmp_path, holder, ttl=5.0):
+    return LeaderLease(str(tmp_path / 'bot.lease'), holder, ttl=ttl, interval=0.01)
+
+
+def test_new_instance_waits_for_release(tmp_path):
+    old, new = lease(tmp_path, 'old'), lease(tmp_path, 'new')
+    assert old.try_acquire() == (True, None)
+    assert new.try_acquire() == (False, 'old')
+
+    async def watch():
+        # Лидер замечает запрос передачи и начинает остановку
+        lost = asyncio.Event()
+        old.start(lost.set)
+        await asyncio.wait_for(lost.wait(), 5)
+        await old.stop()
+
+    asyncio.run(watch())
+    assert old.superseded
+    # Пока старый экземпляр не освободил аренду, новый ждет
+    assert new.try_acquire() == (False, 'old')
+
+    old.release()
+    assert new.try_acquire() == (True, None)
+    assert new.current_holder() == 'new'
+    new.release()
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    crashed, new = lease(tmp_path, 'crashed', ttl=0.05), lease(tmp_path, 'new')
+    assert crashed.try_acquire() == (True, None)
+    time.sleep(0.1)
+
+    assert new.try_acquire() == (True, None)
+    # Упавший лидер, если ожил, видит, что аренда у другого
+    assert crashed._check(renew=True) == (False, None)
+    new.release()
+    crashed.release()
+
+
+def test_handover_between_bot_instances(tmp_path):
+    args = argparse.Namespace(rate=20, warmup=1.0, after=1.0, settle=1.0, startup_timeout=30.0)
+
+    result = asyncio.run(run_handover(args, workdir=str(tmp_path)))
+
+    assert result['first_exit_code'] == 0
+    assert result['lost'] == 0
+    assert result['duplicated'] == 0
+    assert result['answered'] == result['messages'] > 0
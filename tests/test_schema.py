@@ -0,0 +1,70 @@
+"""Миграции схемы и планы горячих запросов"""
+import sqlite3
+
+import pytest
+
+import database
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'bot.db')
+    database.init_db(path, engine='sqlite')
+    yield path
+    database.close_db()
+
+
+def _schema(path):
+    conn = sqlite3.connect(path)
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(achievements)")]
+    finally:
+        conn.close()
+    return version, columns
+
+
+def test_hot_queries_use_indexes(db_path):
+    assert database.query_plan_problems() == []
+
+
+def test_full_scan_is_reported(db_path, monkeypatch):
+    monkeypatch.setitem(database.QUERIES, 'by_points', "SELECT user_id FROM achievements WHERE points = ?")
+
+    problems = database.query_plan_problems()
+
+    assert [name for name, _ in problems] == ['by_points']
+    assert problems[0][1].startswith('SCAN')
+
+
+def test_migrations_bring_schema_to_latest_version(db_path):
+    version, columns = _schema(db_path)
+    assert version == len(database.MIGRATIONS)
+    assert 'update_id' in columns
+
+
+def test_interrupted_migration_is_rolled_back(tmp_path, monkeypatch):
+    path = str(tmp_path / 'bot.db')
+    number = database.MIGRATIONS.index(database._add_achievement_update_id)
+
+    def interrupted(conn):
+        database._add_achievement_update_id(conn)
+        # Падение после ALTER TABLE, до смены user_version
+        raise KeyboardInterrupt
+
+    migrations = list(database.MIGRATIONS)
+    migrations[number] = interrupted
+    monkeypatch.setattr(database, 'MIGRATIONS', migrations)
+    with pytest.raises(KeyboardInterrupt):
+        database.init_db(path, engine='sqlite')
+    database.close_db()
+
+    version, columns = _schema(path)
+    assert version == number
+    assert 'update_id' not in columns
+
+    # Следующий запуск применяет миграцию заново
+    monkeypatch.undo()
+    database.init_db(path, engine='sqlite')
+    database.close_db()
+    assert _schema(path) == (len(database.MIGRATIONS), columns + ['update_id'])
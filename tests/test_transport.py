@@ -0,0 +1,147 @@
+"""Бот целиком в отдельном процессе против fake_bot_api: polling и webhook"""
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import httpx
+import pytest
+
+from fake_bot_api import FakeBotApi
+from handover import free_port
+from http_server import HttpServer, Response
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bot.py')
+SECRET = 'test-secret'
+STARTUP_TIMEOUT = 30.0
+
+
+def start_bot(workdir, api_url, mode, port):
+    env = dict(
+        os.environ,
+        BOT_TOKEN='1:test',
+        BOT_MODE=mode,
+        BOT_API_URL=api_url,
+        DB_PATH=os.path.join(workdir, 'bot.db'),
+        PORT=str(port),
+        WEBHOOK_URL=f'http://127.0.0.1:{port}',
+        WEBHOOK_SECRET=SECRET,
+        SEND_GLOBAL_RATE='0',
+        SEND_CHAT_RATE='0',
+    )
+    log = open(os.path.join(workdir, 'bot.log'), 'w')
+    return subprocess.Popen([sys.executable, BOT_SCRIPT], env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def stop_bot(process):
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+    return process.wait(timeout=STARTUP_TIMEOUT)
+
+
+async def wait_for(predicate, timeout=STARTUP_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("Не дождались ответа бота")
+        await asyncio.sleep(0.05)
+
+
+async def ask(api, user_id, text):
+    """Сообщение пользователя и первый ответ бота на него"""
+    sent = len(api.sent_messages(user_id))
+    await api.push_message(user_id, text)
+    await wait_for(lambda: len(api.sent_messages(user_id)) > sent)
+    return api.sent_messages(user_id)[sent]
+
+
+@pytest.mark.parametrize('mode', ['polling', 'webhook'])
+def test_round_trip(tmp_path, mode):
+    port = free_port()
+
+    async def scenario():
+        api = FakeBotApi()
+        await api.start()
+        bot = start_bot(str(tmp_path), api.url, mode, port)
+        try:
+            if mode == 'webhook':
+                # Бот регистрирует webhook после запуска HTTP сервера
+                await wait_for(lambda: api.webhook_url is not None or bot.poll() is not None)
+                assert api.webhook_url == f'http://127.0.0.1:{port}/telegram'
+                assert api.webhook_secret == SECRET
+
+            greeting = await ask(api, 1, '/start')
+            assert 'Привет' in greeting['text']
+            confirmation = await ask(api, 1, '💪 Тренировка')
+            assert 'тренировку' in confirmation['text']
+
+            async with httpx.AsyncClient() as client:
+                health = await client.get(f'http://127.0.0.1:{port}/health')
+                if mode == 'webhook':
+                    headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET}
+                    malformed = await client.post(api.webhook_url, content=b'[1]', headers=headers)
+                    foreign = await client.post(api.webhook_url, json={'update_id': 1}, headers={})
+                    assert (malformed.status_code, foreign.status_code) == (400, 403)
+                    assert set(api.webhook_responses) == {200}
+            assert health.status_code == 200
+        finally:
+            code = await asyncio.get_running_loop().run_in_executor(None, stop_bot, bot)
+            await api.stop()
+        return code
+
+    assert asyncio.run(scenario()) == 0
+
+
+async def _exchange(server, raw):
+    """Отправить серверу байты запроса и вернуть строку статуса ответа"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+    try:
+        writer.write(raw)
+        await writer.drain()
+        return (await reader.readline()).decode('latin-1').strip()
+    finally:
+        writer.close()
+
+
+@pytest.mark.parametrize('raw, status', [
+    (b'GET /health HTTP/1.1\r\nHost: x\r\n\r\n', 200),
+    (b'POST /health HTTP/1.1\r\nContent-Length: abc\r\n\r\n', 400),
+    (b'POST /health HTTP/1.1\r\nContent-Length: -5\r\n\r\n', 400),
+    (b'GET /health HTTP/1.1\r\nX-Long: ' + b'a' * 100_000 + b'\r\n\r\n', 400),
+    (b'GET /health HTTP/1.1\r\n' + b'X-Same: 1\r\n' * 101 + b'\r\n', 431),
+    (b'nonsense\r\n\r\n', 400),
+])
+def test_http_server_rejects_malformed_requests(raw, status):
+    async def scenario():
+        server = HttpServer('127.0.0.1', 0)
+
+        async def health(request):
+            return Response(200, 'OK')
+
+        server.route('GET', '/health', health)
+        server.route('POST', '/health', health)
+        await server.start()
+        try:
+            return await _exchange(server, raw)
+        finally:
+            await server.stop()
+
+    assert asyncio.run(scenario()).split(' ')[1] == str(status)
+
+
+def test_http_server_closes_idle_connections():
+    async def scenario():
+        server = HttpServer('127.0.0.1', 0, read_timeout=0.2)
+        await server.start()
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+            # Соединение без запроса закрывается сервером по таймауту
+            closed = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return closed
+        finally:
+            await server.stop()
+
+    assert asyncio.run(scenario()) == b''
@@ -0,0 +1,180 @@
+"""Трассировка медленных обновлений и окно профилирования cProfile.
+
+Трассируется доля обновлений sample_rate. Для трассируемого обновления
+записываются интервалы (span) обращений к базе, подготовки текста и
+вызовов Bot API. Обновление дольше slow_threshold пишется в лог
+с разбивкой по интервалам и сохраняется в списке последних медленных.
+Без трассировки span стоит одной проверки contextvar.
+"""
+import cProfile
+import collections
+import contextvars
+import io
+import logging
+import marshal
+import pstats
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('trace', default=None)
+
+# Последние медленные обновления для /admin/traces
+slow_traces = collections.deque(maxlen=100)
+
+sample_rate = 0.0
+slow_threshold = 1.0
+
+
+def configure(rate=None, threshold=None):
+    """Изменить долю трассируемых обновлений и порог медленного обновления"""
+    global sample_rate, slow_threshold
+
+    if rate is not None:
+        if not 0.0 <= rate <= 1.0:
+            raise ValueError(f"Доля трассировки должна быть от 0 до 1, получено {rate}")
+        sample_rate = rate
+    if threshold is not None:
+        slow_threshold = threshold
+
+
+class Trace:
+    def __init__(self, name, user_id):
+        self.name = name
+        self.user_id = user_id
+        self.started = time.perf_counter()
+        self.duration = None
+        # (имя, начало от старта обновления, длительность)
+        self.spans = []
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'user_id': self.user_id,
+            'duration': round(self.duration, 6),
+            'spans': [
+                {'name': name, 'offset': round(offset, 6), 'duration': round(duration, 6)}
+                for name, offset, duration in self.spans
+            ],
+        }
+
+    def format(self):
+        lines = [f"Медленное обновление {self.name} пользователя {self.user_id}: {self.duration * 1000:.1f} мс"]
+        for name, offset, duration in self.spans:
+            lines.append(f"  +{offset * 1000:8.1f} мс  {duration * 1000:8.1f} мс  {name}")
+        accounted = sum(duration for _, _, duration in self.spans)
+        lines.append(f"  вне интервалов: {(self.duration - accounted) * 1000:.1f} мс")
+        return '\n'.join(lines)
+
+
+class trace_update:
+    """Контекстный менеджер обновления: с вероятностью sample_rate включает трассировку"""
+
+    __slots__ = ('name', 'user_id', 'trace', 'token')
+
+    def __init__(self, name, user_id=None):
+        self.name = name
+        self.user_id = user_id
+        self.trace = None
+
+    def __enter__(self):
+        if sample_rate and random.random() < sample_rate:
+            self.trace = Trace(self.name, self.user_id)
+            self.token = _current.set(self.trace)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        trace = self.trace
+        if trace is None:
+            return False
+
+        _current.reset(self.token)
+        trace.duration = time.perf_counter() - trace.started
+        if trace.duration >= slow_threshold:
+            slow_traces.append(trace)
+            logger.warning(trace.format())
+        return False
+
+
+class span:
+    """Интервал внутри трассируемого обновления"""
+
+    __slots__ = ('name', 'trace', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.trace = _current.get()
+        if self.trace is not None:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.trace is not None:
+            finished = time.perf_counter()
+            self.trace.spans.append((self.name, self.started - self.trace.started, finished - self.started))
+        return False
+
+
+class Profiler:
+    """Окно профилирования cProfile для потока event loop"""
+
+    def __init__(self):
+        self._profile = None
+        self._timer = None
+        self.started_at = None
+        self.stats = None
+        self.window = None
+
+    @property
+    def running(self):
+        return self._profile is not None
+
+    def start(self, loop=None, seconds=None):
+        """Начать профилирование, при seconds - с автоматической остановкой"""
+        if self.running:
+            raise RuntimeError("Профилирование уже запущено")
+
+        self._profile = cProfile.Profile()
+        self.started_at = time.time()
+        self._profile.enable()
+        if seconds and loop is not None:
+            self._timer = loop.call_later(seconds, self.stop)
+        logger.info(f"Профилирование запущено{f' на {seconds} с' if seconds else ''}")
+
+    def stop(self):
+        """Остановить профилирование и сохранить статистику"""
+        if not self.running:
+            return False
+
+        self._profile.disable()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        self._profile.create_stats()
+        self.stats = self._profile.stats
+        self.window = (self.started_at, time.time())
+        self._profile = None
+        logger.info(f"Профилирование остановлено через {self.window[1] - self.window[0]:.1f} с")
+        return True
+
+    def dump(self):
+        """Статистика в формате файла cProfile (pstats.Stats, snakeviz)"""
+        return marshal.dumps(self.stats) if self.stats is not None else None
+
+    def report(self, sort='cumulative', limit=50):
+        """Текстовая сводка по самым дорогим функциям"""
+        if self.stats is None:
+            return None
+        stream = io.StringIO()
+        stats = pstats.Stats(stream=stream)
+        stats.stats = self.stats
+        stats.get_top_level_stats()
+        stats.sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+
+profiler = Profiler()
@@ -0,0 +1,67 @@
+import collections
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+def update_user_key(update):
+    """Ключ упорядочивания: id пользователя, иначе id чата, иначе None"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений разных пользователей.
+
+    Обновления одного пользователя выполняются строго по порядку: первое
+    обновление становится обработчиком очереди пользователя, следующие
+    добавляются в эту очередь и не занимают отдельных слотов. Очередь
+    удаляется, как только пользователь перестает присылать обновления.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._queues = {}
+
+    @property
+    def active_users(self):
+        return len(self._queues)
+
+    async def do_process_update(self, update, coroutine):
+        key = update_user_key(update)
+        if key is None:
+            await coroutine
+            return
+
+        queue = self._queues.get(key)
+        if queue is not None:
+            # Пользователь уже обрабатывается - выполним после предыдущих обновлений
+            queue.append(coroutine)
+            return
+
+        self._queues[key] = queue = collections.deque([coroutine])
+        try:
+            while queue:
+                try:
+                    await queue.popleft()
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке обновления пользователя {key}: {e}")
+        finally:
+            del self._queues[key]
+            # При отмене оставшиеся обновления уже не будут выполнены
+            for pending in queue:
+                pending.close()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass